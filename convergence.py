@@ -18,10 +18,13 @@ from src import (
     analyzer, 
     qe_runner, 
     fc3_builder,  
+    fc3_store,
+    fc3_pruner,
     bte_runner,   
     collector,    
     plotter,
-    automator       
+    automator,
+    executor
 )
 
 def resolve_path(relative_path):
@@ -48,9 +51,14 @@ def main():
     commands_help = (
         "generate    : Generate supercell files (DISP.*)\n"
         "link        : Deduplicate structures using symlinks\n"
+        "sym_expand  : Synthesize symmetry-equivalent DISP.*.out files\n"
         "submit_dft  : Submit DFT (Quantum Espresso) jobs\n"
+        "validate_dft: Classify DFT outputs and resubmit failed jobs\n"
         "gen_fc3     : Harvest results and generate FORCE_CONSTANTS_3RD\n"
+        "compare     : Compare FORCE_CONSTANTS_3RD between cutoffs and supercells\n"
+        "prune_bench : ShengBTE runtime and kappa change for PRUNE_BENCHMARK thresholds\n"
         "analyze     : Analyze computational savings\n"
+        "plan        : Dry-run job counts and core-hours before generating files\n"
         "run_bte     : Submit ShengBTE calculation tasks\n"
         "collect     : Collect thermal conductivity results to JSON\n"
         "plot        : Plot convergence curves (PRB style)\n"
@@ -58,8 +66,8 @@ def main():
     )
     
     parser.add_argument("command", 
-                        choices=['generate', 'link', 'submit_dft', 'gen_fc3', 
-                                 'analyze', 'run_bte', 'collect', 'plot', 'auto'], 
+                        choices=['generate', 'link', 'sym_expand', 'submit_dft', 'validate_dft', 'gen_fc3', 
+                                 'compare', 'prune_bench', 'analyze', 'plan', 'run_bte', 'collect', 'plot', 'auto'], 
                         help=commands_help)
     
     parser.add_argument("control_file", nargs='?', default="INPUT", 
@@ -77,6 +85,7 @@ def main():
         return c.config if hasattr(c, 'config') else c
     
     cfg_dict = get_cfg_dict(raw_cfg)
+    executor.configure(cfg_dict.get('executor', {}))
 
     if args.command == 'generate':
         configs = raw_cfg.get('cell', 'configs')
@@ -85,12 +94,22 @@ def main():
         thirdorder_bin = raw_cfg.get('cell', 'THIRDORDER_BIN', 'thirdorder_espresso.py')
 
         if configs and base_in:
-            generator.run_generation(configs, base_in, tpl_name, thirdorder_bin)
+            generator.run_generation(configs, base_in, tpl_name, thirdorder_bin,
+                                     raw_cfg.get('cell', 'GEN_WORKERS'),
+                                     raw_cfg.get('cell', 'DISP_LAYOUT', 'classic'))
 
     elif args.command == 'link':
         configs = raw_cfg.get('cell', 'configs')
+        tolerance = raw_cfg.get('cell', 'DEDUP_TOLERANCE')
         if configs:
-            deduplicator.run_linking(configs)
+            deduplicator.run_linking(configs, tolerance, raw_cfg.get('cell', 'DEDUP_WORKERS'))
+            if raw_cfg.get('cell', 'DEDUP_MODE', 'link') == 'symmetry':
+                deduplicator.run_symmetry_reduction(configs, raw_cfg.get('cell', 'SYMPREC'))
+
+    elif args.command == 'sym_expand':
+        configs = raw_cfg.get('cell', 'configs')
+        if configs:
+            deduplicator.expand_symmetric_outputs(configs)
 
     elif args.command == 'analyze':
         analyze_cfg = cfg_dict.get('analyze', {}).copy()
@@ -99,6 +118,16 @@ def main():
         
         analyzer.run_analysis(analyze_cfg)
 
+    elif args.command == 'plan':
+        configs = raw_cfg.get('cell', 'configs')
+        base_in = raw_cfg.get('cell', 'base_input')
+        analyze_cfg = cfg_dict.get('analyze', {}).copy()
+        if 'COST_ESTIMATES' in cfg_dict:
+            analyze_cfg['COST_ESTIMATES'] = cfg_dict['COST_ESTIMATES']
+
+        if configs and base_in:
+            analyzer.run_plan(configs, base_in, analyze_cfg, raw_cfg.get('cell', 'DEDUP_TOLERANCE'))
+
     elif args.command == 'submit_dft':
         dft_cfg = cfg_dict.get('dft', {})
         if dft_cfg:
@@ -108,6 +137,16 @@ def main():
         else:
             print("Error: No &dft section found.")
 
+    elif args.command == 'validate_dft':
+        dft_cfg = cfg_dict.get('dft', {})
+        configs = raw_cfg.get('cell', 'configs')
+        if dft_cfg and configs:
+            raw_script = dft_cfg.get('SUB_SCRIPT', 'templates/sub_calc.sh')
+            dft_cfg['SUB_SCRIPT'] = resolve_path(raw_script)
+            qe_runner.validate_dft_jobs(dft_cfg, configs)
+        else:
+            print("Error: No &dft section or configs found.")
+
     elif args.command == 'gen_fc3':
         configs = raw_cfg.get('cell', 'configs')
         base_in = raw_cfg.get('cell', 'base_input')
@@ -119,12 +158,29 @@ def main():
         if configs and base_in:
             fc3_builder.run_reaping(raw_cfg, sub_gen_script)
 
+    elif args.command == 'compare':
+        configs = raw_cfg.get('cell', 'configs')
+        base_in = raw_cfg.get('cell', 'base_input')
+        if configs and base_in:
+            fc3_store.run_comparison(configs, base_in)
+
+    elif args.command == 'prune_bench':
+        submit_cfg = cfg_dict.get('submit', {})
+        if submit_cfg:
+            raw_script = submit_cfg.get('SUB_SCRIPT', 'templates/sub_sheng.sh')
+            submit_cfg['SUB_SCRIPT'] = resolve_path(raw_script)
+            fc3_pruner.run_benchmark(raw_cfg, submit_cfg)
+            executor.drain()
+            fc3_pruner.report_benchmark(raw_cfg, submit_cfg)
+        else:
+            print("Error: No &submit section found.")
+
     elif args.command == 'run_bte':
         submit_cfg = cfg_dict.get('submit', {})
         if submit_cfg:
             raw_script = submit_cfg.get('SUB_SCRIPT', 'templates/sub_sheng.sh')
             submit_cfg['SUB_SCRIPT'] = resolve_path(raw_script)
-            bte_runner.submit_jobs(submit_cfg)
+            bte_runner.submit_jobs(submit_cfg, fc3_files=fc3_pruner.run_pruning(raw_cfg))
         else:
             print("Error: No &submit section found.")
 
@@ -147,5 +203,7 @@ def main():
     elif args.command == 'auto':
         automator.run_automation(raw_cfg)
 
+    executor.drain()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,134 @@
+import os
+import json
+
+DEFAULT_TOLERANCE = 0.05
+ROUND_FILE = "adaptive_round.json"
+
+def grid_label(grid):
+    return "x".join(str(n) for n in grid)
+
+def kappa_values(summary, grid, cutoff):
+    """Flatten {T: {component: kappa}} of one config to {(T, component): kappa}, or None."""
+    per_cut = summary.get(grid_label(grid), {})
+    entry = per_cut.get(str(cutoff), per_cut.get(cutoff))
+    if not entry:
+        return None
+    return {(temp, comp): value for temp, comps in entry.items() for comp, value in comps.items()}
+
+def max_relative_change(old, new):
+    common = set(old) & set(new)
+    if not common:
+        return None
+    return max(abs(new[k] - old[k]) / max(abs(old[k]), abs(new[k]), 1e-12) for k in common)
+
+def walk(summary, candidates, tolerance, skip):
+    """Follow an ordered candidate list until two successive results agree.
+
+    Returns (converged, missing, history): `converged` is the first config of the agreeing
+    pair, `missing` the candidates still needed to decide, `history` the changes seen.
+    """
+    previous = None
+    history = []
+    for index, config in enumerate(candidates):
+        if config in skip:
+            continue
+        values = kappa_values(summary, config[:3], config[3])
+        if values is None:
+            return None, [c for c in candidates[index:] if c not in skip], history
+        if previous is not None:
+            change = max_relative_change(previous[1], values)
+            history.append((previous[0], config, change))
+            if change is not None and change <= tolerance:
+                return previous[0], [], history
+        previous = (config, values)
+    return None, [], history
+
+def plan_next(summary, supercells, cutoffs, tolerance, lookahead=0, failed=()):
+    """Decide what to run next from the collected kappa.
+
+    The cutoff is converged first on the smallest supercell, then the supercell at that
+    cutoff. Returns (todo, result): `todo` lists the configs to evaluate in the next round
+    (empty once finished), `result` is the converged (na, nb, nc, cutoff) or None.
+    """
+    failed = set(tuple(c) for c in failed)
+    width = 1 + max(0, int(lookahead))
+
+    base = tuple(supercells[0])
+    cut_line = [base + (cut,) for cut in cutoffs]
+    cut_conv, missing, _ = walk(summary, cut_line, tolerance, failed)
+    if missing:
+        # Two points are needed before anything can be compared
+        evaluated = [c for c in cut_line if c not in missing and c not in failed]
+        return missing[:width + (0 if evaluated else 1)], None
+    if cut_conv is None:
+        print("  [Adaptive] Cutoff did not converge over the candidates; using the largest.")
+        done = [c for c in cut_line if c not in failed]
+        if not done:
+            return [], None
+        cut_conv = done[-1]
+
+    cutoff = cut_conv[3]
+    sc_line = [tuple(sc) + (cutoff,) for sc in supercells]
+    sc_conv, missing, _ = walk(summary, sc_line, tolerance, failed)
+    if missing:
+        return missing[:width], None
+    if sc_conv is None:
+        print("  [Adaptive] Supercell did not converge over the candidates; using the largest.")
+        done = [c for c in sc_line if c not in failed]
+        return [], done[-1] if done else None
+    return [], sc_conv
+
+def load_summary(collect_cfg):
+    path = os.path.join(collect_cfg.get('ROOT_DIR', '.'), collect_cfg.get('OUTPUT_JSON', 'kappa_summary.json'))
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        print(f"  [Warning] Could not read '{path}'.")
+        return {}
+
+def load_round(candidates, path=ROUND_FILE):
+    """The round `auto` was working on when it stopped: (round_no, todo, failed), or None.
+
+    A restart must finish the same `todo` before planning again, otherwise the workflow
+    state (keyed by the round's configs) would be discarded and queued DFT resubmitted.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            saved = json.load(f)
+        todo = [tuple(c) for c in saved['todo']]
+        failed = set(tuple(c) for c in saved['failed'])
+        round_no = int(saved['round'])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        print(f"  [Warning] Ignoring unreadable adaptive round '{path}'.")
+        return None
+    if not set(todo) <= set(candidates):
+        print(f"  [Info] '{path}' lists configs outside the candidate grid; planning a new round.")
+        return None
+    return round_no, todo, failed
+
+def save_round(round_no, todo, failed, path=ROUND_FILE):
+    with open(path + ".tmp", 'w') as f:
+        json.dump({'round': round_no, 'todo': [list(c) for c in todo],
+                   'failed': sorted(list(c) for c in failed)}, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def report(summary, supercells, cutoffs, tolerance, failed=()):
+    """Print the successive changes along both search axes."""
+    failed = set(tuple(c) for c in failed)
+    base = tuple(supercells[0])
+    cut_conv, _, history = walk(summary, [base + (c,) for c in cutoffs], tolerance, failed)
+    lines = [("cutoff", history)]
+    if cut_conv is not None:
+        _, _, sc_history = walk(summary, [tuple(sc) + (cut_conv[3],) for sc in supercells],
+                                tolerance, failed)
+        lines.append(("supercell", sc_history))
+    for axis, steps in lines:
+        for old, new, change in steps:
+            shown = "n/a" if change is None else f"{change * 100:.2f}%"
+            print(f"    {axis:<9} {grid_label(old[:3])}/{old[3]} -> {grid_label(new[:3])}/{new[3]}: "
+                  f"max change {shown}")
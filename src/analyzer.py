@@ -1,9 +1,16 @@
 import os
 import glob
 import re
+import math
 from collections import defaultdict
+from src import disp_archive, pw_output, dft_validator, structure, sow_engine, deduplicator
 
 def get_folder_stats(folder_path):
+    if disp_archive.is_packed(folder_path):
+        names = disp_archive.list_inputs(folder_path)
+        saved = set(disp_archive.load_links(folder_path)) | disp_archive.load_sym_skipped(folder_path)
+        return len(names), len(saved.intersection(names))
+
     try:
         all_files = os.listdir(folder_path)
     except FileNotFoundError:
@@ -11,6 +18,11 @@ def get_folder_stats(folder_path):
 
     jobs_status = {}
 
+    sym_skipped = set()
+    if "sym_skip.list" in all_files:
+        with open(os.path.join(folder_path, "sym_skip.list"), 'r') as f:
+            sym_skipped = set(line.strip() for line in f if line.strip())
+
     for f in all_files:
         if not f.startswith("DISP."):
             continue
@@ -28,13 +40,24 @@ def get_folder_stats(folder_path):
                 jobs_status[job_id] = False
             
             full_path = os.path.join(folder_path, f)
-            if os.path.islink(full_path):
+            if os.path.islink(full_path) or f in sym_skipped:
                 jobs_status[job_id] = True
 
     total = len(jobs_status)
     linked = sum(jobs_status.values())
     return total, linked
 
+def measured_runs(folder_path):
+    """(wall hours, processor count) of the pw.x runs that actually ran in the folder (links
+    and symmetry members excluded), read from the force bundle. The count is 0 if unknown."""
+    records = pw_output.load_bundle(folder_path)
+    runs = []
+    for path, (state, _, relation) in dft_validator.scan_folder(folder_path).items():
+        record = records.get(disp_archive.split_path(path)[1])
+        if relation == 'unique' and record is not None and not math.isnan(record['wall']):
+            runs.append((record['wall'] / 3600.0, record['nproc']))
+    return runs
+
 def run_analysis(analyze_cfg):
     LOG_FILE = "linking_report.txt"
     cost_map = analyze_cfg.get('COST_ESTIMATES', {})
@@ -59,7 +82,8 @@ def run_analysis(analyze_cfg):
         data[sc_str].append({
             'cut': cut_str,
             'total': total,
-            'saved': saved
+            'saved': saved,
+            'runs': measured_runs(folder)
         })
         found_sc_keys.add(sc_str)
 
@@ -79,16 +103,30 @@ def run_analysis(analyze_cfg):
         for sc in sorted(list(all_sc_keys)):
             sc_key = str(sc) 
             
-            if sc_key not in cost_map:
-                f.write(f"\n[WARNING] No cost estimate found for Supercell {sc_key}. Assuming 0.\n")
-                unit_cost = 0.0
-            else:
-                unit_cost = float(cost_map[sc_key])
-            
             if sc_key not in data:
                 continue
 
+            runs = [run for entry in data[sc_key] for run in entry['runs']]
+            walls = [w for w, _ in runs]
+            cores = [w * n for w, n in runs if n > 0]
+            mean_wall = sum(walls) / len(walls) if walls else None
+            mean_core = sum(cores) / len(cores) if cores else None
+
+            if sc_key in cost_map:
+                unit_cost = float(cost_map[sc_key])
+            elif mean_core is not None:
+                f.write(f"\n[INFO] No cost estimate for Supercell {sc_key}; using the measured core-hours.\n")
+                unit_cost = round(mean_core, 3)
+            else:
+                f.write(f"\n[WARNING] No cost estimate found for Supercell {sc_key}. Assuming 0.\n")
+                unit_cost = 0.0
+
             f.write(f"\nSupercell {sc_key} (Est. Cost: {unit_cost} Core-Hours/Job)\n")
+            if mean_wall is not None:
+                f.write(f"  Measured: {mean_wall:.3f} Wall-Hours/Job over {len(walls)} pw.x runs")
+                if mean_core is not None:
+                    f.write(f", {mean_core:.3f} Core-Hours/Job over the {len(cores)} with a processor count")
+                f.write("\n")
             f.write(f"{'-'*85}\n")
             f.write(f"{'Cutoff':<10} | {'Total Jobs':<12} | {'Linked(Saved)':<15} | {'Actual Run':<12} | {'Savings %':<10}\n")
             f.write(f"{'-'*85}\n")
@@ -138,4 +176,70 @@ def run_analysis(analyze_cfg):
         f.write(f"  TOTAL COMPUTING SAVED : {grand_total_saved_hours:,.1f} Core-Hours\n")
         f.write(f"{'='*85}\n")
         
-    print(f"--- Analysis Complete. Results saved to {LOG_FILE}. ---")
\ No newline at end of file
+    print(f"--- Analysis Complete. Results saved to {LOG_FILE}. ---")
+
+def run_plan(configs, base_input, analyze_cfg, tolerance=None):
+    tolerance = float(tolerance) if tolerance else structure.DEFAULT_TOLERANCE
+    cost_map = analyze_cfg.get('COST_ESTIMATES', {})
+
+    print("-" * 60)
+    print("--- Savings Dry-Run Plan (no files are written) ---")
+
+    unit = structure.read_unit_cell(base_input)
+    if unit is None:
+        print(f"Error: Could not read unit cell from '{base_input}'.")
+        return
+
+    fingerprint_db = {}
+    rows = []
+
+    for config in configs:
+        na, nb, nc, cut = config
+        sc_key = f"{na}{nb}{nc}"
+        sposcar, frange, displacements = sow_engine.sow_displacements(unit, na, nb, nc, cut)
+
+        unique = 0
+        for idx, frac in enumerate(displacements):
+            struct = {
+                'nat': len(frac),
+                'species': sposcar['species'],
+                'positions': frac,
+                'pos_unit': 'crystal',
+                'cell': sposcar['lattice'],
+                'cell_unit': 'angstrom',
+            }
+            fp = structure.structure_fingerprint(struct, tolerance)
+            if deduplicator.find_master(fingerprint_db, fp, tolerance) is None:
+                deduplicator.register_master(fingerprint_db, fp, (sc_key, cut, idx))
+                unique += 1
+
+        unit_cost = float(cost_map.get(sc_key, 0.0))
+        rows.append((sc_key, cut, frange, len(displacements), unique, unit_cost))
+
+    print(f"{'Supercell':<10} | {'Cutoff':<7} | {'Range(A)':<9} | {'Jobs':<6} | {'Unique':<7} | {'Core-Hours (All -> Unique)':<28}")
+    print("-" * 85)
+
+    total_jobs = 0
+    total_unique = 0
+    total_hours = 0.0
+    unique_hours = 0.0
+    for sc_key, cut, frange, jobs, unique, unit_cost in rows:
+        hours = jobs * unit_cost
+        u_hours = unique * unit_cost
+        print(f"{sc_key:<10} | {cut:<7} | {frange:<9.3f} | {jobs:<6} | {unique:<7} | {hours:>10,.1f} -> {u_hours:,.1f}")
+        total_jobs += jobs
+        total_unique += unique
+        total_hours += hours
+        unique_hours += u_hours
+
+    missing = sorted(set(r[0] for r in rows if r[0] not in cost_map))
+    if missing:
+        print(f"\n[WARNING] No cost estimate for Supercell(s): {', '.join(missing)}. Assuming 0.")
+
+    pct = ((total_jobs - total_unique) / total_jobs * 100) if total_jobs else 0.0
+    print("-" * 85)
+    print(f"  Total Jobs        : {total_jobs}")
+    print(f"  Unique After Dedup: {total_unique} ({pct:.1f}% saved)")
+    print(f"  Est. Core-Hours   : {total_hours:,.1f} -> {unique_hours:,.1f}")
+    print("  Note: 4 jobs per (i, j, a, b) entry of thirdorder's list4, as written by thirdorder sow.")
+    print("-" * 60)
@@ -1,9 +1,8 @@
 import time
-import subprocess
 import sys
 import os
-import glob
-from src import generator, deduplicator, qe_runner, fc3_builder, bte_runner, collector, plotter, analyzer
+from src import adaptive, dft_validator, disp_archive, executor, readiness, workflow_state
+from src import generator, deduplicator, qe_runner, fc3_builder, fc3_pruner, bte_runner, collector, plotter, analyzer
 
 def resolve_path(relative_path):
     if not relative_path: return relative_path
@@ -17,271 +16,531 @@ def resolve_path(relative_path):
         return global_path
     return relative_path
 
-def check_job_status(job_name_keyword, user):
-    try:
-        cmd = f"squeue -u {user} -o '%.100j' -h"
-        result = subprocess.check_output(cmd, shell=True).decode('utf-8')
-        return any(job_name_keyword in line for line in result.split('\n') if line.strip())
-    except subprocess.CalledProcessError:
-        return False
+MIN_POLL_INTERVAL = 10
+BACKOFF_FACTOR = 1.5
 
-def wait_for_jobs(step_name, job_keyword, check_interval=300):
-    user = subprocess.check_output("whoami", shell=True).decode('utf-8').strip()
-    print(f"--- [Auto] Waiting for {step_name} jobs (Keyword: '{job_keyword}') to finish... ---")
-    
-    start_time = time.time()
-    while True:
-        if not check_job_status(job_keyword, user):
-            print(f"--- [Auto] {step_name} jobs finished in queue. ---")
-            break
-        
-        elapsed = (time.time() - start_time) / 60 
-        sys.stdout.write(f"\r    ... Still waiting ({elapsed:.1f} min elapsed) ...")
-        sys.stdout.flush()
-        time.sleep(check_interval)
-    print("")
+def next_interval(interval, progressed, min_interval, max_interval, remaining, total):
+    # Back off while nothing changes, poll fast again as soon as work starts finishing
+    interval = min_interval if progressed else min(interval * BACKOFF_FACTOR, max_interval)
+    return max(min_interval, min(interval, max_interval * remaining / max(total, 1)))
+
+_log_scanner = readiness.LogScanner()
 
 def check_log_completion(folder, specific_log_name, pattern_log_name, success_key, failure_key=None):
-    if specific_log_name:
-        specific_path = os.path.join(folder, specific_log_name)
-        if os.path.exists(specific_path):
-            try:
-                with open(specific_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
-                    if success_key in content:
-                        return True
-                    if failure_key and failure_key in content:
-                        raise RuntimeError(f"Job failed in {folder}. Check log: {specific_log_name}")
-            except RuntimeError:
-                raise
-            except Exception:
-                pass
-            return False
-
-    files = glob.glob(os.path.join(folder, pattern_log_name))
-    if not files:
+    log_path = _log_scanner.current_log(folder, specific_log_name, pattern_log_name)
+    if log_path is None:
         return False
-        
-    latest_log = max(files, key=os.path.getmtime)
+
+    markers = [success_key] + ([failure_key] if failure_key else [])
+    found = _log_scanner.scan(log_path, markers)
+    if success_key in found:
+        return True
+    if failure_key in found:
+        raise RuntimeError(f"Job failed in {folder}. Check log: {os.path.basename(log_path)}")
+    return False
+
+def missing_dft_outputs(folder, config, use_symmetry):
+    if use_symmetry:
+        deduplicator.expand_symmetric_outputs([config], verbose=False)
+    return disp_archive.missing_outputs(folder)
+
+def fc3_valid(folder):
+    fpath = os.path.join(folder, "FORCE_CONSTANTS_3RD")
+    return os.path.exists(fpath) and os.path.getsize(fpath) >= 100
+
+def bte_result_valid(task_path, target):
+    fpath = os.path.join(task_path, target)
+    return os.path.exists(fpath) and os.path.getsize(fpath) >= 10
+
+def artifact_ready(path, min_size, tracker, finished_at):
+    """True once the file is complete and quiescent, False if it never shows up, else None."""
+    if os.path.exists(path) and os.path.getsize(path) >= min_size:
+        return True if tracker.stable(path) else None
+    if time.time() - finished_at > readiness.VISIBILITY_TIMEOUT:
+        return False
+    return None
+
+def log_verdict(folder, specific_log_name, success_key, failure_key, job_state, finished_at, tracker):
+    """True on success, False on failure, None while the log may still be syncing."""
+    try:
+        if check_log_completion(folder, specific_log_name, "slurm-*.out", success_key, failure_key):
+            return True
+    except RuntimeError as e:
+        print(f"    [Error] {e}")
+        return False
+    if job_state not in (executor.COMPLETED, executor.UNKNOWN):
+        return False
+
+    log_path = _log_scanner.current_log(folder, specific_log_name, "slurm-*.out")
+    if log_path is None:
+        return False if time.time() - finished_at > readiness.VISIBILITY_TIMEOUT else None
+    if tracker.stable(log_path):
+        print(f"    [Error] No '{success_key}' in {log_path} after the job ended.")
+        return False
+    return None
+
+def finished_ok(folder, log_name, success_key, failure_key):
     try:
-        with open(latest_log, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-            if success_key in content:
-                return True
-            if failure_key and failure_key in content:
-                raise RuntimeError(f"Job failed in {folder}. Check log: {os.path.basename(latest_log)}")
+        return check_log_completion(folder, log_name, "slurm-*.out", success_key, failure_key)
     except RuntimeError:
-        raise
-    except Exception:
-        pass
-        
-    return False
+        return False
 
-def ensure_dft_files_ready(configs, check_interval=60):
-    print("--- [Auto] Verifying DFT output file availability (I/O Sync Check) ---")
-    
-    while True:
-        all_ready = True
-        waiting_list = []
-
-        for config in configs:
-            na, nb, nc, cut = config
-            folder_name = f"thirdorder_{na}{nb}{nc}_{cut}"
-            
-            if not os.path.exists(folder_name):
-                continue
+def resume_stage(state, folder, task_path, target, jobs_lost):
+    """Pick the stage to restart a config from, trusting only artifacts that still verify."""
+    saved = state.folder(folder)
+    last = saved.get('stage', 'dft')
+    fc3_path = os.path.join(folder, "FORCE_CONSTANTS_3RD")
+    if last in ('collect', 'done') and state.artifact_valid(folder, os.path.join(task_path, target)):
+        return last, None
+    if last == 'bte' and saved.get('job'):
+        if not jobs_lost:
+            return last, saved['job']
+        if finished_ok(task_path, "shengbte.out", "Job Done", "Job Failed") \
+                and bte_result_valid(task_path, target):
+            return 'collect', None
+    if last != 'dft' and state.artifact_valid(folder, fc3_path):
+        return 'fc3', None
+    if last == 'reap' and saved.get('job'):
+        if not jobs_lost and not executor.in_process(saved['job']):
+            return last, saved['job']
+        if finished_ok(folder, "reap.out", "Success", "Error: Generation failed") and fc3_valid(folder):
+            return 'fc3', None
+    return 'dft', None
 
-            inputs = glob.glob(os.path.join(folder_name, "DISP.*"))
-            valid_inputs = [f for f in inputs if not f.endswith(('.out', '.in', '.save', '.xml', '.run'))]
-            expected_count = len(valid_inputs)
+def run_pipeline(cfg, configs, use_symmetry, warm_start, sub_gen_script, submit_cfg, collect_cfg,
+                 watch_cfg=None, state=None, check_interval=300):
+    """Drive every config through DFT -> FC3 reap -> ShengBTE independently."""
+    backend = executor.get_executor()
+    bte_work_dir = submit_cfg.get('WORK_DIR', 'ShengBTE')
+    target = submit_cfg.get('TARGET_RESULT', 'BTE.KappaTensorVsT_CONV')
+    state = state or workflow_state.WorkflowState(configs)
 
-            if expected_count == 0:
-                continue
+    def task_dir(folder):
+        return os.path.join(bte_work_dir, folder.replace("thirdorder_", "task_", 1))
 
-            outputs = glob.glob(os.path.join(folder_name, "DISP.*.out"))
-            actual_count = len(outputs)
+    folders = {}
+    for config in configs:
+        na, nb, nc, cut = config
+        folders[f"thirdorder_{na}{nb}{nc}_{cut}"] = config
+    stage = {folder: 'dft' for folder in folders}
+    derive_from = fc3_builder.derive_sources(cfg, configs)
+    jobs = {}
+    artifacts = {folder: {} for folder in folders}
+    finished_at = {}
+    failures = {}
+    dft_ids = [entry['id'] for entry in executor.registry().jobs(qe_runner.STAGE)]
+    dft_cfg = (cfg.config if hasattr(cfg, 'config') else cfg).get('dft', {})
+    retry_limit = int(dft_cfg.get('RETRY_LIMIT', dft_validator.DEFAULT_RETRY_LIMIT))
 
-            if actual_count < expected_count:
-                all_ready = False
-                waiting_list.append(f"{folder_name} ({actual_count}/{expected_count})")
-        
-        if all_ready:
-            print("--- [Auto] All DFT output files are verified on disk. Proceeding. ---")
-            break
-        else:
-            print(f"    ... Waiting for filesystem sync: {', '.join(waiting_list[:3])} ...")
-            time.sleep(check_interval)
+    resumed = state.reached(workflow_state.PHASE_PIPELINE)
+    if resumed:
+        # Local jobs die with the controller; Slurm jobs keep running and are re-attached
+        jobs_lost = state.backend != backend.name or backend.name == 'local'
+        for folder in folders:
+            stage[folder], job_id = resume_stage(state, folder, task_dir(folder), target, jobs_lost)
+            if job_id:
+                jobs[folder] = job_id
+            if stage[folder] != 'dft':
+                artifacts[folder] = state.folder(folder).get('artifacts', {})
+            # A job that finished while nobody was watching is verified by its log and output
+            path = {'fc3': os.path.join(folder, "FORCE_CONSTANTS_3RD"),
+                    'collect': os.path.join(task_dir(folder), target)}.get(stage[folder])
+            if path and path not in artifacts[folder]:
+                artifacts[folder][path] = workflow_state.file_signature(path)
+        counts = {}
+        for f in folders:
+            counts[stage[f]] = counts.get(stage[f], 0) + 1
+        print(f"--- [Auto] Resumed from {workflow_state.STATE_FILE}: "
+              f"{', '.join(f'{k}: {v}' for k, v in sorted(counts.items()))} ---")
+    else:
+        executor.registry().begin_stage(fc3_builder.STAGE)
+        executor.registry().begin_stage(bte_runner.STAGE)
+        state.set_phase(workflow_state.PHASE_PIPELINE, backend.name)
+
+    def verified(folder, path):
+        artifacts[folder][path] = workflow_state.file_signature(path)
+
+    def untrusted(candidates, name_of):
+        # After a resume, files nobody verified may be leftovers of a killed job
+        if not resumed:
+            return []
+        return [f for f in candidates if name_of(f) not in artifacts[f]]
+
+    def persist():
+        state.update_folders({
+            folder: {
+                'stage': stage[folder],
+                'job': jobs.get(folder) if stage[folder] in ('reap', 'bte') else None,
+                'reason': failures.get(folder),
+                'artifacts': artifacts[folder],
+            } for folder in folders})
+
+    watch_cfg = watch_cfg or {}
+    tracker = readiness.StabilityTracker(float(watch_cfg.get('QUIET_PERIOD', readiness.QUIET_PERIOD)))
+    watcher = readiness.FileWatcher(mode=watch_cfg.get('WATCH_MODE', 'auto'))
+    watcher.watch(qe_runner.QUEUE_STATE_FILES[1])
+    for folder in folders:
+        for name in ("", qe_runner.QUEUE_STATE_FILES[1], disp_archive.OUTPUT_STORE, "reap.out"):
+            watcher.watch(os.path.join(folder, name) if name else folder)
+
+    def fail(folder, reason):
+        stage[folder] = 'failed'
+        failures[folder] = reason
+        print(f"    [Failed] {folder}: {reason}")
+
+    min_interval = backend.poll_interval(MIN_POLL_INTERVAL)
+    max_interval = backend.poll_interval(check_interval)
+    interval = min_interval
+    start_time = time.time()
+    print(f"--- [Auto] Pipelining {len(folders)} config(s): DFT -> FC3 -> ShengBTE "
+          f"(file watch: {watcher.backend}) ---")
 
-def ensure_fc3_finished(configs, check_interval=30):
-    print("--- [Auto] Verifying FC3 Generation logs (Keyword: 'Success') ---")
-    
     while True:
-        all_done = True
-        pending_list = []
-        
-        for config in configs:
-            na, nb, nc, cut = config
-            folder_name = f"thirdorder_{na}{nb}{nc}_{cut}"
-            
-            try:
-                is_done = check_log_completion(folder_name, "reap.out", "slurm-*.out", "Success", "Error: Generation failed")
-                if not is_done:
-                    all_done = False
-                    pending_list.append(folder_name)
-            except RuntimeError as e:
-                print(f"\n[CRITICAL ERROR] {e}")
-                sys.exit(1)
-
-        if all_done:
-            print("--- [Auto] All FC3 jobs confirmed success. ---")
-            print("    ... Buffering 30s for safety ...")
-            time.sleep(30)
+        progressed = False
+        awaiting = False
+        active = [f for f in folders if stage[f] not in ('done', 'failed')]
+        if not active:
             break
-        else:
-            print(f"    ... Waiting for logs to update: {', '.join(pending_list[:3])} ...")
-            time.sleep(check_interval)
 
-def ensure_shengbte_finished(configs, work_dir, check_interval=30):
-    print("--- [Auto] Verifying ShengBTE logs (Keyword: 'Job Done') ---")
-    
-    while True:
-        all_done = True
-        pending_list = []
-        
-        for config in configs:
-            na, nb, nc, cut = config
-            folder_name = f"task_{na}{nb}{nc}_{cut}"
-            task_path = os.path.join(work_dir, folder_name)
-            
-            if not os.path.exists(task_path): 
+        # DFT -> reap: as soon as every unique, linked and synthesized output of a config exists
+        waiting_dft = [f for f in active if stage[f] == 'dft']
+        if waiting_dft:
+            dft_states = backend.job_states(dft_ids)
+            # Repair only once every DFT job has provably ended, never on a failed or empty query
+            dft_ended = all(executor.has_ended(job_id, state) for job_id, state in dft_states.items())
+            ready = []
+            broken = []
+            for folder in waiting_dft:
+                if not os.path.exists(folder):
+                    fail(folder, "folder not generated")
+                    continue
+                missing = missing_dft_outputs(folder, folders[folder], use_symmetry)
+                if not missing:
+                    # JOB DONE alone is not enough: a usable output also has its force block
+                    missing = dft_validator.unusable(folder)
+                if not missing:
+                    ready.append(folder)
+                elif dft_ended:
+                    broken.append(folder)
+
+            if broken:
+                queue, exhausted, counts = dft_validator.prepare_retries(broken, retry_limit)
+                print(f"\n    [DFT Check] {', '.join(broken)}: {dft_validator.report(counts)}")
+                new_ids = qe_runner.resubmit_failed(dft_cfg, queue) if queue else []
+                if new_ids:
+                    progressed = True
+                    dft_ids.extend(new_ids)
+                else:
+                    # Nothing left to retry anywhere: these folders cannot complete
+                    for folder in broken:
+                        if exhausted.get(folder):
+                            fail(folder, f"{len(exhausted[folder])} DFT job(s) still failing after "
+                                         f"{retry_limit} retries ({dft_validator.FAILED_DIR}/)")
+                        else:
+                            fail(folder, f"DFT outputs unusable after all DFT jobs ended "
+                                         f"({dft_validator.report(counts)})")
+
+            if ready:
+                progressed = True
+                print(f"\n    [DFT Done] {', '.join(ready)}")
+                redo = untrusted(ready, lambda f: os.path.join(f, "FORCE_CONSTANTS_3RD"))
+                submitted = fc3_builder.run_reaping(cfg, sub_gen_script, ready, redo, configs)
+                for folder in ready:
+                    if folder in submitted:
+                        stage[folder], jobs[folder] = 'reap', submitted[folder]
+                    elif fc3_valid(folder):
+                        stage[folder] = 'fc3'
+                        verified(folder, os.path.join(folder, "FORCE_CONSTANTS_3RD"))
+                    elif folder in derive_from:
+                        stage[folder] = 'derive'
+                    else:
+                        fail(folder, "FC3 reap submission failed")
+                persist()
+
+            if warm_start and not any(stage[f] == 'dft' for f in folders):
+                qe_runner.cleanup_references()
+
+        # derive: smaller cutoffs are filtered from the reap of the largest one, once verified
+        waiting = [f for f in folders if stage[f] == 'derive']
+        source_ready = [f for f in waiting if stage[derive_from[f]] in ('fc3', 'bte', 'collect', 'done')]
+        orphaned = [f for f in waiting if stage[derive_from[f]] == 'failed']
+        for batch, derive in ((source_ready, True), (orphaned, False)):
+            if not batch:
                 continue
-                
-            try:
-                is_done = check_log_completion(task_path, "shengbte.out", "slurm-*.out", "Job Done", "Job Failed")
-                if not is_done:
-                    all_done = False
-                    pending_list.append(folder_name)
-            except RuntimeError as e:
-                print(f"\n[CRITICAL ERROR] {e}")
-                sys.exit(1)
-
-        if all_done:
-            print("--- [Auto] All ShengBTE jobs confirmed success. ---")
-            print("    ... Buffering 30s for safety ...")
-            time.sleep(30)
-            break
-        else:
-            print(f"    ... Waiting for logs to update: {', '.join(pending_list[:3])} ...")
-            time.sleep(check_interval)
+            progressed = True
+            if not derive:
+                print(f"\n    [Derive] Source reap failed; reaping {', '.join(batch)} on their own.")
+            redo = untrusted(batch, lambda f: os.path.join(f, "FORCE_CONSTANTS_3RD"))
+            submitted = fc3_builder.run_reaping(cfg, sub_gen_script, batch, redo, configs, derive)
+            for folder in batch:
+                if folder in submitted:
+                    stage[folder], jobs[folder] = 'reap', submitted[folder]
+                else:
+                    fail(folder, "FC3 derivation could not be submitted")
 
-def verify_fc3_success(configs):
-    print("--- [Auto] Verifying FORCE_CONSTANTS_3RD integrity... ---")
-    failed = []
-    for config in configs:
-        na, nb, nc, cut = config
-        folder_name = f"thirdorder_{na}{nb}{nc}_{cut}"
-        fpath = os.path.join(folder_name, "FORCE_CONSTANTS_3RD")
-        
-        if not os.path.exists(fpath) or os.path.getsize(fpath) < 100:
-            failed.append(folder_name)
-            
-    if failed:
-        print("\n[CRITICAL ERROR] FC3 generation failed for the following folders:")
-        for f in failed: print(f"  - {f}")
-        print("Please check the error logs inside these folders.")
-        sys.exit(1)
-    print("--- [Auto] Verification Passed. ---")
+        # reap -> verified FORCE_CONSTANTS_3RD
+        reaping = [f for f in folders if stage[f] == 'reap']
+        states = executor.job_states([jobs[f] for f in reaping]) if reaping else {}
+        for folder in reaping:
+            if executor.still_active(jobs[folder], states.get(jobs[folder])):
+                continue
+            finished_at.setdefault(folder, time.time())
+            verdict = log_verdict(folder, "reap.out", "Success", "Error: Generation failed",
+                                  states.get(jobs[folder]), finished_at[folder], tracker)
+            if verdict:
+                verdict = artifact_ready(os.path.join(folder, "FORCE_CONSTANTS_3RD"), 100,
+                                         tracker, finished_at[folder])
+            if verdict is None:
+                awaiting = True
+                continue
+            progressed = True
+            finished_at.pop(folder)
+            if verdict:
+                stage[folder] = 'fc3'
+                verified(folder, os.path.join(folder, "FORCE_CONSTANTS_3RD"))
+            else:
+                fail(folder, f"FC3 reap job {jobs[folder]} ended {states.get(jobs[folder])}")
 
-def verify_shengbte_success(configs, work_dir="ShengBTE"):
-    print("--- [Auto] Verifying ShengBTE results... ---")
-    failed = []
-    target = "BTE.KappaTensorVsT_CONV"
-    for config in configs:
-        na, nb, nc, cut = config
-        folder_name = f"task_{na}{nb}{nc}_{cut}"
-        fpath = os.path.join(work_dir, folder_name, target)
-        
-        if not os.path.exists(fpath) or os.path.getsize(fpath) < 10:
-            failed.append(folder_name)
-
-    if failed:
-        print(f"\n[CRITICAL ERROR] Missing {target} for:")
-        for f in failed: print(f"  - {f}")
-        sys.exit(1)
-    print("--- [Auto] Verification Passed. ---")
+        # verified FC3 -> ShengBTE
+        fc3_ready = [f for f in folders if stage[f] == 'fc3']
+        if fc3_ready:
+            progressed = True
+            print(f"\n    [FC3 Verified] {', '.join(fc3_ready)}")
+            redo = untrusted(fc3_ready, lambda f: os.path.join(task_dir(f), target))
+            fc3_files = fc3_pruner.run_pruning(cfg, fc3_ready)
+            submitted = bte_runner.submit_jobs(submit_cfg, fc3_ready, redo, fc3_files)
+            for folder in fc3_ready:
+                task_path = task_dir(folder)
+                if folder in submitted:
+                    stage[folder], jobs[folder] = 'bte', submitted[folder]
+                elif bte_result_valid(task_path, target):
+                    stage[folder] = 'collect'
+                    verified(folder, os.path.join(task_path, target))
+                else:
+                    fail(folder, "ShengBTE submission failed")
+            persist()
 
-def run_automation(cfg):
-    print("==================================================")
-    print("      AUTO-THIRDORDER ONE-CLICK WORKFLOW          ")
-    print("==================================================")
-    
-    def get_cfg_dict(c): return c.config if hasattr(c, 'config') else c
-    cfg_dict = get_cfg_dict(cfg)
+        # ShengBTE -> verified kappa
+        running_bte = [f for f in folders if stage[f] == 'bte']
+        states = backend.job_states([jobs[f] for f in running_bte]) if running_bte else {}
+        bte_ids = [jobs[f] for f in running_bte]
+        for folder in running_bte:
+            task_path = task_dir(folder)
+            watcher.watch(task_path)
+            watcher.watch(os.path.join(task_path, "shengbte.out"))
+            # Packed members share the pack's job ID: a member whose log already ended need not wait
+            member_ended = False
+            if bte_ids.count(jobs[folder]) > 1:
+                try:
+                    member_ended = check_log_completion(task_path, "shengbte.out", "slurm-*.out",
+                                                        "Job Done", "Job Failed")
+                except RuntimeError:
+                    member_ended = True
+            if not member_ended and executor.still_active(jobs[folder], states.get(jobs[folder])):
+                continue
+            finished_at.setdefault(folder, time.time())
+            verdict = log_verdict(task_path, "shengbte.out", "Job Done", "Job Failed",
+                                  states.get(jobs[folder]), finished_at[folder], tracker)
+            if verdict:
+                verdict = artifact_ready(os.path.join(task_path, target), 10,
+                                         tracker, finished_at[folder])
+            if verdict is None:
+                awaiting = True
+                continue
+            progressed = True
+            finished_at.pop(folder)
+            if verdict:
+                stage[folder] = 'collect'
+                verified(folder, os.path.join(task_path, target))
+            else:
+                fail(folder, f"ShengBTE job {jobs[folder]} ended {states.get(jobs[folder])}")
 
-    print("\n>>> Phase 1: Generation & Deduplication")
-    configs = cfg.get('cell', 'configs')
+        # Incremental collection and plotting as results arrive
+        collected = [f for f in folders if stage[f] == 'collect']
+        if collected:
+            print(f"\n    [Kappa Ready] {', '.join(collected)}")
+            for folder in collected:
+                stage[folder] = 'done'
+            collector.run_collection(collect_cfg)
+            plotter.plot_convergence(collect_cfg)
+
+        persist()
+        remaining = sum(1 for f in folders if stage[f] not in ('done', 'failed'))
+        if remaining == 0:
+            break
+        interval = next_interval(interval, progressed, min_interval, max_interval,
+                                 remaining, len(folders))
+        if awaiting:
+            # Files still settling: come back once they could have been quiet long enough
+            interval = min(interval, max(tracker.quiet_period, 1.0))
+        counts = {}
+        for f in folders:
+            counts[stage[f]] = counts.get(stage[f], 0) + 1
+        elapsed = (time.time() - start_time) / 60
+        sys.stdout.write(f"\r    ... {', '.join(f'{k}: {v}' for k, v in sorted(counts.items()))} "
+                         f"({elapsed:.1f} min elapsed, next check within {interval:.0f}s) ...")
+        sys.stdout.flush()
+        watcher.wait(interval)
+
+    watcher.close()
+    persist()
+    if not failures:
+        state.set_phase(workflow_state.PHASE_COMPLETE)
+    print("")
+    return failures
+
+def run_configs(cfg, configs, link_configs=None):
+    """Phases 1-5 for one set of configs; returns {folder: reason} for those that failed."""
+    cfg_dict = cfg.config if hasattr(cfg, 'config') else cfg
+    link_configs = link_configs or configs
     base_in = cfg.get('cell', 'base_input')
     tpl_name = cfg.get('cell', 'template_supercell_name')
     thirdorder_bin = cfg.get('cell', 'THIRDORDER_BIN', 'thirdorder_espresso.py')
-    
-    generator.run_generation(configs, base_in, tpl_name, thirdorder_bin)
-    deduplicator.run_linking(configs)
+    use_symmetry = cfg.get('cell', 'DEDUP_MODE', 'link') == 'symmetry'
+    backend = executor.get_executor()
+
+    state = workflow_state.WorkflowState(configs)
+    if state.reached(workflow_state.PHASE_GENERATED):
+        print(f"\n>>> Resuming '{state.phase}' workflow from {workflow_state.STATE_FILE} "
+              f"(delete it to start over)")
+
+    print("\n>>> Phase 1: Generation & Deduplication")
+    if state.reached(workflow_state.PHASE_GENERATED):
+        print("  [Skip] Generation and deduplication already recorded.")
+    else:
+        generator.run_generation(configs, base_in, tpl_name, thirdorder_bin, cfg.get('cell', 'GEN_WORKERS'),
+                                 cfg.get('cell', 'DISP_LAYOUT', 'classic'))
+        # Earlier configs (adaptive rounds) take part so their finished outputs become link masters
+        deduplicator.run_linking(link_configs, cfg.get('cell', 'DEDUP_TOLERANCE'),
+                                 cfg.get('cell', 'DEDUP_WORKERS'))
+        if use_symmetry:
+            deduplicator.run_symmetry_reduction(configs, cfg.get('cell', 'SYMPREC'))
 
-    analyze_conf = cfg_dict.get('analyze', {}).copy()
-    if 'COST_ESTIMATES' in cfg_dict:
-        analyze_conf['COST_ESTIMATES'] = cfg_dict['COST_ESTIMATES']
-    analyzer.run_analysis(analyze_conf)
+        analyze_conf = cfg_dict.get('analyze', {}).copy()
+        if 'COST_ESTIMATES' in cfg_dict:
+            analyze_conf['COST_ESTIMATES'] = cfg_dict['COST_ESTIMATES']
+        analyzer.run_analysis(analyze_conf)
+        state.set_phase(workflow_state.PHASE_GENERATED)
     
     print("\n>>> Phase 2: DFT Submission")
     dft_cfg = cfg_dict.get('dft', {})
-    if dft_cfg:
-        raw_script = dft_cfg.get('SUB_SCRIPT', 'templates/sub_calc.sh')
-        dft_cfg['SUB_SCRIPT'] = resolve_path(raw_script)
-        qe_runner.submit_dft_jobs(dft_cfg)
-    else:
+    if not dft_cfg:
         print("Error: No &dft section.")
-        return
-
-    wait_for_jobs("DFT Calculation", "scf_array", check_interval=300)
-
-    ensure_dft_files_ready(configs)
+        return None
+    raw_script = dft_cfg.get('SUB_SCRIPT', 'templates/sub_calc.sh')
+    dft_cfg['SUB_SCRIPT'] = resolve_path(raw_script)
+    if state.reached(workflow_state.PHASE_DFT_SUBMITTED) and state.backend == 'slurm' == backend.name:
+        print("  [Skip] DFT jobs already submitted; tracking the recorded job IDs.")
+    else:
+        # Unfinished local jobs died with the previous controller: only missing outputs are queued
+        qe_runner.submit_dft_jobs(dft_cfg)
+        if not state.reached(workflow_state.PHASE_DFT_SUBMITTED):
+            state.set_phase(workflow_state.PHASE_DFT_SUBMITTED, backend.name)
 
-    print("\n>>> Phase 3: FC3 Generation")
-    
     raw_script = cfg.get('cell', 'SUB_GEN_SCRIPT', 'templates/sub_gen.sh')
     sub_gen_script = resolve_path(raw_script)
 
-    fc3_builder.run_reaping(cfg, sub_gen_script)
-    
-    wait_for_jobs("FC3 Generation", "Gen_FC3", check_interval=120)
-    
-    ensure_fc3_finished(configs)
-    
-    verify_fc3_success(configs)
-
-    print("\n>>> Phase 4: ShengBTE Calculation")
     submit_cfg = cfg_dict.get('submit', {})
-    if submit_cfg:
-        raw_script = submit_cfg.get('SUB_SCRIPT', 'templates/sub_sheng.sh')
-        submit_cfg['SUB_SCRIPT'] = resolve_path(raw_script)
-        bte_runner.submit_jobs(submit_cfg)
-    
-    wait_for_jobs("ShengBTE", "shengBTE", check_interval=120)
-    
-    bte_work_dir = cfg.get('submit', 'WORK_DIR', 'ShengBTE')
-    
-    ensure_shengbte_finished(configs, bte_work_dir)
-    
-    verify_shengbte_success(configs, work_dir=bte_work_dir)
+    raw_script = submit_cfg.get('SUB_SCRIPT', 'templates/sub_sheng.sh')
+    submit_cfg['SUB_SCRIPT'] = resolve_path(raw_script)
 
-    print("\n>>> Phase 5: Collection & Plotting")
+    print("\n>>> Phase 3-5: Pipelined FC3 Generation, ShengBTE and Collection (per config)")
+    return run_pipeline(cfg, configs, use_symmetry, dft_cfg.get('WARM_START', False),
+                        sub_gen_script, submit_cfg, collect_settings(cfg), cfg_dict.get('executor', {}),
+                        state)
+
+def collect_settings(cfg):
+    cfg_dict = cfg.config if hasattr(cfg, 'config') else cfg
     collect_cfg = cfg_dict.get('collect', {})
     if 'ROOT_DIR' not in collect_cfg: collect_cfg['ROOT_DIR'] = cfg.get('submit', 'ROOT_DIR', '.')
-    if 'WORK_DIR' not in collect_cfg: collect_cfg['WORK_DIR'] = bte_work_dir
+    if 'WORK_DIR' not in collect_cfg: collect_cfg['WORK_DIR'] = cfg.get('submit', 'WORK_DIR', 'ShengBTE')
+    return collect_cfg
+
+def run_adaptive(cfg, adaptive_cfg):
+    """Evaluate candidate configs round by round until kappa agrees within the tolerance."""
+    supercells = [tuple(sc) for sc in adaptive_cfg.get('SUPERCELLS', [])]
+    cutoffs = [int(c) for c in adaptive_cfg.get('CUTOFFS', [])]
+    if not supercells or not cutoffs:
+        print("Error: &adaptive needs SUPERCELLS and CUTOFFS.")
+        return None
+    tolerance = float(adaptive_cfg.get('TOLERANCE', adaptive.DEFAULT_TOLERANCE))
+    lookahead = int(adaptive_cfg.get('LOOKAHEAD', 0))
+    collect_cfg = collect_settings(cfg)
+    candidates = [sc + (cut,) for sc in supercells for cut in cutoffs]
+
+    saved = adaptive.load_round(candidates)
+    round_no, resume, failed = saved if saved else (0, [], set())
+    while True:
+        summary = adaptive.load_summary(collect_cfg)
+        if resume:
+            todo, resume = resume, []
+            print(f"  [Resume] Finishing adaptive round {round_no} from '{adaptive.ROUND_FILE}'.")
+        else:
+            todo, result = adaptive.plan_next(summary, supercells, cutoffs, tolerance, lookahead, failed)
+            if not todo:
+                break
+            round_no += 1
+            adaptive.save_round(round_no, todo, failed)
+        names = ", ".join(f"{adaptive.grid_label(c[:3])}/{c[3]}" for c in todo)
+        print(f"\n##### [Adaptive] Round {round_no}: evaluating {names} "
+              f"(tolerance {tolerance * 100:.1f}%) #####")
+        earlier = [c for c in candidates if c not in todo
+                   and os.path.exists(f"thirdorder_{c[0]}{c[1]}{c[2]}_{c[3]}")]
+        round_failures = run_configs(cfg, [list(c) for c in todo], [list(c) for c in earlier + todo])
+        if round_failures is None:
+            return None
+        for folder, reason in sorted(round_failures.items()):
+            print(f"  [Warning] {folder} is dropped from the search: {reason}")
+        for config in todo:
+            if f"thirdorder_{config[0]}{config[1]}{config[2]}_{config[3]}" in round_failures:
+                failed.add(config)
+        # A config that finished without a collected kappa would be planned again forever
+        summary = adaptive.load_summary(collect_cfg)
+        for config in todo:
+            if config not in failed and adaptive.kappa_values(summary, config[:3], config[3]) is None:
+                print(f"  [Warning] thirdorder_{config[0]}{config[1]}{config[2]}_{config[3]} is dropped "
+                      f"from the search: no kappa in the collected summary")
+                failed.add(config)
+        adaptive.save_round(round_no, [], failed)
+
+    if os.path.exists(adaptive.ROUND_FILE):
+        os.remove(adaptive.ROUND_FILE)
+    print("\n>>> Adaptive convergence summary")
+    adaptive.report(summary, supercells, cutoffs, tolerance, failed)
+    if result:
+        print(f"  [Converged] {adaptive.grid_label(result[:3])} supercell with cutoff {result[3]}")
+    else:
+        print("  [Warning] No configuration could be evaluated.")
+    skipped = [c for c in candidates if adaptive.kappa_values(summary, c[:3], c[3]) is None]
+    print(f"  Candidates never run: {len(skipped)} of {len(candidates)}")
+    return result
+
+def run_automation(cfg):
+    print("==================================================")
+    print("      AUTO-THIRDORDER ONE-CLICK WORKFLOW          ")
+    print("==================================================")
     
-    collector.run_collection(collect_cfg)
-    plotter.plot_convergence(collect_cfg)
+    def get_cfg_dict(c): return c.config if hasattr(c, 'config') else c
+    cfg_dict = get_cfg_dict(cfg)
+    executor.configure(cfg_dict.get('executor', {}))
+
+    adaptive_cfg = cfg_dict.get('adaptive', {})
+    if adaptive_cfg.get('ENABLED', False):
+        if run_adaptive(cfg, adaptive_cfg) is None:
+            sys.exit(1)
+        failures = {}
+    else:
+        failures = run_configs(cfg, cfg.get('cell', 'configs'))
+        if failures is None:
+            return
+
+    if failures:
+        print("\n[CRITICAL ERROR] The following configs did not finish:")
+        for folder, reason in sorted(failures.items()):
+            print(f"  - {folder}: {reason}")
+        print("Results of the other configs are in the collected summary and plots.")
+        sys.exit(1)
 
     print("\n==================================================")
     print("          ALL TASKS COMPLETED SUCCESSFULLY        ")
-    print("==================================================")
\ No newline at end of file
+    print("==================================================")
@@ -1,36 +1,203 @@
 import os
 import glob
 import re
+import json
+import math
 import shutil
-import subprocess
 import sys
+from src import executor
+from src import fc3_store
 
-def submit_jobs(config):
+STAGE = "bte"
+REUSE_FILE = "fc3_reused.json"
+PACK_DIR = "packs"
+PACK_SCRIPT = "sub_pack.sh"
+PACK_LOG = "pack.out"
+
+def find_reusable(src_folder, work_dir, target_result, tolerance):
+    """Task of another config (same supercell or same cutoff) whose FC3 is within `tolerance`.
+
+    Returns (task_dir, relative FC3 change) of the closest one with a ShengBTE result of its
+    own, or (None, None).
+    """
+    match = re.match(r"thirdorder_(\d+)_(-?\d+)$", os.path.basename(src_folder))
+    root = os.path.dirname(src_folder)
+    candidates = (set(glob.glob(os.path.join(root, f"thirdorder_{match.group(1)}_*")))
+                  | set(glob.glob(os.path.join(root, f"thirdorder_*_{match.group(2)}"))))
+    candidates.discard(src_folder)
+    try:
+        blocks = fc3_store.load(os.path.join(src_folder, "FORCE_CONSTANTS_3RD"))
+    except (IOError, OSError, ValueError):
+        return None, None
+
+    best = (None, None)
+    for other in sorted(candidates):
+        task_dir = os.path.join(work_dir, os.path.basename(other).replace("thirdorder_", "task_", 1))
+        result_path = os.path.join(task_dir, target_result)
+        fc3_path = os.path.join(other, "FORCE_CONSTANTS_3RD")
+        if (not os.path.exists(result_path) or os.path.getsize(result_path) == 0
+                or os.path.exists(os.path.join(task_dir, REUSE_FILE)) or not os.path.exists(fc3_path)):
+            continue
+        try:
+            change = fc3_store.compare(fc3_store.load(fc3_path), blocks)['relative']
+        except (IOError, OSError, ValueError):
+            continue
+        if change <= tolerance and (best[1] is None or change < best[1]):
+            best = (task_dir, change)
+    return best
+
+def prepare_task(task_dir, control_file, ifc2_file, fc3_path, sub_script_tpl):
+    """Populate a ShengBTE task directory; returns the name of its submission script."""
+    os.makedirs(task_dir, exist_ok=True)
+    shutil.copy(os.path.abspath(control_file), os.path.join(task_dir, "CONTROL"))
+
+    dest_ifc2 = os.path.join(task_dir, "espresso.ifc2")
+    if not os.path.exists(dest_ifc2):
+        os.symlink(os.path.abspath(ifc2_file), dest_ifc2)
+
+    dest_fc3 = os.path.join(task_dir, "FORCE_CONSTANTS_3RD")
+    if os.path.exists(dest_fc3) or os.path.islink(dest_fc3):
+        os.remove(dest_fc3)
+    os.symlink(os.path.abspath(fc3_path), dest_fc3)
+
+    dest_script_name = os.path.basename(sub_script_tpl)
+    shutil.copy(os.path.abspath(sub_script_tpl), os.path.join(task_dir, dest_script_name))
+    return dest_script_name
+
+def task_cost(task_dir):
+    """Relative ShengBTE cost of a task: the number of blocks in its FORCE_CONSTANTS_3RD."""
+    try:
+        with open(os.path.join(task_dir, "FORCE_CONSTANTS_3RD"), 'r') as f:
+            return max(1, int(f.readline().split()[0]))
+    except (IOError, OSError, ValueError, IndexError):
+        return 1
+
+def plan_packs(costs, per_pack, cores):
+    """Group tasks into allocations and split the cores of each one by cost.
+
+    Tasks are placed longest first on the least loaded allocation that has room (at most
+    `per_pack` each). Returns [[(task index, cores)]], every task getting at least one core.
+    """
+    per_pack = max(1, min(per_pack, cores))
+    npacks = math.ceil(len(costs) / per_pack)
+    loads = [0] * npacks
+    packs = [[] for _ in range(npacks)]
+    for index in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        target = min((p for p in range(npacks) if len(packs[p]) < per_pack), key=loads.__getitem__)
+        packs[target].append(index)
+        loads[target] += costs[index]
+
+    plans = []
+    for members, load in zip(packs, loads):
+        spare = cores - len(members)
+        raw = [spare * costs[i] / load for i in members]
+        shares = [1 + int(r) for r in raw]
+        # Largest remainders take the cores lost to rounding down
+        for k in sorted(range(len(members)), key=lambda k: int(raw[k]) - raw[k])[:cores - sum(shares)]:
+            shares[k] += 1
+        plans.append(list(zip(members, shares)))
+    return plans
+
+def write_pack_script(pack_dir, sub_script_tpl, job_name, entries, cores):
+    """Allocation script that runs each (task_dir, script, cores) entry concurrently.
+
+    Every task runs its own copy of the ShengBTE script with AUTO3RD_NPROC set to its share
+    and writes shengbte.out in its directory, exactly like a job of its own.
+    """
+    with open(sub_script_tpl, 'r') as f:
+        directives = [line.rstrip("\n") for line in f if line.startswith("#SBATCH")
+                      and executor.DIRECTIVE_ALIASES.get(line.split()[1].split('=')[0])
+                      not in ('job-name', 'output')]
+    lines = ["#!/bin/bash"] + directives + [
+        f"#SBATCH -J {job_name}",
+        f"#SBATCH -o {PACK_LOG}",
+        "",
+        f"# {len(entries)} packed ShengBTE task(s) sharing {cores} cores (scaled to the allocation)",
+        f"TOTAL=${{AUTO3RD_NPROC:-{cores}}}",
+        'if [ -n "$SLURM_JOB_ID" ]; then',
+        '    export AUTO3RD_LAUNCHER="srun --exclusive -n"',
+        "fi",
+        "",
+        "run_task() {",
+        f"    local n=$(( TOTAL * $3 / {cores} ))",
+        "    [ $n -lt 1 ] && n=1",
+        '    echo "[Pack] $1: $n core(s), started at $(date)"',
+        '    (cd "$1" && AUTO3RD_NPROC=$n bash "$2" > shengbte.out 2>&1)',
+        "}",
+        "",
+        "PIDS=()",
+    ]
+    for task_dir, script, share in entries:
+        lines.append(f'run_task "{os.path.abspath(task_dir)}" "{script}" {share} &')
+        lines.append("PIDS+=($!)")
+    lines += [
+        "",
+        "STATUS=0",
+        'for pid in "${PIDS[@]}"; do',
+        '    wait "$pid" || STATUS=1',
+        "done",
+        'echo "[Pack] Finished at $(date) (status $STATUS)."',
+        "exit $STATUS",
+    ]
+    os.makedirs(pack_dir, exist_ok=True)
+    with open(os.path.join(pack_dir, PACK_SCRIPT), 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+def pack_requests(work_dir, sub_script_tpl, requests, per_pack):
+    """Replace one-job-per-task requests by a few packed allocations.
+
+    Returns (pack requests, [[indices of the original requests] per pack]).
+    """
+    cores = int(executor.script_directives(sub_script_tpl).get('ntasks', 1))
+    costs = [task_cost(request['work_dir']) for request in requests]
+    pack_root = os.path.join(work_dir, PACK_DIR)
+    first = len(glob.glob(os.path.join(pack_root, "pack_*")))
+
+    packed = []
+    members = []
+    for n, plan in enumerate(plan_packs(costs, per_pack, cores), first + 1):
+        pack_dir = os.path.join(pack_root, f"pack_{n}")
+        job_name = f"KP_{n}"
+        entries = [(requests[i]['work_dir'], requests[i]['script'], share) for i, share in plan]
+        write_pack_script(pack_dir, sub_script_tpl, job_name, entries, cores)
+        names = ", ".join(f"{os.path.basename(requests[i]['work_dir'])} ({share})" for i, share in plan)
+        print(f"  [Pack] {job_name}: {names} of {cores} cores")
+        packed.append({'script': PACK_SCRIPT, 'work_dir': pack_dir, 'job_name': job_name})
+        members.append([i for i, _ in plan])
+    return packed, members
+
+def submit_jobs(config, folders=None, redo=(), fc3_files=None):
     root_dir = config.get('ROOT_DIR', '.')
     work_dir = config.get('WORK_DIR', 'ShengBTE')
     control_file = config.get('CONTROL_FILE', 'CONTROL')
     ifc2_file = config.get('IFC2_FILE', 'espresso.ifc2')
     sub_script_tpl = config.get('SUB_SCRIPT', 'templates/sub_sheng.sh')
     target_result = config.get('TARGET_RESULT', 'BTE.KappaTensorVsT_CONV')
+    fc3_tolerance = config.get('FC3_TOLERANCE')
+    pack_tasks = int(config.get('PACK_TASKS', 1))
 
     required_files = [control_file, ifc2_file, sub_script_tpl]
     for f in required_files:
         if not os.path.exists(f):
             print(f"Error: Required file '{f}' not found in root directory.")
-            return
+            return {}
 
     if not os.path.exists(work_dir):
         os.makedirs(work_dir)
         print(f"Created working directory: {work_dir}")
 
     pattern = re.compile(r"thirdorder_(\d+)_(-?\d+)")
-    source_folders = sorted(glob.glob(os.path.join(root_dir, "thirdorder_*")))
+    if folders is None:
+        source_folders = sorted(glob.glob(os.path.join(root_dir, "thirdorder_*")))
+    else:
+        source_folders = [os.path.join(root_dir, folder) for folder in sorted(folders)]
     
     print(f"--- Starting ShengBTE Submission ---")
     print(f"Found {len(source_folders)} candidate folders.")
 
     skipped_count = 0
-    submitted_count = 0
+    requests = []
+    sources = []
 
     for src_folder in source_folders:
         folder_name = os.path.basename(src_folder)
@@ -40,7 +207,7 @@ def submit_jobs(config):
         sc_size = match.group(1)
         cutoff = match.group(2)
         
-        fc3_path = os.path.join(src_folder, "FORCE_CONSTANTS_3RD")
+        fc3_path = os.path.join(src_folder, (fc3_files or {}).get(folder_name, "FORCE_CONSTANTS_3RD"))
         if not os.path.exists(fc3_path):
             continue
 
@@ -48,7 +215,8 @@ def submit_jobs(config):
         task_dir = os.path.join(work_dir, task_folder_name)
 
         result_path = os.path.join(task_dir, target_result)
-        if os.path.exists(result_path) and os.path.getsize(result_path) > 0:
+        if (os.path.exists(result_path) and os.path.getsize(result_path) > 0
+                and folder_name not in redo):
             print(f"  [Skip] {task_folder_name}: Result exists.")
             skipped_count += 1
             continue
@@ -56,45 +224,43 @@ def submit_jobs(config):
         if not os.path.exists(task_dir):
             os.makedirs(task_dir)
 
-        abs_control = os.path.abspath(control_file)
-        abs_ifc2 = os.path.abspath(ifc2_file)
-        abs_fc3 = os.path.abspath(fc3_path)
-        abs_sub_script = os.path.abspath(sub_script_tpl)
+        reuse_path = os.path.join(task_dir, REUSE_FILE)
+        if os.path.exists(reuse_path):
+            os.remove(reuse_path)
+        if fc3_tolerance is not None:
+            reference, change = find_reusable(src_folder, work_dir, target_result, float(fc3_tolerance))
+            if reference:
+                # The FC3 has stopped changing: its kappa would not move either
+                shutil.copy(os.path.join(reference, target_result), result_path)
+                with open(reuse_path, 'w') as f:
+                    json.dump({'reference': reference, 'fc3_change': change}, f, indent=1)
+                print(f"  [Reuse] {task_folder_name}: FC3 within {change * 100:.3f}% of "
+                      f"{os.path.basename(reference)}, result copied.")
+                skipped_count += 1
+                continue
 
-        shutil.copy(abs_control, os.path.join(task_dir, "CONTROL"))
+        dest_script_name = prepare_task(task_dir, control_file, ifc2_file, fc3_path, sub_script_tpl)
 
-        dest_ifc2 = os.path.join(task_dir, "espresso.ifc2")
-        if not os.path.exists(dest_ifc2):
-            os.symlink(abs_ifc2, dest_ifc2)
+        job_name = f"K_{sc_size}_{cutoff}"
+        print(f"  [Sub] Submitting {task_folder_name} ...")
+        requests.append({'script': dest_script_name, 'work_dir': task_dir, 'job_name': job_name})
+        sources.append(folder_name)
 
-        dest_fc3 = os.path.join(task_dir, "FORCE_CONSTANTS_3RD")
-        if os.path.exists(dest_fc3) or os.path.islink(dest_fc3):
-            os.remove(dest_fc3)
-        os.symlink(abs_fc3, dest_fc3)
-
-        dest_script_name = os.path.basename(sub_script_tpl)
-        shutil.copy(abs_sub_script, os.path.join(task_dir, dest_script_name))
-
-        original_cwd = os.getcwd()
-        try:
-            os.chdir(task_dir)
-            
-            job_name = f"K_{sc_size}_{cutoff}"
-            print(f"  [Sub] Submitting {task_folder_name} ...")
-            
-            cmd = f"sbatch -J {job_name} {dest_script_name}"
-            
-            ret = subprocess.call(cmd, shell=True, stdout=subprocess.DEVNULL)
-            if ret == 0:
-                submitted_count += 1
-            else:
-                print(f"    Error: Submission failed for {task_folder_name}")
-                
-        except Exception as e:
-            print(f"    Error in {task_folder_name}: {e}")
-        finally:
-            os.chdir(original_cwd)
+    if folders is None:
+        executor.registry().begin_stage(STAGE)
+    members = [[i] for i in range(len(requests))]
+    if pack_tasks > 1 and len(requests) > 1:
+        requests, members = pack_requests(work_dir, sub_script_tpl, requests, pack_tasks)
+    submitted = {}
+    for group, request, job_id in zip(members, requests, executor.submit_batch(STAGE, requests)):
+        if job_id is not None:
+            # Packed tasks share the job ID; each still reports in its own shengbte.out
+            submitted.update((sources[i], job_id) for i in group)
+        else:
+            print(f"    Error: Submission failed for {os.path.basename(request['work_dir'])}")
+    submitted_count = len(submitted)
 
     print(f"\n--- Submission Summary ---")
     print(f"  Skipped (Done) : {skipped_count}")
-    print(f"  Submitted      : {submitted_count}")
\ No newline at end of file
+    print(f"  Submitted      : {submitted_count}")
+    return submitted
@@ -1,81 +1,91 @@
 import os
-import glob
 import sys
+import json
+import numpy as np
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from src import structure, symmetry, pw_output, disp_archive
+from src.fingerprint_index import FingerprintIndex, INDEX_FILE
 
 LOG_FILE = "linking_report.txt"
+SYM_MAP_FILE = "symmetry_map.json"
+SYM_SKIP_FILE = "sym_skip.list"
+PARALLEL_THRESHOLD = 64
 
-def parse_structure_fingerprint(filepath):
-    nat = 0
-    coords = []
-    in_positions = False
-    
-    try:
-        with open(filepath, 'r') as f:
-            lines = f.readlines()
-            
-        for line in lines:
-            line = line.strip()
-            if not line: continue
-            
-            if line.startswith('nat') or 'nat' in line:
-                if '=' in line:
-                    parts = line.split('=')
-                    try:
-                        val = parts[1].strip().split(',')[0]
-                        nat = int(val)
-                    except:
-                        pass
-                elif line.startswith('nat'):
-                     try:
-                        parts = line.split()
-                        nat = int(parts[1])
-                     except:
-                        pass
-
-            if 'ATOMIC_POSITIONS' in line:
-                in_positions = True
-                continue
-                
-            if in_positions:
-                if 'K_POINTS' in line or 'CELL_PARAMETERS' in line:
-                    break
-                coords.append(line)
-        
-        if nat == 0 or not coords:
-            return None
-            
-        return (nat, tuple(coords))
-
-    except Exception:
+def parse_structure_fingerprint(filepath, tolerance=structure.DEFAULT_TOLERANCE):
+    struct = structure.read_pw_structure(filepath)
+    if struct is None:
         return None
+    return structure.structure_fingerprint(struct, tolerance)
+
+def fingerprint_files(paths, tolerance, workers=1):
+    if workers <= 1 or len(paths) < PARALLEL_THRESHOLD:
+        return [parse_structure_fingerprint(p, tolerance) for p in paths]
+
+    chunksize = max(1, len(paths) // (workers * 8))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(parse_structure_fingerprint, paths,
+                             repeat(tolerance, len(paths)), chunksize=chunksize))
+
+def _match_in_bucket(bucket, frac, periodic, tolerance):
+    stacked = np.stack([entry[0] for entry in bucket])
+    delta = stacked - frac
+    if periodic:
+        delta -= np.rint(delta)
+    max_dev = np.abs(delta).reshape(len(bucket), -1).max(axis=1)
+
+    hits = np.nonzero(max_dev <= tolerance)[0]
+    if len(hits) == 0:
+        return None
+    return bucket[hits[0]][1]
+
+def find_master(fingerprint_db, fp, tolerance=structure.DEFAULT_TOLERANCE):
+    digest, frac, periodic = fp
+    digests = structure.probe_digests(fp, tolerance)
+    if digests is None:
+        header = digest.split(':', 1)[0] + ':'
+        digests = [digest] + [d for d in fingerprint_db if d.startswith(header) and d != digest]
+
+    for candidate in digests:
+        bucket = fingerprint_db.get(candidate)
+        if bucket:
+            master = _match_in_bucket(bucket, frac, periodic, tolerance)
+            if master is not None:
+                return master
+    return None
 
-def create_relative_symlink(src_abs_path, dst_abs_path, log_handle):
+def register_master(fingerprint_db, fp, path):
+    digest, frac, _ = fp
+    fingerprint_db.setdefault(digest, []).append((frac, path))
+
+def create_relative_symlink(src_abs_path, dst_abs_path):
     dst_dir = os.path.dirname(dst_abs_path)
     src_rel = os.path.relpath(src_abs_path, dst_dir)
     
     if os.path.islink(dst_abs_path):
         current_target = os.readlink(dst_abs_path)
         if current_target == src_rel:
-            return
+            return True
         os.remove(dst_abs_path)
     elif os.path.exists(dst_abs_path):
         if os.path.getsize(dst_abs_path) > 0:
-            return
+            return False
         os.remove(dst_abs_path)
 
     os.symlink(src_rel, dst_abs_path)
-    
-    try:
-        root = os.getcwd()
-        log_dst = os.path.relpath(dst_abs_path, root)
-        log_src = os.path.relpath(src_abs_path, root)
-    except:
-        log_dst = dst_abs_path
-        log_src = src_abs_path
-        
-    log_handle.write(f"{log_dst} -> {log_src}\n")
-
-def run_linking(configs):
+    return True
+
+def write_linking_report(index):
+    with open(LOG_FILE, 'w') as log:
+        log.write("=== Thirdorder Duplication Linking Report ===\n")
+        for path, master in index.links():
+            log.write(f"{path}.out -> {master}.out\n")
+
+def run_linking(configs, tolerance=None, workers=None):
+    tolerance = float(tolerance) if tolerance else structure.DEFAULT_TOLERANCE
+    workers = int(workers) if workers else min(8, os.cpu_count() or 1)
+
     target_folders = []
     for config in configs:
         na, nb, nc, cut = config
@@ -88,54 +98,65 @@ def run_linking(configs):
     
     print("-" * 60)
     print("--- Starting Structure Deduplication (Smart Linking) ---")
-    
-    with open(LOG_FILE, 'w') as log:
-        log.write("=== Thirdorder Duplication Linking Report ===\n")
-        
-        print("  Phase 1: Indexing existing results...")
-        for folder in target_folders:
-            if not os.path.exists(folder): continue
-            
-            inputs = glob.glob(os.path.join(folder, "DISP.*"))
-            for infile in inputs:
-                if infile.endswith(('.out', '.in', '.save', '.xml', '.run')): continue
-                
-                outfile = infile + ".out"
-                if os.path.exists(outfile) and not os.path.islink(outfile) and os.path.getsize(outfile) > 100:
-                    fp = parse_structure_fingerprint(infile)
-                    if fp and fp not in fingerprint_db:
-                        fingerprint_db[fp] = os.path.abspath(outfile)
-
-        print("  Phase 2: Linking duplicates...")
-        for folder in target_folders:
-            if not os.path.exists(folder): continue
-
-            input_files = sorted([
-                f for f in glob.glob(os.path.join(folder, "DISP.*")) 
-                if not f.endswith(('.out', '.in', '.save', '.xml', '.run')) and os.path.isfile(f)
-            ])
-            
-            if not input_files: continue
-            
-            for infile in input_files:
-                fp = parse_structure_fingerprint(infile)
-                if fp is None: continue
-                
-                outfile = infile + ".out"
-                abs_outfile = os.path.abspath(outfile)
-                
-                if fp in fingerprint_db:
-                    master_path = fingerprint_db[fp]
-                    
-                    if master_path == abs_outfile:
-                        pass
-                    else:
-                        create_relative_symlink(master_path, abs_outfile, log)
-                        total_linked += 1
-                else:
-                    fingerprint_db[fp] = abs_outfile
-                
-                total_scanned += 1
+
+    index = FingerprintIndex(INDEX_FILE)
+    index.prune()
+
+    print("  Phase 1: Indexing existing results...")
+    fingerprints = {}
+    missing = []
+    for folder in target_folders:
+        if not os.path.exists(folder): continue
+
+        for infile in list_input_files(folder):
+            hit, fp = index.lookup(infile, tolerance)
+            fingerprints[infile] = fp
+            if not hit:
+                missing.append(infile)
+
+    for infile, fp in zip(missing, fingerprint_files(missing, tolerance, workers)):
+        index.store(infile, fp, tolerance)
+        fingerprints[infile] = fp
+
+    print(f"    Fingerprints: {len(fingerprints)} inputs ({len(missing)} parsed with "
+          f"{workers if len(missing) >= PARALLEL_THRESHOLD else 1} worker(s), "
+          f"{len(fingerprints) - len(missing)} from {INDEX_FILE})")
+
+    for infile, fp in fingerprints.items():
+        if fp is None: continue
+        if disp_archive.output_done(infile):
+            if find_master(fingerprint_db, fp, tolerance) is None:
+                register_master(fingerprint_db, fp, infile)
+
+    print("  Phase 2: Linking duplicates...")
+    packed_links = {folder: {} for folder in target_folders if disp_archive.is_packed(folder)}
+    for infile, fp in fingerprints.items():
+        if fp is None: continue
+
+        folder, name, packed = disp_archive.split_path(infile)
+        master = find_master(fingerprint_db, fp, tolerance)
+        if master is None:
+            register_master(fingerprint_db, fp, infile)
+            index.set_role(infile, 'master')
+        elif master == infile:
+            index.set_role(infile, 'master')
+        elif packed and not disp_archive.output_done(infile):
+            packed_links[folder][name] = os.path.relpath(master, folder)
+            index.set_role(infile, 'link', master)
+            total_linked += 1
+        elif not packed and create_relative_symlink(os.path.abspath(master + ".out"), os.path.abspath(infile + ".out")):
+            index.set_role(infile, 'link', master)
+            total_linked += 1
+        else:
+            index.set_role(infile, 'master')
+
+        total_scanned += 1
+
+    for folder, links in packed_links.items():
+        disp_archive.write_links(folder, links)
+
+    write_linking_report(index)
+    index.close()
 
     if total_scanned > 0:
         pct = (total_linked / total_scanned) * 100
@@ -146,4 +167,157 @@ def run_linking(configs):
     print(f"    Total Jobs Check: {total_scanned}")
     print(f"    Links Created   : {total_linked} ({pct:.1f}%)")
     print(f"    Details log     : {LOG_FILE}")
-    print("-" * 60)
\ No newline at end of file
+    print("-" * 60)
+
+def list_input_files(folder):
+    return disp_archive.input_paths(folder)
+
+def is_linked(infile):
+    folder, name, packed = disp_archive.split_path(infile)
+    if packed:
+        return name in disp_archive.load_links(folder)
+    return os.path.islink(infile + ".out")
+
+def run_symmetry_reduction(configs, symprec=None):
+    symprec = float(symprec) if symprec else symmetry.DEFAULT_SYMPREC
+
+    groups = defaultdict(list)
+    for config in configs:
+        na, nb, nc, cut = config
+        folder_name = f"thirdorder_{na}{nb}{nc}_{cut}"
+        if os.path.exists(folder_name):
+            groups[f"{na}{nb}{nc}"].append(folder_name)
+
+    print("-" * 60)
+    print("--- Starting Symmetry Reduction (Equivalent Displacements) ---")
+
+    total_members = 0
+    total_scanned = 0
+
+    for grid in sorted(groups.keys()):
+        candidates = []
+        structs = []
+        for folder in groups[grid]:
+            for infile in list_input_files(folder):
+                if is_linked(infile):
+                    continue
+                struct = structure.read_pw_structure(infile)
+                if struct is None or struct['cell'] is None:
+                    continue
+                frac = structure.fractional_positions(struct)
+                if frac is None:
+                    continue
+                candidates.append(infile)
+                structs.append((struct, frac))
+
+        if not candidates:
+            continue
+
+        lattice = structs[0][0]['cell']
+        species = structs[0][0]['species']
+        eq = symmetry.equilibrium_positions([frac for _, frac in structs])
+        operations = symmetry.find_symmetry_operations(lattice, eq, species, symprec)
+
+        patterns = [symmetry.displacement_pattern(eq, frac, lattice, symprec) for _, frac in structs]
+        reps, assignment = symmetry.classify_orbits(patterns, operations)
+
+        folder_maps = defaultdict(lambda: {'operations': [], 'members': {}})
+        for idx, (rep, op_index) in enumerate(assignment):
+            if op_index is None:
+                continue
+            infile = candidates[idx]
+            folder, name, _ = disp_archive.split_path(infile)
+            entry = folder_maps[folder]
+            op = operations[op_index]
+            entry['operations'].append({
+                'rotation': op['rotation'].tolist(),
+                'perm': op['perm'].tolist(),
+            })
+            entry['members'][name] = {
+                'source': os.path.relpath(candidates[rep], folder),
+                'operation': len(entry['operations']) - 1,
+            }
+
+        for folder in groups[grid]:
+            map_path = os.path.join(folder, SYM_MAP_FILE)
+            skip_path = os.path.join(folder, SYM_SKIP_FILE)
+            entry = folder_maps.get(folder)
+            if not entry:
+                for path in (map_path, skip_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                continue
+
+            with open(map_path, 'w') as f:
+                json.dump(entry, f)
+            with open(skip_path, 'w') as f:
+                for name in sorted(entry['members']):
+                    f.write(name + "\n")
+
+        n_members = len(candidates) - len(reps)
+        total_members += n_members
+        total_scanned += len(candidates)
+        print(f"  [Sym] Supercell {grid}: {len(operations)} operations, "
+              f"{len(candidates)} structures -> {len(reps)} orbits ({n_members} skipped)")
+
+    pct = (total_members / total_scanned * 100) if total_scanned else 0.0
+    print("--- Symmetry Reduction Complete. ---")
+    print(f"    Structures Checked : {total_scanned}")
+    print(f"    Symmetry Skipped   : {total_members} ({pct:.1f}%)")
+    print("-" * 60)
+
+def expand_symmetric_outputs(configs, verbose=True):
+    if verbose:
+        print("--- Synthesizing Symmetry-Equivalent Outputs ---")
+    created = 0
+    pending = 0
+
+    for config in configs:
+        na, nb, nc, cut = config
+        folder_name = f"thirdorder_{na}{nb}{nc}_{cut}"
+        map_path = os.path.join(folder_name, SYM_MAP_FILE)
+        if not os.path.exists(map_path):
+            continue
+
+        with open(map_path, 'r') as f:
+            sym_map = json.load(f)
+
+        operations = [
+            {'rotation': np.array(op['rotation']), 'perm': np.array(op['perm'], dtype=int)}
+            for op in sym_map['operations']
+        ]
+
+        packed = disp_archive.is_packed(folder_name)
+        for name, info in sorted(sym_map['members'].items()):
+            member = disp_archive.entry_path(folder_name, name) if packed else os.path.join(folder_name, name)
+            if disp_archive.output_done(member):
+                continue
+
+            source = os.path.normpath(os.path.join(folder_name, info['source']))
+            data = disp_archive.read_output(source)
+            parsed = pw_output.parse_forces(data.decode(errors='ignore')) if data else None
+            if parsed is None:
+                pending += 1
+                continue
+
+            forces, types = parsed
+            op = operations[info['operation']]
+            new_types = [0] * len(types)
+            for i, dst in enumerate(op['perm']):
+                new_types[dst] = types[i]
+
+            text = pw_output.format_forces(
+                symmetry.rotate_forces(forces, op), new_types,
+                header_lines=[f"Synthesized from {info['source']} by symmetry operation"])
+            if packed:
+                disp_archive.store_output(folder_name, name, text)
+            else:
+                with open(member + ".out", 'w') as f:
+                    f.write(text)
+            created += 1
+
+    if verbose:
+        print(f"    Outputs Created : {created}")
+    if pending and verbose:
+        print(f"    [Warning] {pending} outputs pending (source calculation not finished).")
+    return pending == 0
@@ -0,0 +1,198 @@
+import os
+import json
+from collections import Counter, defaultdict
+from src import disp_archive, pw_output
+from src.deduplicator import SYM_MAP_FILE
+
+DONE = "done"
+UNCONVERGED = "unconverged"
+CRASHED = "crashed"
+MISSING = "missing"
+FAILED_STATES = (UNCONVERGED, CRASHED, MISSING)
+
+RETRY_FILE = "dft_retries.json"
+FAILED_DIR = "failed_outputs"
+FALLBACK_FILE = "dft_fallback.txt"
+DEFAULT_RETRY_LIMIT = 2
+
+def classify_record(record):
+    if record is None:
+        return MISSING
+    if not record['converged']:
+        return UNCONVERGED
+    if not record['done']:
+        return CRASHED
+    # JOB DONE without a force block: the SCF stopped before forces were computed
+    return DONE if record['forces'] is not None else UNCONVERGED
+
+def classify(path):
+    """State of the output belonging to one DISP input (classic or packed path)."""
+    return classify_record(pw_output.output_record(path))
+
+def _sym_sources(folder):
+    map_path = os.path.join(folder, SYM_MAP_FILE)
+    if not os.path.exists(map_path):
+        return {}
+    with open(map_path, 'r') as f:
+        members = json.load(f).get('members', {})
+    return {name: os.path.normpath(os.path.join(folder, info['source'])) for name, info in members.items()}
+
+def owner_of(path, links, sources):
+    """Input whose pw.x run provides the data of `path`, and how it is related."""
+    folder, name, packed = disp_archive.split_path(path)
+    if packed and name in links:
+        return os.path.normpath(os.path.join(folder, links[name])), 'link'
+    if not packed and os.path.islink(path + ".out"):
+        target = os.path.relpath(os.path.realpath(path + ".out"))
+        return target[:-len(".out")], 'link'
+    if name in sources:
+        return sources[name], 'symmetry'
+    return path, 'unique'
+
+def scan_folder(folder):
+    """Classify every displacement: {path: (state, owner, relation)}."""
+    links = disp_archive.load_links(folder) if disp_archive.is_packed(folder) else {}
+    sources = _sym_sources(folder)
+    records = pw_output.load_bundle(folder)
+    results = {}
+    for path in disp_archive.input_paths(folder):
+        owner, relation = owner_of(path, links, sources)
+        state = classify_record(records.get(disp_archive.split_path(path)[1]))
+        results[path] = (state, owner, relation)
+    return results
+
+def unusable(folder):
+    return [path for path, (state, _, _) in scan_folder(folder).items() if state != DONE]
+
+def input_exists(path):
+    folder, name, packed = disp_archive.split_path(path)
+    if packed:
+        return name in disp_archive.list_inputs(folder)
+    return os.path.isfile(path)
+
+def plan_repairs(folders):
+    """Work out which unique pw.x runs must be redone so that `folders` become complete.
+
+    Returns (reruns, dependents): the owner inputs to rerun, and for each of them the
+    entries whose data derives from it (links and symmetry members).
+    """
+    reruns = set()
+    dependents = defaultdict(list)
+    for folder in folders:
+        for path, (state, owner, relation) in scan_folder(folder).items():
+            if relation != 'unique':
+                dependents[owner].append((path, relation))
+            if state == DONE:
+                continue
+            if relation == 'link' and not input_exists(owner):
+                # The master can never be rerun: turn the duplicate into a job of its own
+                unlink(path)
+                owner = path
+            if owner == path or classify(owner) != DONE:
+                reruns.add(owner)
+            elif relation == 'symmetry' and state != MISSING:
+                # Synthesized from an earlier (bad) source output: synthesize again
+                discard_output(path, keep=False)
+    return reruns, dependents
+
+def unlink(path):
+    folder, name, packed = disp_archive.split_path(path)
+    if packed:
+        links = dict(disp_archive.load_links(folder))
+        links.pop(name, None)
+        disp_archive.write_links(folder, links)
+    elif os.path.islink(path + ".out"):
+        os.remove(path + ".out")
+    print(f"    [Repair] {path}: master no longer exists, running the duplicate itself.")
+
+def discard_output(path, keep=True, attempt=0):
+    """Move a bad output out of the way so that the job is queued again."""
+    folder, name, packed = disp_archive.split_path(path)
+    if packed:
+        data = disp_archive.read_output(path)
+        if data and keep:
+            _keep(folder, name, attempt, data)
+        disp_archive.remove_output(folder, name)
+        return
+    outfile = path + ".out"
+    if os.path.islink(outfile):
+        return
+    if os.path.exists(outfile):
+        if keep:
+            with open(outfile, 'rb') as f:
+                _keep(folder, name, attempt, f.read())
+        os.remove(outfile)
+
+def _keep(folder, name, attempt, data):
+    failed_dir = os.path.join(folder, FAILED_DIR)
+    os.makedirs(failed_dir, exist_ok=True)
+    with open(os.path.join(failed_dir, f"{name}.out.{attempt}"), 'wb') as f:
+        f.write(data)
+
+def load_retries(folder):
+    path = os.path.join(folder, RETRY_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def save_retries(folder, retries):
+    path = os.path.join(folder, RETRY_FILE)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(retries, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def write_fallback(folder, settings):
+    """Write FALLBACK_SCF as 'NAMELIST key value' lines for sub_calc.sh."""
+    path = os.path.join(folder, FALLBACK_FILE)
+    if not settings:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, 'w') as f:
+        for key, value in sorted(settings.items()):
+            namelist, _, key = key.rpartition('.')
+            if isinstance(value, bool):
+                value = ".true." if value else ".false."
+            elif isinstance(value, str) and not value.startswith(("'", '"', '.')):
+                value = f"'{value}'"
+            f.write(f"{(namelist or 'ELECTRONS').upper()} {key} {value}\n")
+
+def prepare_retries(folders, retry_limit=DEFAULT_RETRY_LIMIT):
+    """Classify, set aside failed outputs and count attempts.
+
+    Returns (queue, exhausted, counts): {folder: [names]} to run again, {folder: [names]}
+    that used up their retries, and the number of outputs per state.
+    """
+    counts = Counter()
+    for folder in folders:
+        counts.update(state for state, _, _ in scan_folder(folder).values())
+
+    reruns, dependents = plan_repairs(folders)
+    queue = defaultdict(list)
+    exhausted = defaultdict(list)
+    retries = {}
+    for owner in sorted(reruns):
+        folder, name, _ = disp_archive.split_path(owner)
+        if folder not in retries:
+            retries[folder] = load_retries(folder)
+        attempt = retries[folder].get(name, 0) + 1
+        if attempt > retry_limit:
+            exhausted[folder].append(name)
+            continue
+        retries[folder][name] = attempt
+        discard_output(owner, keep=True, attempt=attempt)
+        for path, relation in dependents.get(owner, []):
+            if relation == 'symmetry':
+                discard_output(path, keep=False)
+        queue[folder].append(name)
+
+    for folder, folder_retries in retries.items():
+        save_retries(folder, folder_retries)
+    return dict(queue), dict(exhausted), counts
+
+def report(counts):
+    return ", ".join(f"{state}: {counts.get(state, 0)}" for state in (DONE,) + FAILED_STATES)
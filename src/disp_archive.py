@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import zlib
+import fcntl
+import zipfile
+import contextlib
+
+INPUT_ARCHIVE = "disp_inputs.zip"
+OUTPUT_STORE = "disp_outputs.idx"
+OUTPUT_DATA = "disp_outputs.{}.dat"
+LINKS_FILE = "disp_links.txt"
+LOCK_FILE = ".disp_outputs.lock"
+SYM_SKIP_FILE = "sym_skip.list"
+SEP = "::"
+EXCLUDE_SUFFIXES = ('.out', '.in', '.save', '.xml', '.run')
+MIN_OUTPUT_SIZE = 100
+COMPACT_MIN_BYTES = 1 << 20
+
+_cache = {}
+_archives = {}
+
+def is_packed(folder):
+    return os.path.exists(os.path.join(folder, INPUT_ARCHIVE))
+
+def entry_path(folder, name):
+    return os.path.join(folder, INPUT_ARCHIVE) + SEP + name
+
+def split_path(path):
+    if SEP in path:
+        archive, name = path.split(SEP, 1)
+        return os.path.dirname(archive), name, True
+    return os.path.dirname(path), os.path.basename(path), False
+
+def source_file(path):
+    return path.split(SEP, 1)[0]
+
+@contextlib.contextmanager
+def _locked(folder, exclusive):
+    with open(os.path.join(folder, LOCK_FILE), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _cached(path, loader):
+    try:
+        st = os.stat(path)
+    except OSError:
+        _cache.pop(path, None)
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    hit = _cache.get(path)
+    if hit is None or hit[0] != key:
+        hit = (key, loader())
+        _cache[path] = hit
+    return hit[1]
+
+def _open_archive(archive):
+    # One open ZipFile per archive and process (a forked worker must not share the file offset)
+    st = os.stat(archive)
+    key = (st.st_ino, st.st_mtime_ns, st.st_size, os.getpid())
+    hit = _archives.get(archive)
+    if hit is None or hit[0] != key:
+        if hit is not None:
+            hit[1].close()
+        hit = (key, zipfile.ZipFile(archive, 'r'))
+        _archives[archive] = hit
+    return hit[1]
+
+def _classic_inputs(folder):
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        f for f in names
+        if f.startswith("DISP.") and not f.endswith(EXCLUDE_SUFFIXES)
+        and os.path.isfile(os.path.join(folder, f))
+    )
+
+def pack_inputs(folder):
+    names = _classic_inputs(folder)
+    if not names:
+        return 0
+
+    archive = os.path.join(folder, INPUT_ARCHIVE)
+    tmp = archive + ".tmp"
+    with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zf:
+        if os.path.exists(archive):
+            with zipfile.ZipFile(archive, 'r') as old:
+                for name in old.namelist():
+                    if name not in names:
+                        zf.writestr(name, old.read(name))
+        for name in names:
+            zf.write(os.path.join(folder, name), name)
+    os.replace(tmp, archive)
+
+    for name in names:
+        os.remove(os.path.join(folder, name))
+    return len(names)
+
+def list_inputs(folder):
+    if not is_packed(folder):
+        return _classic_inputs(folder)
+    archive = os.path.join(folder, INPUT_ARCHIVE)
+
+    def loader():
+        return sorted(_open_archive(archive).namelist())
+
+    return list(_cached(archive, loader) or [])
+
+def input_paths(folder):
+    if not is_packed(folder):
+        return [os.path.join(folder, name) for name in _classic_inputs(folder)]
+    return [entry_path(folder, name) for name in list_inputs(folder)]
+
+def read_input(path):
+    folder, name, packed = split_path(path)
+    if not packed:
+        with open(path, 'rb') as f:
+            return f.read()
+    return _open_archive(os.path.join(folder, INPUT_ARCHIVE)).read(name)
+
+def load_links(folder):
+    path = os.path.join(folder, LINKS_FILE)
+
+    def loader():
+        links = {}
+        with open(path, 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    links[parts[0]] = parts[1]
+        return links
+
+    return _cached(path, loader) or {}
+
+def write_links(folder, links):
+    path = os.path.join(folder, LINKS_FILE)
+    with open(path + ".tmp", 'w') as f:
+        for name in sorted(links):
+            f.write(f"{name} {links[name]}\n")
+    os.replace(path + ".tmp", path)
+
+def load_sym_skipped(folder):
+    path = os.path.join(folder, SYM_SKIP_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as f:
+        return set(line.strip() for line in f if line.strip())
+
+def _read_index(folder):
+    """{'data': data file name, 'entries': {name: [offset, length, size, crc]}} of the output store.
+
+    Outputs are zlib blobs appended to the data file; the index is only ever replaced
+    atomically, so a job killed mid-append leaves unreferenced bytes but no lost outputs.
+    """
+    try:
+        with open(os.path.join(folder, OUTPUT_STORE), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'data': OUTPUT_DATA.format(0), 'entries': {}}
+
+def _compact(folder, index):
+    generation = int(index['data'].split('.')[1]) + 1
+    data = OUTPUT_DATA.format(generation)
+    entries = {}
+    with open(os.path.join(folder, index['data']), 'rb') as src, \
+            open(os.path.join(folder, data), 'wb') as dst:
+        for name, (offset, length, size, crc) in sorted(index['entries'].items(), key=lambda e: e[1][0]):
+            src.seek(offset)
+            entries[name] = [dst.tell(), length, size, crc]
+            dst.write(src.read(length))
+        dst.flush()
+        os.fsync(dst.fileno())
+    return {'data': data, 'entries': entries}
+
+def _commit_index(folder, index):
+    """Replace the index, first compacting the data file once superseded bytes outweigh live ones."""
+    old = index['data']
+    try:
+        used = os.path.getsize(os.path.join(folder, old))
+    except OSError:
+        used = 0
+    live = sum(entry[1] for entry in index['entries'].values())
+    if used - live > max(live, COMPACT_MIN_BYTES):
+        index = _compact(folder, index)
+
+    path = os.path.join(folder, OUTPUT_STORE)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(index, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    if index['data'] != old and os.path.exists(os.path.join(folder, old)):
+        os.remove(os.path.join(folder, old))
+
+def _stored_index(folder):
+    store = os.path.join(folder, OUTPUT_STORE)
+
+    def loader():
+        with _locked(folder, exclusive=False):
+            entries = _read_index(folder)['entries']
+        return {name: (entry[2], entry[3]) for name, entry in entries.items()}
+
+    return _cached(store, loader) or {}
+
+def stored_outputs(folder):
+    return {name: entry[0] for name, entry in _stored_index(folder).items()}
+
+def output_signature(path, _depth=0):
+    """Cheap identity of the output behind `path`, or None if there is none yet.
+
+    (size, mtime_ns) of DISP.*.out (through symlinks), or (size, CRC) of the entry in the
+    packed store (through disp_links.txt); an empty output counts as no output.
+    """
+    folder, name, packed = split_path(path)
+    if not packed:
+        try:
+            st = os.stat(path + ".out")
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    entry = _stored_index(folder).get(name)
+    if entry is None and _depth < 4:
+        master = load_links(folder).get(name)
+        if master:
+            return output_signature(os.path.normpath(os.path.join(folder, master)), _depth + 1)
+    return entry if entry and entry[0] > 0 else None
+
+def store_output(folder, name, data):
+    if isinstance(data, str):
+        data = data.encode()
+    blob = zlib.compress(data)
+    with _locked(folder, exclusive=True):
+        index = _read_index(folder)
+        with open(os.path.join(folder, index['data']), 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        index['entries'][name] = [offset, len(blob), len(data), zlib.crc32(data)]
+        _commit_index(folder, index)
+
+def remove_output(folder, name):
+    with _locked(folder, exclusive=True):
+        index = _read_index(folder)
+        if index['entries'].pop(name, None) is not None:
+            _commit_index(folder, index)
+
+def _read_stored(folder, name):
+    if not os.path.exists(os.path.join(folder, OUTPUT_STORE)):
+        return None
+    with _locked(folder, exclusive=False):
+        index = _read_index(folder)
+        entry = index['entries'].get(name)
+        if entry is None:
+            return None
+        with open(os.path.join(folder, index['data']), 'rb') as f:
+            f.seek(entry[0])
+            return zlib.decompress(f.read(entry[1]))
+
+def read_output(path, _depth=0):
+    folder, name, packed = split_path(path)
+    if not packed:
+        try:
+            with open(path + ".out", 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    data = _read_stored(folder, name)
+    if data is None and _depth < 4:
+        master = load_links(folder).get(name)
+        if master:
+            return read_output(os.path.normpath(os.path.join(folder, master)), _depth + 1)
+    return data
+
+def output_done(path):
+    folder, name, packed = split_path(path)
+    if not packed:
+        outfile = path + ".out"
+        return (os.path.exists(outfile) and not os.path.islink(outfile)
+                and os.path.getsize(outfile) > MIN_OUTPUT_SIZE)
+    return stored_outputs(folder).get(name, 0) > MIN_OUTPUT_SIZE
+
+def resolved_done(path, _depth=0):
+    if output_done(path):
+        return True
+    folder, name, packed = split_path(path)
+    if not packed:
+        return os.path.exists(path + ".out") and os.path.getsize(path + ".out") > MIN_OUTPUT_SIZE
+    master = load_links(folder).get(name)
+    if master and _depth < 4:
+        return resolved_done(os.path.normpath(os.path.join(folder, master)), _depth + 1)
+    return False
+
+_completed = {}
+
+def output_complete(path):
+    folder, name, packed = split_path(path)
+    if packed:
+        return resolved_done(path)
+    outfile = path + ".out"
+    try:
+        st = os.stat(outfile)
+    except OSError:
+        return False
+    key = (st.st_size, st.st_mtime_ns)
+    if _completed.get(outfile) == key:
+        return True
+    if st.st_size > MIN_OUTPUT_SIZE and classic_completed(outfile):
+        _completed[outfile] = key
+        return True
+    return False
+
+def missing_outputs(folder):
+    return [path for path in input_paths(folder) if not output_complete(path)]
+
+def classic_completed(outfile):
+    try:
+        with open(outfile, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 4096))
+            return b"JOB DONE" in f.read()
+    except (IOError, OSError):
+        return False
+
+def pending_jobs(folder):
+    if not is_packed(folder):
+        skipped = load_sym_skipped(folder)
+        pending = []
+        for name in _classic_inputs(folder):
+            path = os.path.join(folder, name)
+            if name in skipped or os.path.islink(path) or os.path.islink(path + ".out"):
+                continue
+            if classic_completed(path + ".out"):
+                continue
+            pending.append(name)
+        return pending
+
+    stored = stored_outputs(folder)
+    links = load_links(folder)
+    skipped = load_sym_skipped(folder)
+    return [
+        name for name in list_inputs(folder)
+        if name not in links and name not in skipped and stored.get(name, 0) <= MIN_OUTPUT_SIZE
+    ]
+
+def export_classic(folder):
+    missing = 0
+    for name in list_inputs(folder):
+        path = entry_path(folder, name)
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(read_input(path))
+
+        data = read_output(path)
+        if data is None:
+            missing += 1
+            continue
+        with open(os.path.join(folder, name + ".out"), 'wb') as f:
+            f.write(data)
+    return missing
+
+def main(argv):
+    usage = "Usage: disp_archive.py [pending|extract|store|export] FOLDER [NAME] [FILE]"
+    if len(argv) < 2:
+        print(usage)
+        return 1
+
+    command, folder = argv[0], argv[1]
+    if command == 'pending':
+        for name in pending_jobs(folder):
+            print(name)
+    elif command == 'extract' and len(argv) == 4:
+        with open(argv[3], 'wb') as f:
+            f.write(read_input(entry_path(folder, argv[2])))
+    elif command == 'store' and len(argv) == 4:
+        with open(argv[3], 'rb') as f:
+            store_output(folder, argv[2], f.read())
+    elif command == 'export':
+        missing = export_classic(folder)
+        if missing:
+            print(f"Warning: {missing} outputs missing in {folder}")
+    else:
+        print(usage)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
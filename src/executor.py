@@ -0,0 +1,415 @@
+import os
+import re
+import json
+import time
+import getpass
+import itertools
+import subprocess
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from src import readiness
+
+PENDING = "PENDING"
+RUNNING = "RUNNING"
+COMPLETED = "COMPLETED"
+FAILED = "FAILED"
+UNKNOWN = "UNKNOWN"
+QUERY_FAILED = "QUERY_FAILED"
+ACTIVE_STATES = (PENDING, RUNNING)
+TERMINAL_STATES = (COMPLETED, FAILED, "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL",
+                   "PREEMPTED", "BOOT_FAIL", "DEADLINE")
+
+REGISTRY_FILE = "job_registry.json"
+SUBMIT_WORKERS = 8
+TASK_PREFIX = "P"
+
+DIRECTIVE_RE = re.compile(r"^#SBATCH\s+(--?[\w-]+)(?:[=\s]+([^\s#]+))?", re.MULTILINE)
+DIRECTIVE_ALIASES = {
+    '-J': 'job-name', '--job-name': 'job-name',
+    '-o': 'output', '--output': 'output',
+    '-n': 'ntasks', '--ntasks': 'ntasks',
+    '-a': 'array', '--array': 'array',
+}
+
+def script_directives(script_path):
+    try:
+        with open(script_path, 'r', errors='ignore') as f:
+            text = f.read()
+    except (IOError, OSError):
+        return {}
+    directives = {}
+    for match in DIRECTIVE_RE.finditer(text):
+        key = DIRECTIVE_ALIASES.get(match.group(1))
+        if key and match.group(2):
+            directives[key] = match.group(2)
+    return directives
+
+def parse_array(spec):
+    if not spec:
+        return [None], None
+    spec, _, limit = str(spec).partition('%')
+    tasks = []
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-', 1)
+            tasks.extend(range(int(first), int(last) + 1))
+        else:
+            tasks.append(int(part))
+    return tasks, int(limit) if limit else None
+
+def aggregate_state(task_states):
+    """Collapse the states of the tasks of one (array) job into a single state."""
+    if not task_states:
+        return UNKNOWN
+    for state in ACTIVE_STATES[::-1]:
+        if state in task_states:
+            return state
+    failures = [state for state in task_states if state not in (COMPLETED, UNKNOWN)]
+    if failures:
+        return failures[0]
+    return COMPLETED if COMPLETED in task_states else UNKNOWN
+
+class SlurmExecutor:
+    name = "slurm"
+    # squeue/sacct may not list a job right after submission or while accounting lags
+    unseen_grace = readiness.VISIBILITY_TIMEOUT
+
+    def submit(self, script, work_dir=".", job_name=None, array=None, env=None, dependency=None):
+        cmd = ["sbatch", "--parsable"]
+        if job_name:
+            cmd.append(f"--job-name={job_name}")
+        if array:
+            cmd.append(f"--array={array}")
+        cmd.append("--export=ALL" + "".join(f",{key}={value}" for key, value in (env or {}).items()))
+        if dependency:
+            cmd.append("--dependency=afterany:" + ":".join(dependency))
+        cmd.append(script)
+
+        try:
+            result = subprocess.run(cmd, cwd=work_dir, check=True, capture_output=True, text=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"  [Error] sbatch failed in {work_dir}: {e}")
+            return None
+        return result.stdout.strip().split(";")[0]
+
+    def _query(self, cmd):
+        try:
+            return subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode('utf-8')
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def job_states(self, job_ids):
+        job_ids = [str(job_id) for job_id in job_ids]
+        if not job_ids:
+            return {}
+
+        # One squeue call for everything still queued; array tasks are reported as <id>_<task>
+        tasks = {job_id: [] for job_id in job_ids}
+        output = self._query(["squeue", "-h", "-o", "%i %T", f"--jobs={','.join(job_ids)}"])
+        if output is None:
+            # squeue rejects the whole list once one ID has been purged; list the user's jobs instead
+            output = self._query(["squeue", "-h", "-o", "%i %T", "-u", getpass.getuser()])
+        if output is None:
+            # A failed query is not an empty queue: nothing can be said about these jobs
+            print(f"\n  [Warning] squeue failed; treating {len(job_ids)} job(s) as still queued.")
+            return {job_id: QUERY_FAILED for job_id in job_ids}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) >= 2 and fields[0].split('_')[0] in tasks:
+                tasks[fields[0].split('_')[0]].append(PENDING if fields[1] == PENDING else RUNNING)
+
+        # One sacct call for the exit states of jobs that have left the queue
+        finished = [job_id for job_id in job_ids if not tasks[job_id]]
+        if finished:
+            output = self._query(["sacct", "-X", "-n", "-P", "-o", "JobID,State",
+                                  f"--jobs={','.join(finished)}"])
+            if output is None:
+                print(f"\n  [Warning] sacct failed; exit states of {len(finished)} job(s) unknown.")
+                tasks.update({job_id: [QUERY_FAILED] for job_id in finished})
+                output = ""
+            for line in output.splitlines():
+                fields = line.split('|')
+                if len(fields) >= 2 and fields[0].split('_')[0] in tasks:
+                    state = fields[1].split()[0] if fields[1].strip() else UNKNOWN
+                    tasks[fields[0].split('_')[0]].append(state)
+
+        return {job_id: aggregate_state(tasks[job_id]) for job_id in job_ids}
+
+    def poll_interval(self, default):
+        return default
+
+    def drain(self):
+        pass
+
+class LocalExecutor:
+    name = "local"
+    unseen_grace = 0
+
+    def __init__(self, max_cores=None):
+        self.max_cores = int(max_cores) if max_cores else (os.cpu_count() or 1)
+        self.free_cores = self.max_cores
+        self.cond = threading.Condition()
+        self.jobs = {}
+        self.threads = []
+        self.counter = itertools.count(1)
+
+    def submit(self, script, work_dir=".", job_name=None, array=None, env=None, dependency=None):
+        work_dir = os.path.abspath(work_dir)
+        directives = script_directives(os.path.join(work_dir, script))
+        job_name = job_name or directives.get('job-name', os.path.basename(script))
+        tasks, limit = parse_array(array or directives.get('array'))
+        cores = min(int(directives.get('ntasks', 1)), self.max_cores)
+
+        job_id = f"L{next(self.counter)}"
+        job = {
+            'name': job_name,
+            'tasks': {task: PENDING for task in tasks},
+            'done': threading.Event(),
+            'slots': threading.Semaphore(limit) if limit else None,
+        }
+        with self.cond:
+            self.jobs[job_id] = job
+
+        for task in tasks:
+            thread = threading.Thread(
+                target=self._run_task,
+                args=(job_id, task, script, work_dir, cores, directives.get('output'),
+                      dict(env or {}), list(dependency or [])))
+            thread.start()
+            self.threads.append(thread)
+
+        print(f"    [Local] {job_name}: job {job_id}, {len(tasks)} task(s) x {cores} core(s)")
+        return job_id
+
+    def _run_task(self, job_id, task, script, work_dir, cores, output, env, dependency):
+        job = self.jobs[job_id]
+        for dep in dependency:
+            if dep in self.jobs:
+                self.jobs[dep]['done'].wait()
+
+        if job['slots']:
+            job['slots'].acquire()
+        with self.cond:
+            while self.free_cores < cores:
+                self.cond.wait()
+            self.free_cores -= cores
+            job['tasks'][task] = RUNNING
+
+        task_id = job_id if task is None else f"{job_id}_{task}"
+        log_name = output or ("slurm-%A_%a.out" if task is not None else "slurm-%j.out")
+        log_name = (log_name.replace("%A", job_id).replace("%a", str(task))
+                    .replace("%j", task_id))
+
+        run_env = dict(os.environ)
+        run_env.update({key: str(value) for key, value in env.items()})
+        run_env.update({'SLURM_JOB_NAME': job['name'], 'SLURM_SUBMIT_DIR': work_dir,
+                        'AUTO3RD_NPROC': str(cores)})
+        if task is not None:
+            run_env['SLURM_ARRAY_TASK_ID'] = str(task)
+
+        state = FAILED
+        try:
+            with open(os.path.join(work_dir, log_name), 'w') as log:
+                ret = subprocess.call(["bash", script], cwd=work_dir, env=run_env,
+                                      stdout=log, stderr=subprocess.STDOUT)
+            state = COMPLETED if ret == 0 else FAILED
+        except (IOError, OSError) as e:
+            print(f"  [Error] Local job {task_id} failed to start: {e}")
+        finally:
+            with self.cond:
+                self.free_cores += cores
+                job['tasks'][task] = state
+                if all(s not in ACTIVE_STATES for s in job['tasks'].values()):
+                    job['done'].set()
+                self.cond.notify_all()
+            if job['slots']:
+                job['slots'].release()
+
+    def job_state(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return UNKNOWN
+        with self.cond:
+            return aggregate_state(list(job['tasks'].values()))
+
+    def job_states(self, job_ids):
+        return {str(job_id): self.job_state(str(job_id)) for job_id in job_ids}
+
+    def poll_interval(self, default):
+        return min(default, 5)
+
+    def drain(self):
+        pending = [t for t in self.threads if t.is_alive()]
+        if pending:
+            print(f"--- [Local] Waiting for {len(pending)} local task(s) to finish "
+                  f"({self.max_cores} cores) ---")
+        for thread in self.threads:
+            thread.join()
+        failed = [job_id for job_id in self.jobs if self.job_state(job_id) == FAILED]
+        if failed:
+            print(f"  [Local] {len(failed)} job(s) failed: {', '.join(failed)}")
+
+class ProcessTasks:
+    """Python callables run in worker processes of the controller instead of the queue.
+
+    Each call gets a job ID (P<n>) and reports the same states as queued jobs; a call
+    that returns False or raises counts as FAILED. The tasks die with the controller.
+    """
+    name = "process"
+    unseen_grace = 0
+
+    def __init__(self):
+        self.pool = None
+        self.futures = {}
+        self.counter = itertools.count(1)
+
+    def submit(self, func, args, workers=None):
+        if self.pool is None:
+            # spawn: the controller runs threads (local jobs, submitters) that fork would copy
+            self.pool = ProcessPoolExecutor(max_workers=int(workers or os.cpu_count() or 1),
+                                            mp_context=multiprocessing.get_context('spawn'))
+        job_id = f"{TASK_PREFIX}{next(self.counter)}"
+        self.futures[job_id] = self.pool.submit(func, *args)
+        return job_id
+
+    def job_state(self, job_id):
+        future = self.futures.get(job_id)
+        if future is None:
+            return UNKNOWN
+        if not future.done():
+            return RUNNING if future.running() else PENDING
+        if future.exception() is not None or future.result() is False:
+            return FAILED
+        return COMPLETED
+
+    def job_states(self, job_ids):
+        return {str(job_id): self.job_state(str(job_id)) for job_id in job_ids}
+
+    def drain(self):
+        pending = [f for f in self.futures.values() if not f.done()]
+        if pending:
+            print(f"--- [Process] Waiting for {len(pending)} in-process task(s) to finish ---")
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        failed = [job_id for job_id in self.futures if self.job_state(job_id) == FAILED]
+        if failed:
+            print(f"  [Process] {len(failed)} task(s) failed: {', '.join(failed)}")
+
+class JobRegistry:
+    def __init__(self, path=REGISTRY_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stages = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.stages = json.load(f).get('stages', {})
+            except (IOError, OSError, ValueError):
+                print(f"  [Warning] Ignoring unreadable job registry '{path}'.")
+
+    def _save(self):
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump({'stages': self.stages}, f, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+
+    def begin_stage(self, stage):
+        with self.lock:
+            self.stages[stage] = []
+            self._save()
+
+    def record(self, stage, job_id, name, work_dir, backend):
+        with self.lock:
+            self.stages.setdefault(stage, []).append({
+                'id': job_id,
+                'name': name,
+                'work_dir': os.path.relpath(os.path.abspath(work_dir)),
+                'backend': backend,
+                'submitted': time.time(),
+            })
+            self._save()
+
+    def jobs(self, stage):
+        with self.lock:
+            return list(self.stages.get(stage, []))
+
+_current = SlurmExecutor()
+_tasks = ProcessTasks()
+_registry = None
+_submit_workers = SUBMIT_WORKERS
+_unseen_since = {}
+
+def configure(config):
+    global _current, _submit_workers
+    config = config or {}
+    backend = config.get('BACKEND', 'slurm')
+    if backend == 'local':
+        _current = LocalExecutor(config.get('LOCAL_CORES'))
+    elif backend == 'slurm':
+        _current = SlurmExecutor()
+    else:
+        print(f"Error: Unknown executor backend '{backend}', using slurm.")
+        _current = SlurmExecutor()
+    _submit_workers = int(config.get('SUBMIT_WORKERS', SUBMIT_WORKERS))
+    return _current
+
+def get_executor():
+    return _current
+
+def registry():
+    global _registry
+    if _registry is None:
+        _registry = JobRegistry()
+    return _registry
+
+def submit(stage, script, work_dir=".", job_name=None, array=None, env=None, dependency=None):
+    job_id = _current.submit(script, work_dir, job_name, array, env, dependency)
+    if job_id is not None:
+        registry().record(stage, job_id, job_name or os.path.basename(script), work_dir,
+                          _current.name)
+    return job_id
+
+def submit_batch(stage, requests):
+    """Submit many jobs concurrently; returns the job IDs (None on failure) in request order."""
+    if not requests:
+        return []
+    workers = max(1, min(_submit_workers, len(requests)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda request: submit(stage, **request), requests))
+
+def submit_call(stage, func, args, work_dir=".", job_name=None, workers=None):
+    """Run func(*args) in a controller worker process; tracked like a submitted job."""
+    job_id = _tasks.submit(func, args, workers)
+    registry().record(stage, job_id, job_name or func.__name__, work_dir, _tasks.name)
+    return job_id
+
+def in_process(job_id):
+    return str(job_id).startswith(TASK_PREFIX)
+
+def job_states(job_ids):
+    """States of backend jobs and in-process tasks alike."""
+    job_ids = [str(job_id) for job_id in job_ids]
+    states = _tasks.job_states([j for j in job_ids if in_process(j)])
+    states.update(_current.job_states([j for j in job_ids if not in_process(j)]))
+    return states
+
+def still_active(job_id, state):
+    """Whether a job may still be running: queued, unqueryable, or unseen for too short a time."""
+    job_id = str(job_id)
+    if state != UNKNOWN:
+        _unseen_since.pop(job_id, None)
+        return state not in TERMINAL_STATES
+    grace = (_tasks if in_process(job_id) else _current).unseen_grace
+    return time.time() - _unseen_since.setdefault(job_id, time.time()) < grace
+
+def has_ended(job_id, state):
+    """Whether a job has positively ended: a terminal state, or gone from a backend that
+    knows all of its jobs. A failed or empty query never counts."""
+    if state in TERMINAL_STATES:
+        return True
+    return state == UNKNOWN and (_tasks if in_process(job_id) else _current).unseen_grace == 0
+
+def drain():
+    _tasks.drain()
+    _current.drain()
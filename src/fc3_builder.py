@@ -1,38 +1,115 @@
 import os
 import glob
 import re
-import subprocess
 import shutil
+from src import disp_archive
+from src import executor
+from src import fc3_reaper
+from src import sow_engine
+from src import structure
+from src import symmetry
 
-def run_reaping(config_object, sub_gen_script):
+STAGE = "fc3"
+REAP_WORKERS = 4
+
+def folder_name(config):
+    na, nb, nc, cut = config
+    return f"thirdorder_{na}{nb}{nc}_{cut}"
+
+def derive_sources(config_object, configs=None):
+    """{folder: source folder} for REAP_MODE = "derive".
+
+    Per supercell only the config with the largest cutoff radius is reaped; every other
+    cutoff of that supercell is filtered from its FORCE_CONSTANTS_3RD.
+    """
+    if not hasattr(config_object, 'get') or config_object.get('cell', 'REAP_MODE', 'each') != 'derive':
+        return {}
+    configs = configs if configs is not None else config_object.get('cell', 'configs') or []
+    unit = structure.read_unit_cell(config_object.get('cell', 'base_input'))
+    if unit is None:
+        print("  [Warning] Cannot read the unit cell; every folder is reaped on its own.")
+        return {}
+
+    by_grid = {}
+    for config in configs:
+        na, nb, nc, cut = (int(x) for x in config)
+        sposcar = sow_engine.build_supercell(unit, na, nb, nc)
+        frange = sow_engine.calc_frange(sposcar, cut)
+        by_grid.setdefault((na, nb, nc), []).append((frange, folder_name((na, nb, nc, cut))))
+
+    sources = {}
+    for entries in by_grid.values():
+        source = max(entries)[1]
+        for _, folder in entries:
+            if folder != source:
+                sources[folder] = source
+    return sources
+
+def run_reaping(config_object, sub_gen_script, folders=None, redo=(), configs=None, derive=True):
     print("-" * 60)
     print("--- Submitting Force Constants Generation Jobs (Phase 3) ---")
 
     if hasattr(config_object, 'get'):
         thirdorder_bin = config_object.get('cell', 'THIRDORDER_BIN')
         base_input = config_object.get('cell', 'base_input')
+        engine = config_object.get('cell', 'REAP_ENGINE', 'thirdorder')
+        workers = config_object.get('cell', 'REAP_WORKERS', REAP_WORKERS)
+        symprec = float(config_object.get('cell', 'SYMPREC') or symmetry.DEFAULT_SYMPREC)
     else:
         thirdorder_bin = "thirdorder_espresso.py"
         base_input = "base.scf.in"
+        engine, workers, symprec = 'thirdorder', REAP_WORKERS, symmetry.DEFAULT_SYMPREC
+    sources = derive_sources(config_object, configs) if derive else {}
+    verify = bool(sources) and bool(config_object.get('cell', 'DERIVE_VERIFY', False))
 
-    if not os.path.exists(sub_gen_script):
+    native = engine == 'native'
+    if not native and not os.path.exists(sub_gen_script):
         print(f"Error: Submission script '{sub_gen_script}' not found.")
-        return
+        return {}
 
     script_basename = os.path.basename(sub_gen_script)
     pattern = re.compile(r"thirdorder_(\d+)_(-?\d+)")
-    all_folders = sorted(glob.glob("thirdorder_*"))
+    all_folders = sorted(folders if folders is not None else glob.glob("thirdorder_*"))
     
-    submit_count = 0
     base_in_name = os.path.basename(base_input)
+    requests = []
+    derived = []
 
     for folder in all_folders:
-        if not pattern.match(folder): continue
+        match = pattern.match(folder)
+        if not match: continue
 
         fc3_path = os.path.join(folder, "FORCE_CONSTANTS_3RD")
-        if os.path.exists(fc3_path) and os.path.getsize(fc3_path) > 100:
+        if os.path.exists(fc3_path) and os.path.getsize(fc3_path) > 100 and folder not in redo:
             print(f"  [Skip] {folder}: FORCE_CONSTANTS_3RD exists.")
             continue
+        if folder in redo and os.path.exists(fc3_path):
+            # Left behind by a job that was never verified; sub_gen.sh would skip it otherwise
+            print(f"  [Redo] {folder}: discarding unverified FORCE_CONSTANTS_3RD.")
+            os.remove(fc3_path)
+
+        grid = match.group(1)
+        config = (int(grid[0]), int(grid[1]), int(grid[2]), int(match.group(2)))
+        folder_base = os.path.join(folder, base_in_name)
+        folder_base = folder_base if os.path.exists(folder_base) else base_input
+        source = sources.get(folder)
+        if source:
+            source_fc3 = os.path.join(source, "FORCE_CONSTANTS_3RD")
+            if not (os.path.exists(source_fc3) and os.path.getsize(source_fc3) > 100) or source in redo:
+                print(f"  [Wait] {folder}: derived from {source} once its FORCE_CONSTANTS_3RD exists.")
+                continue
+            derived.append({'folder': folder, 'source': source,
+                            'args': (folder, source, folder_base, config, symprec, verify)})
+            continue
+
+        if native:
+            requests.append({'folder': folder, 'args': (folder, folder_base, config, symprec)})
+            continue
+
+        if disp_archive.is_packed(folder):
+            missing = disp_archive.export_classic(folder)
+            print(f"  [Export] {folder}: packed archive -> classic DISP.* layout for reap"
+                  + (f" ({missing} outputs missing)" if missing else ""))
 
         target_script = os.path.join(folder, script_basename)
         try:
@@ -41,29 +118,38 @@ def run_reaping(config_object, sub_gen_script):
             print(f"  [Error] Failed to copy script to {folder}: {e}")
             continue
 
-        cwd = os.getcwd()
-        try:
-            os.chdir(folder)
-
-            export_vars = f"ALL,BASE_INPUT_NAME={base_in_name},THIRDORDER_BIN={thirdorder_bin}"
-            
-            cmd = [
-                "sbatch",
-                f"--export={export_vars}",
-                script_basename
-            ]
-            subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
-            print(f"  [Sub] Submitted job for {folder}")
-            submit_count += 1
-            
-        except subprocess.CalledProcessError as e:
-            print(f"  [Error] Failed to submit in {folder}: {e}")
-        finally:
-            os.chdir(cwd)
+        export_vars = {'BASE_INPUT_NAME': base_in_name, 'THIRDORDER_BIN': thirdorder_bin}
+        requests.append({'script': script_basename, 'work_dir': folder, 'env': export_vars})
+
+    if folders is None:
+        executor.registry().begin_stage(STAGE)
+    submitted = {}
+    if native:
+        # Reaped in worker processes of the controller; reap.out carries the usual markers
+        for request in requests:
+            job_id = executor.submit_call(STAGE, fc3_reaper.reap_folder, request['args'],
+                                          request['folder'], "Native_FC3", workers)
+            print(f"  [Reap] Native reap {job_id} for {request['folder']}")
+            submitted[request['folder']] = job_id
+        requests = []
+    for request in derived:
+        # Filtering an existing reap takes seconds: always done in-process
+        job_id = executor.submit_call(STAGE, fc3_reaper.derive_folder, request['args'],
+                                      request['folder'], "Derive_FC3", workers)
+        print(f"  [Derive] {job_id} for {request['folder']} from {request['source']}")
+        submitted[request['folder']] = job_id
+    for request, job_id in zip(requests, executor.submit_batch(STAGE, requests)):
+        if job_id is None:
+            print(f"  [Error] Failed to submit in {request['work_dir']}")
+            continue
+        print(f"  [Sub] Submitted job {job_id} for {request['work_dir']}")
+        submitted[request['work_dir']] = job_id
+    submit_count = len(submitted)
 
     if submit_count == 0:
         print("No new jobs submitted (all folders seem complete).")
     else:
         print(f"--- Successfully submitted {submit_count} jobs. ---")
         print(f"Logs are located inside each folder.")
-    print("-" * 60)
\ No newline at end of file
+    print("-" * 60)
+    return submitted
@@ -0,0 +1,196 @@
+import os
+import re
+import json
+import contextlib
+import numpy as np
+from src import bte_runner, executor, fc3_reaper, symmetry, workflow_state
+
+PRUNED_FILE = "FORCE_CONSTANTS_3RD.pruned"
+PRUNE_RECORD = "fc3_prune.json"
+PRUNE_LOG = "prune.out"
+BENCH_STAGE = "bte_bench"
+BENCH_REPORT = "prune_benchmark.json"
+WALL_RE = re.compile(r"ShengBTE wall time:\s*(\d+)\s*s")
+
+def _settings(config_object):
+    base_input = config_object.get('cell', 'base_input')
+    symprec = float(config_object.get('cell', 'SYMPREC') or symmetry.DEFAULT_SYMPREC)
+    return base_input, symprec
+
+def _config_of(folder):
+    match = re.match(r"thirdorder_(\d)(\d)(\d)_(-?\d+)$", os.path.basename(folder))
+    return tuple(int(x) for x in match.groups()) if match else None
+
+def _folder_base(folder, base_input):
+    local = os.path.join(folder, os.path.basename(base_input))
+    return local if os.path.exists(local) else base_input
+
+def prune_file(source, output, record_path, base_input, config, threshold, symprec, log_path):
+    """Prune `source` into `output` unless `record_path` shows it is already up to date."""
+    signature = workflow_state.file_signature(source)
+    if os.path.exists(record_path) and os.path.exists(output):
+        try:
+            with open(record_path, 'r') as f:
+                record = json.load(f)
+            if record.get('threshold') == threshold and record.get('source') == signature:
+                return record
+        except (IOError, OSError, ValueError):
+            pass
+
+    with open(log_path, 'w') as log, contextlib.redirect_stdout(log):
+        stats = fc3_reaper.prune(source, output, base_input, config, threshold, symprec)
+    record = {'threshold': threshold, 'source': signature,
+              'removed_blocks': stats['blocks_before'] - stats['blocks_after'], **stats}
+    with open(record_path + ".tmp", 'w') as f:
+        json.dump(record, f, indent=1)
+    os.replace(record_path + ".tmp", record_path)
+    return record
+
+def run_pruning(config_object, folders=None):
+    """Prune the FC3 of `folders` with &cell PRUNE_THRESHOLD.
+
+    Returns {folder: FC3 file name ShengBTE should use}; empty when pruning is off. A folder
+    that cannot be pruned keeps its full FORCE_CONSTANTS_3RD.
+    """
+    threshold = config_object.get('cell', 'PRUNE_THRESHOLD')
+    if threshold is None:
+        return {}
+    threshold = float(threshold)
+    base_input, symprec = _settings(config_object)
+
+    if folders is None:
+        folders = sorted(f for f in os.listdir(".") if _config_of(f))
+    print(f"--- Pruning FORCE_CONSTANTS_3RD (blocks below {threshold:g} x max |phi|) ---")
+    chosen = {}
+    for folder in folders:
+        source = os.path.join(folder, fc3_reaper.FC3_FILE)
+        config = _config_of(folder)
+        if config is None or not os.path.exists(source):
+            continue
+        try:
+            record = prune_file(source, os.path.join(folder, PRUNED_FILE),
+                                os.path.join(folder, PRUNE_RECORD), _folder_base(folder, base_input),
+                                config, threshold, symprec, os.path.join(folder, PRUNE_LOG))
+        except (ValueError, IOError, OSError, np.linalg.LinAlgError) as e:
+            print(f"  [Warning] {folder}: pruning failed ({e}); using the full FC3.")
+            continue
+        print(f"  [Prune] {folder}: {record['removed_blocks']} of {record['blocks_before']} blocks "
+              f"removed, ASR residual {record['asr_residual']:.1e}")
+        chosen[folder] = PRUNED_FILE
+    return chosen
+
+def _bench_setup(config_object, submit_cfg):
+    thresholds = [float(t) for t in config_object.get('cell', 'PRUNE_BENCHMARK') or []]
+    configs = [tuple(int(x) for x in c) for c in config_object.get('cell', 'configs') or []]
+    chosen = config_object.get('cell', 'PRUNE_BENCH_CONFIG')
+    if chosen:
+        config = tuple(int(x) for x in chosen)
+    else:
+        done = [c for c in configs if os.path.exists(
+            os.path.join(f"thirdorder_{c[0]}{c[1]}{c[2]}_{c[3]}", fc3_reaper.FC3_FILE))]
+        config = done[-1] if done else None
+    if config is None:
+        return None, None, []
+    folder = f"thirdorder_{config[0]}{config[1]}{config[2]}_{config[3]}"
+    bench_dir = os.path.join(submit_cfg.get('WORK_DIR', 'ShengBTE'),
+                             folder.replace("thirdorder_", "prune_bench_", 1))
+    # Threshold 0 is the unpruned reference
+    return folder, bench_dir, [0.0] + sorted(set(thresholds) - {0.0})
+
+def run_benchmark(config_object, submit_cfg):
+    """Submit one ShengBTE task per PRUNE_BENCHMARK threshold (and an unpruned reference)."""
+    folder, bench_dir, thresholds = _bench_setup(config_object, submit_cfg)
+    if folder is None or len(thresholds) < 2:
+        print("Error: PRUNE_BENCHMARK needs thresholds and a config with FORCE_CONSTANTS_3RD.")
+        return {}
+    base_input, symprec = _settings(config_object)
+    target = submit_cfg.get('TARGET_RESULT', 'BTE.KappaTensorVsT_CONV')
+    source = os.path.join(folder, fc3_reaper.FC3_FILE)
+
+    print(f"--- Pruning benchmark on {folder}: thresholds {', '.join(f'{t:g}' for t in thresholds)} ---")
+    requests = []
+    for threshold in thresholds:
+        task_dir = os.path.join(bench_dir, f"thr_{threshold:g}")
+        if os.path.exists(os.path.join(task_dir, target)):
+            print(f"  [Skip] {task_dir}: Result exists.")
+            continue
+        os.makedirs(task_dir, exist_ok=True)
+        fc3_path = source
+        if threshold > 0:
+            fc3_path = os.path.join(task_dir, PRUNED_FILE)
+            try:
+                prune_file(source, fc3_path, os.path.join(task_dir, PRUNE_RECORD),
+                           _folder_base(folder, base_input), _config_of(folder), threshold, symprec,
+                           os.path.join(task_dir, PRUNE_LOG))
+            except (ValueError, IOError, OSError, np.linalg.LinAlgError) as e:
+                print(f"  [Error] {task_dir}: pruning failed ({e})")
+                continue
+        script = bte_runner.prepare_task(task_dir, submit_cfg.get('CONTROL_FILE', 'CONTROL'),
+                                         submit_cfg.get('IFC2_FILE', 'espresso.ifc2'), fc3_path,
+                                         submit_cfg.get('SUB_SCRIPT', 'templates/sub_sheng.sh'))
+        requests.append({'script': script, 'work_dir': task_dir, 'job_name': f"KB_{threshold:g}"})
+
+    submitted = {}
+    for request, job_id in zip(requests, executor.submit_batch(BENCH_STAGE, requests)):
+        if job_id is None:
+            print(f"  [Error] Failed to submit {request['work_dir']}")
+            continue
+        print(f"  [Sub] {request['work_dir']}: job {job_id}")
+        submitted[request['work_dir']] = job_id
+    return submitted
+
+def _wall_seconds(task_dir):
+    try:
+        with open(os.path.join(task_dir, "shengbte.out"), 'r', errors='ignore') as f:
+            match = WALL_RE.search(f.read())
+    except (IOError, OSError):
+        return None
+    return int(match.group(1)) if match else None
+
+def _block_count(path):
+    try:
+        with open(path, 'r') as f:
+            return int(f.readline().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def report_benchmark(config_object, submit_cfg):
+    """Runtime and kappa change relative to the unpruned run, per finished threshold."""
+    folder, bench_dir, thresholds = _bench_setup(config_object, submit_cfg)
+    if folder is None:
+        return None
+    target = submit_cfg.get('TARGET_RESULT', 'BTE.KappaTensorVsT_CONV')
+
+    def kappa(task_dir):
+        path = os.path.join(task_dir, target)
+        try:
+            return np.loadtxt(path, ndmin=2) if os.path.exists(path) else None
+        except ValueError:
+            return None
+
+    reference = kappa(os.path.join(bench_dir, "thr_0"))
+    rows = []
+    print(f"\n--- Pruning benchmark: {folder} ---")
+    print(f"  {'Threshold':>10} | {'Blocks':>8} | {'Wall (s)':>9} | {'Max kappa change':>16}")
+    for threshold in thresholds:
+        task_dir = os.path.join(bench_dir, f"thr_{threshold:g}")
+        values = kappa(task_dir)
+        change = None
+        if values is not None and reference is not None and values.shape == reference.shape:
+            scale = np.maximum(np.abs(reference[:, 1:]), 1e-12)
+            change = float((np.abs(values[:, 1:] - reference[:, 1:]) / scale).max())
+        row = {'threshold': threshold, 'blocks': _block_count(os.path.join(task_dir, "FORCE_CONSTANTS_3RD")),
+               'wall_seconds': _wall_seconds(task_dir), 'kappa_change': change,
+               'finished': values is not None}
+        rows.append(row)
+        shown = "pending" if not row['finished'] else ("n/a" if change is None else f"{change * 100:.3f}%")
+        wall = "n/a" if row['wall_seconds'] is None else str(row['wall_seconds'])
+        blocks = "n/a" if row['blocks'] is None else str(row['blocks'])
+        print(f"  {threshold:>10g} | {blocks:>8} | {wall:>9} | {shown:>16}")
+
+    os.makedirs(bench_dir, exist_ok=True)
+    with open(os.path.join(bench_dir, BENCH_REPORT), 'w') as f:
+        json.dump({'config': folder, 'rows': rows}, f, indent=1)
+    if not all(row['finished'] for row in rows):
+        print("  [WAIT] Run prune_bench again once the remaining ShengBTE jobs are finished.")
+    return rows
@@ -0,0 +1,434 @@
+import os
+import itertools
+import contextlib
+import numpy as np
+from src import disp_archive, fc3_store, pw_output, sow_engine, structure, symmetry
+
+FC3_FILE = "FORCE_CONSTANTS_3RD"
+REAP_LOG = "reap.out"
+RY_BOHR_TO_EV_ANG = 25.71104309541616
+MATCH_TOLERANCE = 0.1
+DISP_THRESHOLD = 1.0e-5
+ASR_TOLERANCE = 1.0e-10
+ASR_MAX_ITER = 500
+CHUNK_ROWS = 4096
+VERIFY_FILE = "FORCE_CONSTANTS_3RD.reaped"
+
+def cell_table(grid):
+    """Integer cell offsets in the order used by sow_engine.build_supercell."""
+    na, nb, nc = grid
+    return np.array([(i, j, k) for k, j, i in itertools.product(range(nc), range(nb), range(na))])
+
+class Layout:
+    """Supercell atom <-> (cell, unit atom) bookkeeping; atom = cell * natoms_unit + unit atom."""
+
+    def __init__(self, sposcar, grid):
+        self.grid = np.array(grid)
+        self.nu = sposcar['natoms_unit']
+        self.natoms = len(sposcar['frac'])
+        cells = cell_table(grid)
+        self.atom_cell = np.repeat(cells, self.nu, axis=0)
+        self.atom_unit = np.tile(np.arange(self.nu), len(cells))
+
+    def cell_index(self, cells):
+        cells = np.mod(cells, self.grid)
+        return cells[..., 0] + self.grid[0] * (cells[..., 1] + self.grid[1] * cells[..., 2])
+
+    def reduce(self, triplets):
+        """Translate triplets so that their first atom lies in the reference cell."""
+        origin = self.atom_cell[triplets[..., 0]]
+        cells = self.atom_cell[triplets] - origin[..., None, :]
+        return self.cell_index(cells) * self.nu + self.atom_unit[triplets]
+
+    def encode(self, triplets):
+        n = self.natoms
+        return (triplets[..., 0].astype(np.int64) * n + triplets[..., 1]) * n + triplets[..., 2]
+
+def supercell_operations(unit, layout, symprec=symmetry.DEFAULT_SYMPREC):
+    """Space-group operations of the unit cell as (Cartesian rotation, supercell permutation).
+
+    Pure lattice translations are left out (triplets are stored translation-reduced), and
+    so are rotations that do not map the supercell onto itself.
+    """
+    grid = layout.grid
+    cells = cell_table(grid)
+    operations = []
+    for op in symmetry.find_symmetry_operations(unit['lattice'], unit['frac'], unit['species'],
+                                                 symprec):
+        W = op['frac_rotation']
+        if np.any((W * grid[None, :]) % grid[:, None]):
+            continue
+        shifts = np.rint(unit['frac'] @ W.T + op['translation'] - unit['frac'][op['perm']]).astype(int)
+        target = (cells @ W.T)[:, None, :] + shifts[None, :, :]
+        perm = layout.cell_index(target) * layout.nu + op['perm'][None, :]
+        operations.append((op['rotation'], perm.reshape(-1)))
+    return operations
+
+class Orbits:
+    """Triplets grouped into orbits under the space group and index permutations.
+
+    Every triplet t carries the 27x27 matrix mats[op_of[t]] that maps the (flattened)
+    force constants of its orbit representative onto its own.
+    """
+
+    def __init__(self, triplets, operations, layout):
+        self.triplets = triplets
+        self.codes = layout.encode(triplets)
+        nt = len(triplets)
+
+        images = []
+        mats = []
+        for (rotation, perm), order in itertools.product(operations, itertools.permutations(range(3))):
+            mapped = layout.reduce(perm[triplets][:, order])
+            images.append(self.lookup(layout.encode(mapped)))
+            kron = np.kron(np.kron(rotation, rotation), rotation)
+            mats.append(sow_engine.axis_permutation(order) @ kron)
+        images = np.array(images)
+        self.mats = np.array(mats)
+
+        rep = np.where(images < 0, nt, images).min(axis=0)
+        self.reps = np.unique(rep)
+        self.rep_id = np.searchsorted(self.reps, rep)
+        self.op_of = np.full(nt, -1)
+        proj = np.zeros((len(self.reps), 27, 27))
+        stabilizer = np.zeros(len(self.reps))
+        for g, targets in enumerate(images[:, self.reps]):
+            found = targets >= 0
+            fresh = np.zeros(len(targets), dtype=bool)
+            fresh[found] = self.op_of[targets[found]] < 0
+            self.op_of[targets[fresh]] = g
+            fixed = targets == self.reps
+            proj[fixed] += self.mats[g]
+            stabilizer[fixed] += 1
+        if np.any(self.op_of < 0):
+            raise ValueError("symmetry operations do not close over the triplet list")
+        self.proj = proj / stabilizer[:, None, None]
+        self.members = np.bincount(self.rep_id, minlength=len(self.reps))
+        self.groups = [(g, np.nonzero(self.op_of == g)[0]) for g in np.unique(self.op_of)]
+
+    def lookup(self, codes):
+        pos = np.searchsorted(self.codes, codes).clip(0, len(self.codes) - 1)
+        return np.where(self.codes[pos] == codes, pos, -1)
+
+    def expand(self, phi_rep):
+        phi = np.empty((len(self.triplets), 27))
+        for g, sel in self.groups:
+            phi[sel] = phi_rep[self.rep_id[sel]] @ self.mats[g].T
+        return phi
+
+    def symmetrize(self, phi):
+        """Closest set of representatives to `phi` (orthogonal projection)."""
+        acc = np.zeros((len(self.reps), 27))
+        for g, sel in self.groups:
+            np.add.at(acc, self.rep_id[sel], phi[sel] @ self.mats[g])
+        acc /= self.members[:, None]
+        return np.einsum('rij,rj->ri', self.proj, acc)
+
+def read_measurements(folder, sposcar, layout):
+    """Second derivatives of the forces from every displaced pair found in `folder`.
+
+    The displacement of each DISP.* input is read from its structure, so the mapping does
+    not depend on the file order of the sow. Returns ({(i, a, j, b): dF (natoms x 3)}, h).
+    """
+    lattice = sposcar['lattice']
+    sites = sposcar['frac']
+    nat = layout.natoms
+    paths = disp_archive.input_paths(folder)
+    if not paths:
+        raise ValueError(f"no DISP.* inputs in {folder}")
+
+    records = pw_output.load_bundle(folder)
+    order = None
+    runs = {}
+    zero = []
+    steps = []
+    for path in paths:
+        name = disp_archive.split_path(path)[1]
+        struct = structure.read_pw_structure(path)
+        frac = structure.fractional_positions(struct) if struct else None
+        if frac is None or len(frac) != nat:
+            raise ValueError(f"{name}: cannot read a {nat}-atom structure")
+        record = records.get(name)
+        if record is None or record['forces'] is None or len(record['forces']) != nat:
+            raise ValueError(f"{name}: no force block in the output")
+
+        if order is None:
+            delta = frac[:, None, :] - sites[None, :, :]
+            dist = np.linalg.norm((delta - np.rint(delta)) @ lattice, axis=2)
+            order = dist.argmin(axis=1)
+            if len(np.unique(order)) != nat or dist[np.arange(nat), order].max() > MATCH_TOLERANCE:
+                raise ValueError(f"{name}: atoms do not match the supercell of the base input")
+        forces = np.empty((nat, 3))
+        forces[order] = record['forces'] * RY_BOHR_TO_EV_ANG
+
+        delta = frac - sites[order]
+        disp = np.zeros((nat, 3))
+        disp[order] = (delta - np.rint(delta)) @ lattice
+        moved = [(int(atom), int(axis), disp[atom, axis])
+                 for atom, axis in zip(*np.nonzero(np.abs(disp) > DISP_THRESHOLD))]
+
+        if not moved:
+            zero.append(forces)
+        elif len(moved) == 1:
+            atom, axis, value = moved[0]
+            # Same atom and direction twice: (+,+) and (-,-) move it by 2h, (+,-) not at all
+            runs.setdefault((atom, axis, atom, axis), {})[(value > 0, value > 0)] = forces
+            steps.append(abs(value) / 2)
+        elif len(moved) == 2:
+            (i, a, vi), (j, b, vj) = moved
+            runs.setdefault((i, a, j, b), {})[(vi > 0, vj > 0)] = forces
+            steps.extend((abs(vi), abs(vj)))
+        else:
+            raise ValueError(f"{name}: {len(moved)} displaced coordinates, expected at most two")
+
+    h = float(np.mean(steps)) if steps else sow_engine.H_DISPLACEMENT
+    if steps and np.ptp(steps) > 1e-3 * h:
+        raise ValueError("displacement amplitudes differ between DISP.* inputs")
+    reference = np.mean(zero, axis=0) if zero else np.zeros((nat, 3))
+
+    measured = {}
+    for key, signs in runs.items():
+        i, a, j, b = key
+        if i == j and a == b:
+            signs.setdefault((True, False), reference)
+            signs.setdefault((False, True), reference)
+        if len(signs) != 4:
+            raise ValueError(f"incomplete displacement set for atoms {i + 1}/{j + 1}")
+        measured[key] = -(signs[(True, True)] - signs[(True, False)]
+                          - signs[(False, True)] + signs[(False, False)]) / (4.0 * h * h)
+    return measured, h
+
+def solve(orbits, measured, layout):
+    """Least-squares fit of the irreducible force constants to all measured derivatives."""
+    nrep = len(orbits.reps)
+    nat = layout.natoms
+    rows_t, rows_ab, rows_rhs = [], [], []
+    for (i, a, j, b), dF in measured.items():
+        triplets = np.column_stack((np.full(nat, i), np.full(nat, j), np.arange(nat)))
+        t = orbits.lookup(layout.encode(layout.reduce(triplets)))
+        keep = t >= 0
+        rows_t.append(t[keep])
+        rows_ab.append(np.full(keep.sum(), a * 3 + b))
+        rows_rhs.append(dF[keep])
+    rows_t = np.concatenate(rows_t)
+    rows_ab = np.concatenate(rows_ab)
+    rows_rhs = np.concatenate(rows_rhs)
+
+    ata = np.zeros((nrep, 27, 27))
+    atb = np.zeros((nrep, 27))
+    for start in range(0, len(rows_t), CHUNK_ROWS):
+        t = rows_t[start:start + CHUNK_ROWS]
+        index = rows_ab[start:start + CHUNK_ROWS, None] * 3 + np.arange(3)[None, :]
+        rows = orbits.mats[orbits.op_of[t][:, None], index, :]
+        np.add.at(ata, orbits.rep_id[t], np.einsum('cki,ckj->cij', rows, rows))
+        np.add.at(atb, orbits.rep_id[t], np.einsum('cki,ck->ci', rows, rows_rhs[start:start + CHUNK_ROWS]))
+
+    phi_rep = np.zeros((nrep, 27))
+    unresolved = 0
+    for r in range(nrep):
+        w, v = np.linalg.eigh(orbits.proj[r])
+        basis = v[:, w > 0.5]
+        orbits.proj[r] = basis @ basis.T
+        if not basis.shape[1]:
+            continue
+        coeff, _, rank, _ = np.linalg.lstsq(basis.T @ ata[r] @ basis, basis.T @ atb[r], rcond=1e-10)
+        if rank < basis.shape[1]:
+            unresolved += 1
+        phi_rep[r] = basis @ coeff
+    return phi_rep, unresolved
+
+def impose_asr(orbits, phi, layout):
+    """Alternate projections onto the acoustic sum rule and the symmetric subspace.
+
+    Returns (phi, residual, iterations); the result obeys sum_k Phi(i,j,k) = 0 and all
+    space-group and permutation relations.
+    """
+    triplets = orbits.triplets
+    pairs, pair_of = np.unique(triplets[:, 0] * layout.natoms + triplets[:, 1], return_inverse=True)
+    count = np.bincount(pair_of, minlength=len(pairs))[:, None]
+    scale = max(np.abs(phi).max(), 1e-30)
+
+    residual = 0.0
+    for iteration in range(ASR_MAX_ITER + 1):
+        sums = np.zeros((len(pairs), 27))
+        np.add.at(sums, pair_of, phi)
+        residual = np.abs(sums).max() / scale
+        if residual <= ASR_TOLERANCE or iteration == ASR_MAX_ITER:
+            break
+        phi = orbits.expand(orbits.symmetrize(phi - (sums / count)[pair_of]))
+    return phi, residual, iteration
+
+def write_fc3(path, phi, orbits, layout, sposcar, frange, sparse=False):
+    """Write FORCE_CONSTANTS_3RD in the block layout of thirdorder (Angstrom, eV/A^3).
+
+    Like thirdorder, every pair of neighbours within `frange` gets a block, zero when it is
+    not a listed triplet; with `sparse` only the listed triplets are written.
+    """
+    lattice = sposcar['lattice']
+    sites = sposcar['frac']
+    nu = layout.nu
+    shifts = np.array(list(itertools.product((-1, 0, 1), repeat=3)), dtype=float)
+    images = sites[None, :, :] + shifts[:, None, :]
+    dist = np.linalg.norm((images[None, :, :, :] - sites[:nu, None, None, :]) @ lattice, axis=3)
+    dmin = dist.min(axis=1)
+    index = {tuple(t): n for n, t in enumerate(orbits.triplets.tolist())}
+    zero = np.zeros(27)
+
+    blocks = []
+    for ii in range(nu):
+        near = np.nonzero(dmin[ii] < frange)[0]
+        equiv = {jj: np.nonzero(dist[ii, :, jj] - dmin[ii, jj] < sow_engine.SHELL_TOLERANCE)[0] for jj in near}
+        for jj, kk in itertools.product(near, near):
+            n = index.get((ii, int(jj), int(kk)))
+            if n is None and sparse:
+                continue
+            values = zero if n is None else phi[n]
+            pj = images[equiv[jj], jj] @ lattice
+            pk = images[equiv[kk], kk] @ lattice
+            d2 = ((pk[None, :, :] - pj[:, None, :]) ** 2).sum(axis=2)
+            for sj, sk in zip(*np.nonzero(d2 - d2.min() < sow_engine.SHELL_TOLERANCE)):
+                jatom, katom = jj % nu, kk % nu
+                rj = (images[equiv[jj][sj], jj] - sites[jatom]) @ lattice
+                rk = (images[equiv[kk][sk], kk] - sites[katom]) @ lattice
+                blocks.append((rj, rk, ii + 1, jatom + 1, katom + 1, values))
+
+    with open(path + ".tmp", 'w') as f:
+        f.write(f"{len(blocks):>5}\n")
+        for n, (rj, rk, i, j, k, values) in enumerate(blocks, 1):
+            f.write(f"\n{n:>5}\n")
+            f.write("{:15.10f} {:15.10f} {:15.10f}\n".format(*rj))
+            f.write("{:15.10f} {:15.10f} {:15.10f}\n".format(*rk))
+            f.write(f"{i:>6d} {j:>6d} {k:>6d}\n")
+            for (a, b, c), value in zip(itertools.product(range(1, 4), repeat=3), values):
+                f.write(f"{a:>2d} {b:>2d} {c:>2d} {value:>20.10e}\n")
+    os.replace(path + ".tmp", path)
+    return len(blocks)
+
+def fc3_triplet_values(path, orbits, layout, unit_lattice):
+    """Force constants of every triplet of `orbits` as read from a FORCE_CONSTANTS_3RD file.
+
+    Blocks of triplets outside the list are ignored; returns (phi, number of triplets the
+    file does not provide).
+    """
+    blocks = fc3_store.load(path)
+    rj, rk, ijk, values = blocks['rj'], blocks['rk'], blocks['atoms'], blocks['phi']
+    inverse = np.linalg.inv(unit_lattice)
+    nu = layout.nu
+    jj = layout.cell_index(np.rint(rj @ inverse).astype(int)) * nu + ijk[:, 1] - 1
+    kk = layout.cell_index(np.rint(rk @ inverse).astype(int)) * nu + ijk[:, 2] - 1
+    pos = orbits.lookup(layout.encode(np.stack([ijk[:, 0] - 1, jj, kk], axis=1)))
+    inside = pos >= 0
+    phi = np.zeros((len(orbits.triplets), 27))
+    phi[pos[inside]] = values[inside]
+    found = np.zeros(len(orbits.triplets), dtype=bool)
+    found[pos[inside]] = True
+    return phi, int((~found).sum())
+
+def _setup(base_input, config, symprec):
+    na, nb, nc, cut = config
+    unit = structure.read_unit_cell(base_input)
+    if unit is None:
+        raise ValueError(f"cannot read the unit cell from '{base_input}'")
+    sposcar = sow_engine.build_supercell(unit, na, nb, nc)
+    layout = Layout(sposcar, (na, nb, nc))
+    frange = sow_engine.calc_frange(sposcar, cut)
+    triplets = np.array(sorted(sow_engine.find_triplets(sposcar, frange)))
+    print(f"Supercell: {na}x{nb}x{nc} ({layout.natoms} atoms), cutoff {cut} -> {frange:.4f} A")
+
+    operations = supercell_operations(unit, layout, symprec)
+    orbits = Orbits(triplets, operations, layout)
+    print(f"Triplets: {len(triplets)} in {len(orbits.reps)} orbits ({len(operations)} operations)")
+    return unit, sposcar, layout, frange, orbits, operations
+
+def _finish(path, orbits, phi, layout, sposcar, frange, sparse=False):
+    phi, residual, iterations = impose_asr(orbits, phi, layout)
+    print(f"Acoustic sum rule: residual {residual:.2e} after {iterations} iteration(s)")
+    if residual > ASR_TOLERANCE:
+        print("Warning: the sum rule was not reached to the requested tolerance.")
+    nblocks = write_fc3(path, phi, orbits, layout, sposcar, frange, sparse)
+    print(f"Blocks written: {nblocks}")
+    return nblocks, residual
+
+def reap(folder, base_input, config, symprec=symmetry.DEFAULT_SYMPREC, output=FC3_FILE):
+    unit, sposcar, layout, frange, orbits, _ = _setup(base_input, config, symprec)
+    measured, h = read_measurements(folder, sposcar, layout)
+    print(f"Displaced pairs: {len(measured)} (h = {h:.5f} A)")
+    phi_rep, unresolved = solve(orbits, measured, layout)
+    if unresolved:
+        raise ValueError(f"{unresolved} orbit(s) are not determined by the displacements")
+    _finish(os.path.join(folder, output), orbits, orbits.expand(phi_rep), layout, sposcar, frange)
+
+def derive(folder, source, base_input, config, symprec=symmetry.DEFAULT_SYMPREC, verify=False):
+    """FORCE_CONSTANTS_3RD of `folder` filtered from the larger-cutoff reap in `source`.
+
+    Triplets outside the neighbour criterion of this cutoff are dropped and the sum rule is
+    imposed again over the ones that remain. With `verify`, the folder is also reaped from
+    its own outputs and the two results are compared.
+    """
+    unit, sposcar, layout, frange, orbits, _ = _setup(base_input, config, symprec)
+    phi, missing = fc3_triplet_values(os.path.join(source, FC3_FILE), orbits, layout, unit['lattice'])
+    if missing:
+        raise ValueError(f"{missing} triplet(s) are not covered by {source}/{FC3_FILE}")
+    print(f"Derived from: {source}/{FC3_FILE}")
+    _finish(os.path.join(folder, FC3_FILE), orbits, orbits.expand(orbits.symmetrize(phi)),
+            layout, sposcar, frange)
+    if not verify:
+        return
+
+    print("--- Verification: reaping the folder from its own outputs ---")
+    reap(folder, base_input, config, symprec, output=VERIFY_FILE)
+    derived = fc3_triplet_values(os.path.join(folder, FC3_FILE), orbits, layout, unit['lattice'])[0]
+    reaped = fc3_triplet_values(os.path.join(folder, VERIFY_FILE), orbits, layout, unit['lattice'])[0]
+    scale = max(np.abs(reaped).max(), 1e-30)
+    diff = np.abs(derived - reaped).max()
+    print(f"Verification: max |derived - reaped| = {diff:.4e} eV/A^3 "
+          f"({diff / scale * 100:.3f}% of max |phi|), reap kept in {VERIFY_FILE}")
+
+def prune(source, output, base_input, config, threshold, symprec=symmetry.DEFAULT_SYMPREC):
+    """Write `output` without the triplets of `source` whose block norm is below `threshold`
+    times the largest one.
+
+    Whole orbits are dropped (the norm is the same on every member), the sum rule is imposed
+    again over the triplets that remain and only those are written. Returns the block and
+    triplet counts before and after, and the sum-rule residual.
+    """
+    unit, sposcar, layout, frange, orbits, operations = _setup(base_input, config, symprec)
+    phi = fc3_triplet_values(source, orbits, layout, unit['lattice'])[0]
+    norms = np.linalg.norm(phi, axis=1)
+    limit = threshold * norms.max()
+    orbit_norm = np.zeros(len(orbits.reps))
+    np.maximum.at(orbit_norm, orbits.rep_id, norms)
+    keep = orbit_norm[orbits.rep_id] >= limit
+    if not keep.any():
+        raise ValueError(f"threshold {threshold:g} removes every triplet")
+    print(f"Pruning: |phi| < {limit:.4e} eV/A^3 ({threshold:g} x max), "
+          f"{int((~keep).sum())} of {len(keep)} triplets dropped")
+
+    kept = Orbits(orbits.triplets[keep], operations, layout)
+    nblocks, residual = _finish(output, kept, kept.expand(kept.symmetrize(phi[keep])),
+                                layout, sposcar, frange, sparse=True)
+    return {'blocks_before': len(fc3_store.load(source)['phi']), 'blocks_after': nblocks,
+            'triplets_before': len(keep), 'triplets_after': int(keep.sum()),
+            'asr_residual': float(residual)}
+
+def _logged(folder, title, func, *args):
+    with open(os.path.join(folder, REAP_LOG), 'w') as log, contextlib.redirect_stdout(log):
+        print(f"=== FC3 Generation ({title}) Start ===")
+        print(f"Work Dir: {os.path.abspath(folder)}")
+        try:
+            func(*args)
+        except (ValueError, IOError, OSError, np.linalg.LinAlgError) as e:
+            print(f"Error: {e}")
+            print("Error: Generation failed.")
+            return False
+        print("Success: FORCE_CONSTANTS_3RD generated.")
+        return True
+
+def reap_folder(folder, base_input, config, symprec=symmetry.DEFAULT_SYMPREC):
+    """Worker entry point: reap one folder, logging to reap.out with the markers of sub_gen.sh."""
+    return _logged(folder, "native reap", reap, folder, base_input, config, symprec)
+
+def derive_folder(folder, source, base_input, config, symprec=symmetry.DEFAULT_SYMPREC, verify=False):
+    """Worker entry point of derive(), logging like reap_folder()."""
+    return _logged(folder, f"derived from {source}", derive, folder, source, base_input, config,
+                   symprec, verify)
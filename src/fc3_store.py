@@ -0,0 +1,197 @@
+import os
+import json
+import itertools
+import numpy as np
+from src import sow_engine, structure
+
+STORE_SUFFIX = ".npz"
+# Block index, two image vectors, three atoms and 27 "a b c value" lines
+BLOCK_LINES = 1 + 1 + 1 + 1 + 27
+BLOCK_TOKENS = 1 + 3 + 3 + 3 + 27 * 4
+CHUNK_BLOCKS = 4096
+KEY_DECIMALS = 3
+SHELL_DECIMALS = 2
+TOP_TRIPLETS = 10
+
+def store_path(fc3_path):
+    return fc3_path + STORE_SUFFIX
+
+def _signature(path):
+    st = os.stat(path)
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+def parse(fc3_path):
+    """Read a FORCE_CONSTANTS_3RD file CHUNK_BLOCKS blocks at a time.
+
+    Returns {'rj', 'rk' (n x 3, A), 'atoms' (n x 3, 1-based), 'phi' (n x 27, eV/A^3)}
+    with the 27 components in (a, b, c) order, c fastest.
+    """
+    with open(fc3_path, 'r') as f:
+        lines = (line for line in f if line.strip())
+        header = next(lines, None)
+        if header is None:
+            raise ValueError(f"'{fc3_path}' is empty")
+        n = int(header.split()[0])
+        rj = np.empty((n, 3))
+        rk = np.empty((n, 3))
+        atoms = np.empty((n, 3), dtype=np.int32)
+        phi = np.zeros((n, 27))
+        done = 0
+        while done < n:
+            count = min(CHUNK_BLOCKS, n - done)
+            tokens = " ".join(itertools.islice(lines, count * BLOCK_LINES)).split()
+            if len(tokens) != count * BLOCK_TOKENS:
+                raise ValueError(f"'{fc3_path}': expected {n} blocks, the file is truncated or malformed")
+            data = np.array(tokens, dtype=float).reshape(count, BLOCK_TOKENS)
+            rows = slice(done, done + count)
+            rj[rows] = data[:, 1:4]
+            rk[rows] = data[:, 4:7]
+            atoms[rows] = data[:, 7:10]
+            entries = data[:, 10:].reshape(count, 27, 4)
+            axes = entries[:, :, :3].astype(int) - 1
+            np.put_along_axis(phi[rows], axes[:, :, 0] * 9 + axes[:, :, 1] * 3 + axes[:, :, 2],
+                              entries[:, :, 3], axis=1)
+            done += count
+    return {'rj': rj, 'rk': rk, 'atoms': atoms, 'phi': phi}
+
+def load(fc3_path):
+    """Blocks of `fc3_path`, from <fc3_path>.npz while it matches the text file's size and mtime."""
+    signature = _signature(fc3_path)
+    path = store_path(fc3_path)
+    if os.path.exists(path):
+        try:
+            with np.load(path) as data:
+                if np.array_equal(data['sig'], signature):
+                    return {key: data[key] for key in ('rj', 'rk', 'atoms', 'phi')}
+        except (IOError, OSError, ValueError, KeyError):
+            print(f"  [Warning] Ignoring unreadable FC3 store '{path}'.")
+
+    blocks = parse(fc3_path)
+    try:
+        with open(path + ".tmp", 'wb') as f:
+            np.savez(f, sig=signature, **blocks)
+        os.replace(path + ".tmp", path)
+    except (IOError, OSError) as e:
+        print(f"  [Warning] Could not write FC3 store '{path}': {e}")
+    return blocks
+
+def _keys(blocks):
+    """Geometric identity of every block: atoms and image vectors rounded to KEY_DECIMALS."""
+    scale = 10 ** KEY_DECIMALS
+    rows = np.hstack([blocks['atoms'], np.rint(blocks['rj'] * scale), np.rint(blocks['rk'] * scale)])
+    return [tuple(row) for row in rows.astype(np.int64).tolist()]
+
+def shell_radii(blocks, positions):
+    """Largest pairwise distance within each triplet (A); `positions` are unit-cell Cartesians."""
+    i, j, k = (blocks['atoms'][:, n] - 1 for n in range(3))
+    pj = blocks['rj'] + positions[j]
+    pk = blocks['rk'] + positions[k]
+    pi = positions[i]
+    dist = np.stack([np.linalg.norm(pj - pi, axis=1), np.linalg.norm(pk - pi, axis=1),
+                     np.linalg.norm(pk - pj, axis=1)], axis=1)
+    return np.round(dist.max(axis=1), SHELL_DECIMALS)
+
+def _relative(change, norm):
+    if norm > 0:
+        return float(change / norm)
+    return 0.0 if change == 0 else float('inf')
+
+def compare(old, new, positions=None):
+    """Differences between two FC3 block sets; blocks missing on one side count as zero.
+
+    Returns a dict with the matched/unmatched block counts, the largest element difference,
+    the relative Frobenius change ||new - old|| / ||new||, the TOP_TRIPLETS blocks that
+    changed most and, with `positions`, the same per shell of triplet size.
+    """
+    old_keys = _keys(old)
+    new_keys = _keys(new)
+    union = {key: n for n, key in enumerate(dict.fromkeys(old_keys + new_keys))}
+    a = np.zeros((len(union), 27))
+    b = np.zeros((len(union), 27))
+    # Equivalent images of one triplet carry the same values: the last one written wins
+    a[[union[key] for key in old_keys]] = old['phi']
+    b[[union[key] for key in new_keys]] = new['phi']
+    diff = np.linalg.norm(b - a, axis=1)
+    norm_new = np.linalg.norm(b)
+
+    keys = list(union)
+    top = np.argsort(diff)[::-1][:TOP_TRIPLETS]
+    result = {
+        'common': len(set(old_keys) & set(new_keys)),
+        'only_old': len(set(old_keys) - set(new_keys)),
+        'only_new': len(set(new_keys) - set(old_keys)),
+        'max_diff': float(np.abs(b - a).max()) if len(union) else 0.0,
+        'relative': _relative(np.linalg.norm(diff), norm_new),
+        'triplets': [{'atoms': list(keys[n][:3]),
+                      'rj': [x / 10 ** KEY_DECIMALS for x in keys[n][3:6]],
+                      'rk': [x / 10 ** KEY_DECIMALS for x in keys[n][6:9]],
+                      'diff': float(diff[n])} for n in top if diff[n] > 0],
+    }
+    if positions is None:
+        return result
+
+    radius = np.zeros(len(union))
+    radius[[union[key] for key in old_keys]] = shell_radii(old, positions)
+    radius[[union[key] for key in new_keys]] = shell_radii(new, positions)
+    shells = []
+    for r in np.unique(radius):
+        sel = radius == r
+        norm = np.linalg.norm(b[sel])
+        change = np.linalg.norm(diff[sel])
+        shells.append({'radius': float(r), 'blocks': int(sel.sum()),
+                       'norm_old': float(np.linalg.norm(a[sel])), 'norm_new': float(norm),
+                       'diff': float(change),
+                       'relative': _relative(change, norm)})
+    result['shells'] = shells
+    return result
+
+def _label(config):
+    return f"{config[0]}{config[1]}{config[2]}/{config[3]}"
+
+def comparison_pairs(configs, unit):
+    """Successive cutoffs of each supercell, then successive supercells of each cutoff."""
+    configs = [tuple(int(x) for x in c) for c in configs]
+    radius = {c: sow_engine.calc_frange(sow_engine.build_supercell(unit, *c[:3]), c[3]) for c in configs}
+    pairs = []
+    for grid in dict.fromkeys(c[:3] for c in configs):
+        line = sorted((c for c in configs if c[:3] == grid), key=radius.get)
+        pairs.extend(zip(line, line[1:]))
+    for cut in dict.fromkeys(c[3] for c in configs):
+        line = sorted((c for c in configs if c[3] == cut), key=lambda c: c[0] * c[1] * c[2])
+        pairs.extend(zip(line, line[1:]))
+    return pairs
+
+def run_comparison(configs, base_input, output="fc3_compare.json"):
+    unit = structure.read_unit_cell(base_input)
+    if unit is None:
+        print(f"Error: Cannot read the unit cell from '{base_input}'.")
+        return None
+    positions = unit['frac'] @ unit['lattice']
+
+    print("--- Comparing FORCE_CONSTANTS_3RD between configs ---")
+    results = []
+    for old, new in comparison_pairs(configs, unit):
+        paths = [os.path.join(f"thirdorder_{c[0]}{c[1]}{c[2]}_{c[3]}", "FORCE_CONSTANTS_3RD")
+                 for c in (old, new)]
+        missing = [p for p in paths if not os.path.exists(p)]
+        if missing:
+            print(f"  [Skip] {_label(old)} -> {_label(new)}: {', '.join(missing)} not found.")
+            continue
+        try:
+            result = compare(load(paths[0]), load(paths[1]), positions)
+        except (IOError, OSError, ValueError) as e:
+            print(f"  [Error] {_label(old)} -> {_label(new)}: {e}")
+            continue
+        print(f"\n  {_label(old)} -> {_label(new)}: relative change {result['relative'] * 100:.3f}%, "
+              f"max |dphi| {result['max_diff']:.3e} eV/A^3 "
+              f"(blocks: {result['common']} common, +{result['only_new']}, -{result['only_old']})")
+        print(f"    {'Shell (A)':>10} | {'Blocks':>7} | {'|phi| old':>11} | {'|phi| new':>11} | {'Change':>8}")
+        for shell in result['shells']:
+            print(f"    {shell['radius']:>10.2f} | {shell['blocks']:>7d} | {shell['norm_old']:>11.4e} | "
+                  f"{shell['norm_new']:>11.4e} | {shell['relative'] * 100:>7.2f}%")
+        results.append({'old': list(old), 'new': list(new), **result})
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"\n--- {len(results)} comparison(s) saved to {output} ---")
+    return results
@@ -0,0 +1,90 @@
+import os
+import sqlite3
+import numpy as np
+from src import disp_archive, structure
+
+INDEX_FILE = "fingerprint_index.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path      TEXT PRIMARY KEY,
+    mtime_ns  INTEGER,
+    size      INTEGER,
+    tolerance REAL,
+    digest    TEXT,
+    periodic  INTEGER,
+    frac      BLOB,
+    role      TEXT,
+    master    TEXT
+)
+"""
+
+class FingerprintIndex:
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(SCHEMA)
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != structure.FINGERPRINT_VERSION:
+            # Digests of an older format never match new ones: fingerprint every file again
+            self.conn.execute("UPDATE files SET mtime_ns = NULL")
+            self.conn.execute(f"PRAGMA user_version = {structure.FINGERPRINT_VERSION}")
+            self.conn.commit()
+
+    def lookup(self, filepath, tolerance):
+        try:
+            st = os.stat(disp_archive.source_file(filepath))
+        except OSError:
+            return False, None
+
+        row = self.conn.execute(
+            "SELECT mtime_ns, size, tolerance, digest, periodic, frac FROM files WHERE path = ?",
+            (filepath,)).fetchone()
+        if row is None:
+            return False, None
+
+        mtime_ns, size, tol, digest, periodic, frac = row
+        if mtime_ns != st.st_mtime_ns or size != st.st_size or tol != tolerance:
+            return False, None
+        if digest is None:
+            return True, None
+        return True, (digest, np.frombuffer(frac, dtype=np.float64).reshape(-1, 3), bool(periodic))
+
+    def store(self, filepath, fp, tolerance):
+        try:
+            st = os.stat(disp_archive.source_file(filepath))
+        except OSError:
+            return
+
+        if fp is None:
+            digest, periodic, frac = None, None, None
+        else:
+            digest, frac_arr, periodic = fp
+            frac = np.ascontiguousarray(frac_arr, dtype=np.float64).tobytes()
+            periodic = int(periodic)
+
+        self.conn.execute(
+            "INSERT INTO files (path, mtime_ns, size, tolerance, digest, periodic, frac, role, master) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, NULL, NULL) "
+            "ON CONFLICT(path) DO UPDATE SET mtime_ns = excluded.mtime_ns, size = excluded.size, "
+            "tolerance = excluded.tolerance, digest = excluded.digest, "
+            "periodic = excluded.periodic, frac = excluded.frac",
+            (filepath, st.st_mtime_ns, st.st_size, tolerance, digest, periodic, frac))
+
+    def set_role(self, filepath, role, master=None):
+        self.conn.execute("UPDATE files SET role = ?, master = ? WHERE path = ?",
+                          (role, master, filepath))
+
+    def links(self):
+        return self.conn.execute(
+            "SELECT path, master FROM files WHERE role = 'link' ORDER BY path").fetchall()
+
+    def prune(self):
+        stale = [path for (path,) in self.conn.execute("SELECT path FROM files")
+                 if not os.path.exists(disp_archive.source_file(path))]
+        self.conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in stale])
+        return len(stale)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
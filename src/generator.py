@@ -2,20 +2,54 @@ import os
 import shutil
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from src import disp_archive
 
-def run_command(cmd, work_dir):
+SOW_LOG = "sow.log"
+
+def run_command(cmd, work_dir, log_name=None):
     try:
         script_path = cmd.split()[0]
         if os.path.exists(script_path) and not os.access(script_path, os.X_OK):
             os.chmod(script_path, 0o755)
-        subprocess.run(cmd, shell=True, cwd=work_dir, check=True, capture_output=True)
+        if log_name:
+            with open(os.path.join(work_dir, log_name), 'w') as log:
+                subprocess.run(cmd, shell=True, cwd=work_dir, check=True,
+                               stdout=log, stderr=subprocess.STDOUT)
+        else:
+            subprocess.run(cmd, shell=True, cwd=work_dir, check=True, capture_output=True)
     except subprocess.CalledProcessError as e:
         print(f"\n[Error] Command failed in {work_dir}: {cmd}")
-        print(f"Error Message: {e.stderr.decode().strip()}")
+        if log_name:
+            print(f"Error Message: see {os.path.join(work_dir, log_name)}")
+        else:
+            print(f"Error Message: {e.stderr.decode().strip()}")
         return False
     return True
 
-def run_generation(configs, base_input, tpl_name, thirdorder_bin):
+def prepare_folder(config, base_input, tpl_name, thirdorder_bin):
+    na, nb, nc, cut = config
+    folder_name = f"thirdorder_{na}{nb}{nc}_{cut}"
+
+    if not os.path.exists(folder_name):
+        os.makedirs(folder_name)
+
+    shutil.copy(base_input, os.path.join(folder_name, base_input))
+    
+    if tpl_name:
+        shutil.copy(tpl_name, os.path.join(folder_name, tpl_name))
+        return f"{thirdorder_bin} {base_input} sow {na} {nb} {nc} {cut} {tpl_name}"
+    return f"{thirdorder_bin} {base_input} sow {na} {nb} {nc} {cut}"
+
+def sow_folder(cmd, folder_name, layout):
+    if not run_command(cmd, folder_name, SOW_LOG):
+        return False
+    if layout == 'packed':
+        n_packed = disp_archive.pack_inputs(folder_name)
+        print(f"    [Pack] {folder_name}: {n_packed} inputs -> {disp_archive.INPUT_ARCHIVE}")
+    return True
+
+def run_generation(configs, base_input, tpl_name, thirdorder_bin, workers=None, layout='classic'):
     print("-" * 60)
     print("--- Starting Supercell Generation (Phase 1) ---")
     
@@ -32,6 +66,7 @@ def run_generation(configs, base_input, tpl_name, thirdorder_bin):
         return []
 
     generated_folders = []
+    pending = []
 
     for config in configs:
         na, nb, nc, cut = config
@@ -42,8 +77,8 @@ def run_generation(configs, base_input, tpl_name, thirdorder_bin):
             print(f"  [Skip] {folder_name} (Completed)")
             continue
         
-        has_disp = False
-        if os.path.exists(folder_name):
+        has_disp = disp_archive.is_packed(folder_name)
+        if not has_disp and os.path.exists(folder_name):
              files = os.listdir(folder_name)
              if any(f.startswith("DISP.") and not f.endswith(".in") for f in files):
                  has_disp = True
@@ -52,23 +87,38 @@ def run_generation(configs, base_input, tpl_name, thirdorder_bin):
              print(f"  [Skip] {folder_name} (Generated)")
              continue
 
-        print(f"  [Gen] Generating {folder_name} ...")
-        
-        if not os.path.exists(folder_name):
-            os.makedirs(folder_name)
+        cmd = prepare_folder(config, base_input, tpl_name if has_template else None, thirdorder_bin)
+        pending.append((folder_name, cmd))
 
-        shutil.copy(base_input, os.path.join(folder_name, base_input))
-        
-        if has_template:
-            shutil.copy(tpl_name, os.path.join(folder_name, tpl_name))
-            cmd = f"{thirdorder_bin} {base_input} sow {na} {nb} {nc} {cut} {tpl_name}"
-        else:
-            cmd = f"{thirdorder_bin} {base_input} sow {na} {nb} {nc} {cut}"
-        
-        success = run_command(cmd, work_dir=folder_name)
-        if not success:
-            print(f"    [Failed] Generation failed for {folder_name}")
+    if pending:
+        workers = int(workers) if workers else min(4, len(pending))
+        print(f"  [Gen] Generating {len(pending)} folder(s) with {workers} worker(s) "
+              f"(logs: <folder>/{SOW_LOG})")
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(sow_folder, cmd, folder_name, layout): folder_name
+                for folder_name, cmd in pending
+            }
+            for future in as_completed(futures):
+                folder_name = futures[future]
+                try:
+                    success = future.result()
+                except Exception as e:
+                    print(f"\n[Error] {folder_name}: {e}")
+                    success = False
+
+                if success:
+                    print(f"    [Done] {folder_name}")
+                else:
+                    failed.append(folder_name)
+
+        if failed:
+            print(f"    [Failed] Generation failed for {len(failed)} folder(s):")
+            for folder_name in sorted(failed):
+                print(f"      - {folder_name} (see {os.path.join(folder_name, SOW_LOG)})")
         
     print(f"--- Generation Complete. ---")
     print("-" * 60)
-    return generated_folders
\ No newline at end of file
+    return generated_folders
@@ -0,0 +1,233 @@
+import os
+import re
+import mmap
+import numpy as np
+from src import disp_archive
+
+FORCE_HEADER = b"Forces acting on atoms"
+FORCE_LINE_RE = re.compile(
+    rb"^\s*atom\s+(\d+)\s+type\s+(\d+)\s+force\s*=\s*(\S+)\s+(\S+)\s+(\S+)", re.MULTILINE)
+ENERGY_RE = re.compile(rb"!\s+total energy\s*=\s*(\S+)\s+Ry")
+WALL_RE = re.compile(rb"PWSCF\s*:.*?CPU\s+(.*?)\s*WALL")
+TIME_PART_RE = re.compile(rb"(\d+(?:\.\d*)?)\s*([dhms])")
+TIME_UNITS = {b'd': 86400.0, b'h': 3600.0, b'm': 60.0, b's': 1.0}
+# "Parallel version (MPI), running on 64 processors" / "... running on 64 processor cores"
+NPROC_RE = re.compile(rb"running on\s+(\d+)\s+processor")
+SERIAL_MARKER = b"Serial version"
+HEADER_BYTES = 16384
+DONE_MARKER = b"JOB DONE"
+UNCONVERGED_MARKER = b"convergence NOT achieved"
+
+BUNDLE_FILE = "disp_forces.npz"
+FLAG_DONE = 1
+FLAG_CONVERGED = 2
+
+_bundles = {}
+_unsaved = set()
+
+def read_forces(filepath, nat=None):
+    try:
+        with open(filepath, 'r', errors='ignore') as f:
+            text = f.read()
+    except (IOError, OSError):
+        return None
+    return parse_forces(text, nat)
+
+def parse_forces(text, nat=None):
+    """Last force block of a pw.x output (str, bytes or mmap): (forces in Ry/au, types) or None."""
+    if isinstance(text, str):
+        text = text.encode(errors='ignore')
+    start = text.rfind(FORCE_HEADER)
+    if start < 0:
+        return None
+
+    forces = []
+    types = []
+    for match in FORCE_LINE_RE.finditer(text, start):
+        idx = int(match.group(1))
+        if idx != len(forces) + 1:
+            break
+        types.append(int(match.group(2)))
+        forces.append([float(match.group(k)) for k in (3, 4, 5)])
+        if nat and len(forces) == nat:
+            break
+
+    if not forces or (nat and len(forces) != nat):
+        return None
+    return np.array(forces), types
+
+def parse_wall_time(raw):
+    """'1h 2m', '3m40.12s', '0.60s' -> seconds."""
+    parts = TIME_PART_RE.findall(raw)
+    if not parts:
+        return float('nan')
+    return sum(float(value) * TIME_UNITS[unit] for value, unit in parts)
+
+def scan_output(buf):
+    """Facts of one pw.x output, read by seeking backwards instead of parsing every line."""
+    record = {'done': buf.rfind(DONE_MARKER) >= 0,
+              'converged': buf.rfind(UNCONVERGED_MARKER) < 0,
+              'energy': float('nan'), 'wall': float('nan'), 'nproc': 0, 'forces': None, 'types': None}
+
+    pos = buf.rfind(b"\n!")
+    match = ENERGY_RE.match(buf, pos + 1) if pos >= 0 else None
+    if match:
+        record['energy'] = float(match.group(1))
+    pos = buf.rfind(b"PWSCF ")
+    match = WALL_RE.match(buf, pos) if pos >= 0 else None
+    if match:
+        record['wall'] = parse_wall_time(match.group(1))
+    header = min(len(buf), HEADER_BYTES)
+    match = NPROC_RE.search(buf, 0, header)
+    if match:
+        record['nproc'] = int(match.group(1))
+    elif buf.find(SERIAL_MARKER, 0, header) >= 0:
+        record['nproc'] = 1
+
+    parsed = parse_forces(buf)
+    if parsed is not None:
+        record['forces'] = parsed[0]
+        record['types'] = np.array(parsed[1], dtype=np.int32)
+    return record
+
+def read_output_record(path, signature):
+    """Scan the output of one DISP input (classic or packed path); None if it is missing."""
+    folder, name, packed = disp_archive.split_path(path)
+    try:
+        if packed:
+            data = disp_archive.read_output(path)
+            if not data:
+                return None
+            record = scan_output(data)
+        else:
+            with open(path + ".out", 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    record = scan_output(b"")
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                        record = scan_output(buf)
+    except (IOError, OSError, ValueError):
+        return None
+    record['sig'] = tuple(signature)
+    return record
+
+def _load_file(path):
+    try:
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime_ns)
+    except OSError:
+        key = None
+    cached = _bundles.get(path)
+    if cached and cached[0] == key:
+        return cached
+    if key is None:
+        _bundles[path] = (None, {})
+        return _bundles[path]
+
+    records = {}
+    try:
+        with np.load(path) as data:
+            offsets = np.concatenate(([0], np.cumsum(data['nat'])))
+            forces, types = data['forces'], data['types']
+            for n, name in enumerate(data['names']):
+                flags = int(data['flags'][n])
+                has_forces = offsets[n + 1] > offsets[n]
+                records[str(name)] = {
+                    'sig': tuple(int(x) for x in data['sig'][n]),
+                    'done': bool(flags & FLAG_DONE),
+                    'converged': bool(flags & FLAG_CONVERGED),
+                    'energy': float(data['energy'][n]),
+                    'wall': float(data['wall'][n]),
+                    'nproc': int(data['nproc'][n]),
+                    'forces': forces[offsets[n]:offsets[n + 1]] if has_forces else None,
+                    'types': types[offsets[n]:offsets[n + 1]] if has_forces else None,
+                }
+    except (IOError, OSError, ValueError, KeyError):
+        print(f"  [Warning] Ignoring unreadable force bundle '{path}'.")
+        records = {}
+    _bundles[path] = (key, records)
+    return _bundles[path]
+
+def _write_file(path, records):
+    names = sorted(records)
+    rows = [records[name] for name in names]
+    blocks = [r['forces'] for r in rows if r['forces'] is not None]
+    arrays = {
+        'names': np.array(names, dtype=str),
+        'sig': np.array([r['sig'] for r in rows], dtype=np.int64).reshape(-1, 2),
+        'flags': np.array([FLAG_DONE * r['done'] + FLAG_CONVERGED * r['converged'] for r in rows],
+                          dtype=np.int8),
+        'energy': np.array([r['energy'] for r in rows], dtype=float),
+        'wall': np.array([r['wall'] for r in rows], dtype=float),
+        'nproc': np.array([r['nproc'] for r in rows], dtype=np.int32),
+        'nat': np.array([0 if r['forces'] is None else len(r['forces']) for r in rows], dtype=np.int32),
+        'forces': np.concatenate(blocks) if blocks else np.zeros((0, 3)),
+        'types': (np.concatenate([r['types'] for r in rows if r['forces'] is not None])
+                  if blocks else np.zeros(0, dtype=np.int32)),
+    }
+    try:
+        with open(path + ".tmp", 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(path + ".tmp", path)
+        st = os.stat(path)
+        _bundles[path] = ((st.st_size, st.st_mtime_ns), dict(records))
+    except (IOError, OSError) as e:
+        print(f"  [Warning] Could not write force bundle '{path}': {e}")
+
+def load_bundle(folder):
+    """{name: record} for every DISP.* output of `folder` that exists.
+
+    Records (done/converged flags, forces and types in Ry/au, total energy in Ry, wall time
+    in s, MPI processor count or 0 if unknown) are kept in <folder>/disp_forces.npz keyed by the output's signature, so only
+    outputs that changed since the last call are parsed again.
+    """
+    path = os.path.join(folder, BUNDLE_FILE)
+    stored = _load_file(path)[1]
+    current = {}
+    changed = False
+    for entry in disp_archive.input_paths(folder):
+        name = disp_archive.split_path(entry)[1]
+        signature = disp_archive.output_signature(entry)
+        if signature is None:
+            continue
+        record = stored.get(name)
+        if record is None or record['sig'] != tuple(signature):
+            record = read_output_record(entry, signature)
+            changed = True
+            if record is None:
+                continue
+        current[name] = record
+    if changed or path in _unsaved or set(current) != set(stored):
+        _write_file(path, current)
+        _unsaved.discard(path)
+    return current
+
+def output_record(path):
+    """Record of a single output, reusing the folder bundle when it is still current."""
+    signature = disp_archive.output_signature(path)
+    if signature is None:
+        return None
+    folder, name, _ = disp_archive.split_path(path)
+    bundle = os.path.join(folder, BUNDLE_FILE)
+    records = _load_file(bundle)[1]
+    record = records.get(name)
+    if record is None or record['sig'] != tuple(signature):
+        record = read_output_record(path, signature)
+        if record is not None:
+            # Kept in memory only; the next load_bundle() of the folder stores it
+            records[name] = record
+            _unsaved.add(bundle)
+    return record
+
+def format_forces(forces, types, header_lines=()):
+    lines = [""]
+    for line in header_lines:
+        lines.append(f"     {line}")
+    lines.append("\n     Forces acting on atoms (cartesian axes, Ry/au):\n")
+    for i, (force, atype) in enumerate(zip(forces, types)):
+        lines.append(f"     atom {i + 1:4d} type {atype:2d}   force = "
+                     f"{force[0]:14.8f}{force[1]:14.8f}{force[2]:14.8f}")
+    total = np.sqrt((np.asarray(forces) ** 2).sum())
+    lines.append(f"\n     Total force = {total:14.6f}     Total SCF correction = {0.0:14.6f}")
+    lines.append("\n     JOB DONE.")
+    return "\n".join(lines) + "\n"
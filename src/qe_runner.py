@@ -1,8 +1,153 @@
 import os
 import glob
 import re
-import subprocess
 import shutil
+from src import dft_validator, disp_archive, structure, symmetry
+from src import executor
+
+INSTALL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUEUE_FILE = "dft_queue.txt"
+QUEUE_STATE_FILES = ("dft_queue.claims", "dft_queue.done")
+
+REFERENCE_DIR = "reference_{grid}"
+REFERENCE_INPUT = "REF.in"
+REFERENCE_SAMPLE = 16
+FOLDER_RE = re.compile(r"thirdorder_(\d+)_(-?\d+)")
+STAGE = "dft"
+
+def publish_queue(folder, names):
+    queue_path = os.path.join(folder, QUEUE_FILE)
+    with open(queue_path + ".tmp", 'w') as f:
+        for name in names:
+            f.write(name + "\n")
+    os.replace(queue_path + ".tmp", queue_path)
+
+    for state_file in QUEUE_STATE_FILES:
+        path = os.path.join(folder, state_file)
+        if os.path.exists(path):
+            os.remove(path)
+
+def job_env(extra_env=None):
+    env = {'AUTO3RD_HOME': INSTALL_DIR}
+    env.update(extra_env or {})
+    return env
+
+def array_request(work_dir, script_name, job_name, n_tasks, array_limit=None,
+                  dependency=None, extra_env=None):
+    return {
+        'script': script_name,
+        'work_dir': work_dir,
+        'job_name': job_name,
+        'array': f"1-{n_tasks}" + (f"%{array_limit}" if array_limit else ""),
+        'env': job_env(extra_env),
+        'dependency': dependency,
+    }
+
+def collect_pending(folders):
+    pending = {}
+    for folder in folders:
+        if not FOLDER_RE.match(folder): continue
+
+        input_files = disp_archive.list_inputs(folder)
+        if not input_files:
+            print(f"  [Skip] {folder}: No DISP input files found.")
+            continue
+
+        names = disp_archive.pending_jobs(folder)
+        if not names:
+            print(f"  [Skip] {folder}: All {len(input_files)} jobs are linked, synthesized or done.")
+            continue
+
+        pending[folder] = (names, len(input_files))
+    return pending
+
+def build_reference_input(folder):
+    paths = disp_archive.input_paths(folder)[:REFERENCE_SAMPLE]
+    structs = [structure.read_pw_structure(path) for path in paths]
+    fracs = [structure.fractional_positions(s) for s in structs if s is not None]
+    fracs = [frac for frac in fracs if frac is not None]
+    if len(fracs) < 3:
+        return None
+
+    eq = symmetry.equilibrium_positions(fracs)
+    text = disp_archive.read_input(paths[0]).decode(errors='ignore')
+    return structure.replace_positions(text, structs[0]['species'], eq)
+
+def reference_done(ref_dir):
+    output = os.path.join(ref_dir, REFERENCE_INPUT + ".out")
+    saves = glob.glob(os.path.join(ref_dir, "outdir", "*.save"))
+    return bool(saves) and disp_archive.classic_completed(output)
+
+def submit_references(template_script, pending):
+    groups = {}
+    for folder in sorted(pending):
+        grid = FOLDER_RE.match(folder).group(1)
+        groups.setdefault(grid, folder)
+
+    requests = []
+    for grid, folder in sorted(groups.items()):
+        ref_dir = REFERENCE_DIR.format(grid=grid)
+        if reference_done(ref_dir):
+            print(f"  [Ref] {ref_dir}: reference ground state available.")
+            continue
+
+        text = build_reference_input(folder)
+        if text is None:
+            print(f"  [Ref] {ref_dir}: could not build the undisplaced supercell, cold start.")
+            continue
+
+        os.makedirs(ref_dir, exist_ok=True)
+        with open(os.path.join(ref_dir, REFERENCE_INPUT), 'w') as f:
+            f.write(text)
+        shutil.copy(template_script, os.path.join(ref_dir, "run_dft.sh"))
+
+        requests.append(array_request(ref_dir, "run_dft.sh", f"DFT_ref_{grid}", 1,
+                                      extra_env={'AUTO3RD_MODE': 'reference'}))
+
+    job_ids = []
+    for request, job_id in zip(requests, executor.submit_batch(STAGE, requests)):
+        if job_id is None:
+            print(f"  [Ref] {request['work_dir']}: submission failed, cold start.")
+            continue
+        job_ids.append(job_id)
+        print(f"  [Ref] {request['work_dir']}: reference SCF submitted (job {job_id}).")
+
+    # The arrays wait for the references (afterany) and fall back to a cold start if one fails
+    return job_ids
+
+def cleanup_references():
+    removed = 0
+    for ref_dir in glob.glob(REFERENCE_DIR.format(grid="*")):
+        outdir = os.path.join(ref_dir, "outdir")
+        if os.path.isdir(outdir):
+            shutil.rmtree(outdir, ignore_errors=True)
+            removed += 1
+    if removed:
+        print(f"  [Ref] Removed {removed} reference ground state(s).")
+
+def submit_global_array(template_script, pending, max_tasks, array_limit,
+                        dependency=None, extra_env=None):
+    entries = [os.path.join(folder, name) for folder in sorted(pending) for name in pending[folder][0]]
+    for folder in pending:
+        stale = os.path.join(folder, QUEUE_FILE)
+        if os.path.exists(stale):
+            os.remove(stale)
+
+    publish_queue(".", entries)
+    n_tasks = max(1, min(max_tasks, len(entries)))
+
+    for folder in sorted(pending):
+        names, total = pending[folder]
+        print(f"    {folder}: {len(names)}/{total} jobs")
+    print(f"  [Sub] Submitting one global array: {len(entries)} jobs from {len(pending)} folders, "
+          f"{n_tasks} array tasks" + (f" (max {array_limit} running)" if array_limit else ""))
+
+    local_script_name = "run_dft.sh"
+    shutil.copy(template_script, local_script_name)
+    request = array_request(".", local_script_name, "DFT_global", n_tasks, array_limit,
+                            dependency, extra_env)
+    return executor.submit(STAGE, **request) is not None
 
 def submit_dft_jobs(config):
     print("-" * 60)
@@ -15,28 +160,38 @@ def submit_dft_jobs(config):
         print(f"Error: Template script '{template_script}' not found.")
         return
 
-    pattern = re.compile(r"thirdorder_(\d+)_(-?\d+)")
+    max_tasks = int(config.get('MAX_ARRAY_TASKS', 2))
+    array_limit = config.get('ARRAY_LIMIT')
+    mode = config.get('SUBMIT_MODE', 'folder')
+
     folders = sorted(glob.glob("thirdorder_*"))
+    pending = collect_pending(folders)
     
     submit_count = 0
-    
-    for folder in folders:
-        if not pattern.match(folder): continue
-        
-        all_files = glob.glob(os.path.join(folder, "DISP.*"))
-        input_files = [
-            f for f in all_files 
-            if not f.endswith(".out") 
-            and not f.endswith(".run") 
-            and not f.endswith(".save") 
-            and not f.endswith(".xml")
-        ]
+    executor.registry().begin_stage(STAGE)
 
-        if not input_files:
-            print(f"  [Skip] {folder}: No DISP input files found.")
-            continue
+    dependency = None
+    extra_env = None
+    if config.get('WARM_START', False) and pending:
+        dependency = submit_references(template_script, pending)
+        extra_env = {'AUTO3RD_WARM_START': 1, 'AUTO3RD_REF_ROOT': os.getcwd()}
+
+    if mode == 'global':
+        if pending and submit_global_array(template_script, pending, max_tasks, array_limit,
+                                           dependency, extra_env):
+            submit_count = len(pending)
+        print(f"--- DFT Submission Complete. {submit_count} folders processed. ---")
+        print("-" * 60)
+        return
+    
+    requests = []
+    for folder in sorted(pending):
+        names, total = pending[folder]
+        publish_queue(folder, names)
+        n_tasks = max(1, min(max_tasks, len(names)))
             
-        print(f"  [Sub] Submitting folder: {folder} ({len(input_files)} jobs)")
+        print(f"  [Sub] Submitting folder: {folder} ({len(names)}/{total} jobs queued, "
+              f"{n_tasks} array tasks)")
         
         local_script_name = "run_dft.sh"
         local_script_path = os.path.join(folder, local_script_name)
@@ -44,24 +199,75 @@ def submit_dft_jobs(config):
         shutil.copy(template_script, local_script_path)
         
         job_name = f"DFT_{folder.replace('thirdorder_', '')}"
-        
-        cmd = [
-            "sbatch",
-            f"--job-name={job_name}",
-            local_script_name
-        ]
-        
-        full_cmd = " ".join(cmd)
-        
-        cwd = os.getcwd()
-        try:
-            os.chdir(folder)
-            subprocess.call(full_cmd, shell=True)
-            submit_count += 1
-        except Exception as e:
-            print(f"Error submitting in {folder}: {e}")
-        finally:
-            os.chdir(cwd)
-            
+        requests.append(array_request(folder, local_script_name, job_name, n_tasks, array_limit,
+                                      dependency, extra_env))
+
+    job_ids = executor.submit_batch(STAGE, requests)
+    submit_count = sum(1 for job_id in job_ids if job_id is not None)
+
     print(f"--- DFT Submission Complete. {submit_count} folders processed. ---")
-    print("-" * 60)
\ No newline at end of file
+    print("-" * 60)
+
+def resubmit_failed(config, queue):
+    """Rerun only the given {folder: [names]} jobs, with the FALLBACK_SCF settings if any."""
+    template_script = os.path.abspath(config.get('SUB_SCRIPT', 'templates/sub_calc.sh'))
+    if not os.path.exists(template_script):
+        print(f"Error: Template script '{template_script}' not found.")
+        return []
+
+    max_tasks = int(config.get('MAX_ARRAY_TASKS', 2))
+    array_limit = config.get('ARRAY_LIMIT')
+    fallback = config.get('FALLBACK_SCF', {})
+    extra_env = {'AUTO3RD_SCF_FALLBACK': 1} if fallback else None
+
+    requests = []
+    for folder in sorted(queue):
+        names = queue[folder]
+        publish_queue(folder, names)
+        dft_validator.write_fallback(folder, fallback)
+        shutil.copy(template_script, os.path.join(folder, "run_dft.sh"))
+        n_tasks = max(1, min(max_tasks, len(names)))
+        print(f"  [Retry] {folder}: {len(names)} failed job(s) resubmitted"
+              + (" with fallback SCF settings" if fallback else ""))
+        job_name = f"DFT_retry_{folder.replace('thirdorder_', '')}"
+        requests.append(array_request(folder, "run_dft.sh", job_name, n_tasks, array_limit,
+                                      extra_env=extra_env))
+
+    job_ids = []
+    for request, job_id in zip(requests, executor.submit_batch(STAGE, requests)):
+        if job_id is None:
+            print(f"  [Error] Failed to resubmit in {request['work_dir']}")
+            continue
+        job_ids.append(job_id)
+    return job_ids
+
+def validate_dft_jobs(config, configs):
+    print("-" * 60)
+    print("--- Validating DFT Outputs ---")
+
+    ids = [entry['id'] for entry in executor.registry().jobs(STAGE)]
+    states = executor.get_executor().job_states(ids)
+    active = [job_id for job_id, state in states.items()
+              if state in executor.ACTIVE_STATES or state == executor.QUERY_FAILED]
+    if active:
+        print(f"Error: DFT job(s) {', '.join(active)} still queued or running; validate after they end.")
+        return
+
+    folders = [f"thirdorder_{na}{nb}{nc}_{cut}" for na, nb, nc, cut in configs]
+    folders = [folder for folder in folders if os.path.exists(folder)]
+    for folder in folders:
+        counts = {}
+        for state, _, _ in dft_validator.scan_folder(folder).values():
+            counts[state] = counts.get(state, 0) + 1
+        print(f"  {folder}: {dft_validator.report(counts)}")
+
+    retry_limit = int(config.get('RETRY_LIMIT', dft_validator.DEFAULT_RETRY_LIMIT))
+    queue, exhausted, _ = dft_validator.prepare_retries(folders, retry_limit)
+    for folder in sorted(exhausted):
+        print(f"  [Give Up] {folder}: {len(exhausted[folder])} job(s) failed {retry_limit} retries, "
+              f"see {os.path.join(folder, dft_validator.FAILED_DIR)}/")
+    if queue:
+        resubmit_failed(config, queue)
+    else:
+        print("No failed jobs to resubmit.")
+    print("-" * 60)
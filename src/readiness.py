@@ -0,0 +1,220 @@
+import os
+import glob
+import time
+import errno
+import select
+import ctypes
+import ctypes.util
+
+QUIET_PERIOD = 5.0
+VISIBILITY_TIMEOUT = 120.0
+SETTLE_TIME = 2.0
+POLL_START = 1.0
+POLL_MAX = 15.0
+POLL_BACKOFF = 1.5
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+def _load_inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+class FileWatcher:
+    """Wakes up when watched directories/files change.
+
+    Uses inotify when available and always keeps a cheap stat signature of the watched
+    paths, polled with backoff, because inotify does not see writes made by other nodes
+    on NFS/Lustre.
+    """
+
+    def __init__(self, paths=(), mode='auto'):
+        self.paths = []
+        self.wanted = set()
+        self.fd = None
+        self.libc = None
+        if mode in ('auto', 'inotify'):
+            self.libc = _load_inotify()
+            if self.libc is not None:
+                fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+                self.fd = fd if fd >= 0 else None
+            if self.fd is None and mode == 'inotify':
+                print("  [Warning] inotify is not available, falling back to stat polling.")
+        for path in paths:
+            self.watch(path)
+
+    @property
+    def backend(self):
+        return "inotify+stat" if self.fd is not None else "stat"
+
+    def watch(self, path):
+        if path in self.wanted or path in self.paths:
+            return
+        self.wanted.add(path)
+        self._attach()
+
+    def _attach(self):
+        for path in list(self.wanted):
+            if not os.path.exists(path):
+                continue
+            self.wanted.discard(path)
+            self.paths.append(path)
+            if self.fd is not None:
+                wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+                if wd < 0 and ctypes.get_errno() == errno.ENOSPC:
+                    print("  [Warning] inotify watch limit reached, using stat polling only.")
+                    os.close(self.fd)
+                    self.fd = None
+
+    def _signature(self):
+        sig = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                sig.append((st.st_size, st.st_mtime_ns))
+            except OSError:
+                sig.append(None)
+        return sig
+
+    def _drain_events(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return False
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        while True:
+            try:
+                if not os.read(self.fd, 65536):
+                    break
+            except BlockingIOError:
+                break
+        return True
+
+    def wait(self, timeout):
+        """Block until something changes or `timeout` seconds pass; True if woken by a change."""
+        deadline = time.monotonic() + timeout
+        self._attach()
+        base = self._signature()
+        step = POLL_START
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            woken = self._drain_events(min(step, remaining))
+            self._attach()
+            if woken or self._signature() != base:
+                # Coalesce bursts of writes (e.g. pw.x appending to its output)
+                time.sleep(min(SETTLE_TIME, max(0.0, deadline - time.monotonic())))
+                if self.fd is not None:
+                    self._drain_events(0)
+                return True
+            step = min(step * POLL_BACKOFF, POLL_MAX)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class StabilityTracker:
+    """Confirms that a file is complete by size/mtime quiescence instead of fixed sleeps."""
+
+    def __init__(self, quiet_period=QUIET_PERIOD):
+        self.quiet_period = quiet_period
+        self.seen = {}
+
+    def stable(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.seen.pop(path, None)
+            return False
+        sig = (st.st_size, st.st_mtime_ns)
+        now = time.monotonic()
+        previous = self.seen.get(path)
+        if previous is None or previous[0] != sig:
+            self.seen[path] = (sig, now)
+            return self.quiet_period <= 0
+        return now - previous[1] >= self.quiet_period
+
+    def forget(self, path):
+        self.seen.pop(path, None)
+
+class LogScanner:
+    """Scans growing logs incrementally for success/failure markers.
+
+    Only bytes appended since the previous scan are read. The last few bytes of each
+    chunk are carried over so a marker split across two reads is still found, and the
+    current log of each folder is re-resolved only when the folder itself changes.
+    """
+
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self):
+        self.files = {}
+        self.current = {}
+
+    def current_log(self, folder, specific_name, pattern):
+        if specific_name:
+            specific_path = os.path.join(folder, specific_name)
+            if os.path.exists(specific_path):
+                return specific_path
+        try:
+            dir_key = os.stat(folder).st_mtime_ns
+        except OSError:
+            return None
+        cached = self.current.get((folder, pattern))
+        if cached and cached[0] == dir_key and os.path.exists(cached[1]):
+            return cached[1]
+        files = glob.glob(os.path.join(folder, pattern))
+        if not files:
+            return None
+        latest = max(files, key=os.path.getmtime)
+        self.current[(folder, pattern)] = (dir_key, latest)
+        return latest
+
+    def scan(self, path, markers):
+        """Return the subset of `markers` that occur anywhere in the file so far."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.files.pop(path, None)
+            return set()
+
+        keys = tuple(sorted(markers))
+        state = self.files.get(path)
+        if (state is None or state['keys'] != keys or state['inode'] != st.st_ino
+                or st.st_size < state['offset']):
+            # New file, different markers, or the log was truncated/replaced: start over
+            state = {'keys': keys, 'inode': st.st_ino, 'offset': 0, 'carry': b"", 'found': set()}
+            self.files[path] = state
+        if st.st_size == state['offset'] or len(state['found']) == len(keys):
+            return set(state['found'])
+
+        encoded = {key: key.encode() for key in keys}
+        overlap = max(len(b) for b in encoded.values()) - 1
+        try:
+            with open(path, 'rb') as f:
+                f.seek(state['offset'])
+                while True:
+                    chunk = f.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    data = state['carry'] + chunk
+                    for key, needle in encoded.items():
+                        if key not in state['found'] and needle in data:
+                            state['found'].add(key)
+                    state['carry'] = data[-overlap:] if overlap > 0 else b""
+                    state['offset'] += len(chunk)
+        except (IOError, OSError):
+            pass
+        return set(state['found'])
@@ -0,0 +1,182 @@
+import itertools
+import numpy as np
+from collections import defaultdict
+from src import symmetry
+
+H_DISPLACEMENT = 0.01
+SHELL_TOLERANCE = 1.0e-4
+PIVOT_TOLERANCE = 1.0e-4
+
+def build_supercell(unit, na, nb, nc):
+    natoms = len(unit['frac'])
+    images = np.array([(i, j, k) for k, j, i in itertools.product(range(nc), range(nb), range(na))],
+                      dtype=float)
+    frac = (unit['frac'][None, :, :] + images[:, None, :]) / [na, nb, nc]
+    return {
+        'lattice': unit['lattice'] * np.array([[na], [nb], [nc]]),
+        'frac': frac.reshape(-1, 3),
+        'species': list(unit['species']) * (na * nb * nc),
+        'natoms_unit': natoms,
+    }
+
+def _image_shifts():
+    return np.array(list(itertools.product((-1, 0, 1), repeat=3)), dtype=float)
+
+def neighbor_distances(sposcar, radius):
+    lattice = sposcar['lattice']
+    frac = sposcar['frac']
+    nat = len(frac)
+
+    shifts = _image_shifts()
+    images = (frac[None, :, :] + shifts[:, None, :]).reshape(-1, 3) @ lattice
+    owner = np.tile(np.arange(nat), len(shifts))
+    centers = frac @ lattice
+
+    origin = images.min(axis=0)
+    bins = np.floor((images - origin) / radius).astype(int)
+    table = defaultdict(list)
+    for idx, key in enumerate(map(tuple, bins)):
+        table[key].append(idx)
+    table = {key: np.array(val) for key, val in table.items()}
+
+    center_bins = np.floor((centers - origin) / radius).astype(int)
+    offsets = list(itertools.product((-1, 0, 1), repeat=3))
+
+    dmin = {}
+    for a in range(nat):
+        bx, by, bz = center_bins[a]
+        cand = [table[key] for key in ((bx + dx, by + dy, bz + dz) for dx, dy, dz in offsets)
+                if key in table]
+        if not cand:
+            continue
+        cand = np.concatenate(cand)
+        dist = np.linalg.norm(images[cand] - centers[a], axis=1)
+        inside = dist < radius
+        for b, d in zip(owner[cand[inside]], dist[inside]):
+            if b == a:
+                continue
+            if d < dmin.get((a, b), np.inf):
+                dmin[(a, b)] = d
+    return dmin
+
+def unit_distances(sposcar):
+    lattice = sposcar['lattice']
+    frac = sposcar['frac']
+    shifts = _image_shifts()
+    unit = frac[:sposcar['natoms_unit']]
+    delta = frac[None, :, :] - unit[:, None, :]
+    delta -= np.rint(delta)
+    cart = (delta[:, :, None, :] + shifts[None, None, :, :]) @ lattice
+    return np.linalg.norm(cart, axis=3).min(axis=2)
+
+def calc_frange(sposcar, cutoff):
+    if cutoff > 0:
+        return cutoff * 10.0
+
+    n = -int(cutoff)
+    dmin = unit_distances(sposcar)
+    tonth = []
+    for row in dmin:
+        shells = []
+        for d in np.sort(row):
+            if not shells or d - shells[-1] > SHELL_TOLERANCE:
+                shells.append(d)
+        if n + 1 < len(shells):
+            tonth.append(0.5 * (shells[n] + shells[n + 1]))
+        else:
+            print("  [Warning] Supercell too small to find n-th neighbours.")
+            tonth.append(1.1 * shells[-1])
+    return max(tonth)
+
+def find_triplets(sposcar, frange):
+    dmin = neighbor_distances(sposcar, frange)
+    neighbors = defaultdict(set)
+    for (a, b) in dmin:
+        neighbors[a].add(b)
+
+    triplets = set()
+    for i in range(sposcar['natoms_unit']):
+        shell = sorted(neighbors[i] | {i})
+        for j in shell:
+            for k in shell:
+                if j == k or k in neighbors[j]:
+                    triplets.add((i, j, k))
+    return triplets
+
+def axis_permutation(order):
+    """27x27 matrix reordering the Cartesian indices of a flattened (a, b, c) tensor."""
+    basis = np.eye(27).reshape(27, 3, 3, 3)
+    return np.transpose(basis, (0,) + tuple(1 + axis for axis in order)).reshape(27, 27).T
+
+def irreducible_triplets(triplets, operations):
+    """First triplet of every orbit in lexicographic order (thirdorder's choice), each with
+    the 27x27 matrices of the operations and index permutations that leave it in place."""
+    orders = list(itertools.permutations(range(3)))
+    mats = [[axis_permutation(order) @ np.kron(np.kron(op['rotation'], op['rotation']), op['rotation'])
+             for order in orders] for op in operations]
+    seen = set()
+    irreducible = []
+    for triplet in sorted(triplets):
+        if triplet in seen:
+            continue
+        stabilizer = []
+        for op, op_mats in zip(operations, mats):
+            mapped = tuple(int(op['perm'][x]) for x in triplet)
+            for order, mat in zip(orders, op_mats):
+                image = tuple(mapped[axis] for axis in order)
+                seen.add(image)
+                if image == triplet:
+                    stabilizer.append(mat)
+        irreducible.append((triplet, stabilizer))
+    return irreducible
+
+def independent_components(stabilizer):
+    """Flattened (a, b, c) components left free by Gaussian elimination of phi = M phi.
+
+    These are the non-pivot columns of the reduced constraint matrix, the same
+    'independent basis' thirdorder displaces for.
+    """
+    a = np.eye(27) - np.mean(stabilizer, axis=0)
+    row = 0
+    free = []
+    for col in range(27):
+        pivot = row + int(np.argmax(np.abs(a[row:, col]))) if row < 27 else row
+        if row == 27 or abs(a[pivot, col]) < PIVOT_TOLERANCE:
+            free.append(col)
+            continue
+        a[[row, pivot]] = a[[pivot, row]]
+        a[row] /= a[row, col]
+        others = np.arange(27) != row
+        a[others] -= np.outer(a[others, col], a[row])
+        row += 1
+    return free
+
+def sow_pairs(triplets, operations):
+    """Displaced (i, j, a, b) pairs in thirdorder's list4 order: atom i along a, atom j along b,
+    for the independent components of every irreducible triplet."""
+    pairs = {}
+    for (i, j, _), stabilizer in irreducible_triplets(triplets, operations):
+        for component in independent_components(stabilizer):
+            pairs.setdefault((i, j, component // 9, (component % 9) // 3), None)
+    return list(pairs)
+
+def sow_displacements(unit, na, nb, nc, cutoff, symprec=symmetry.DEFAULT_SYMPREC):
+    sposcar = build_supercell(unit, na, nb, nc)
+    frange = calc_frange(sposcar, cutoff)
+    triplets = find_triplets(sposcar, frange)
+    operations = symmetry.find_symmetry_operations(
+        sposcar['lattice'], sposcar['frac'], sposcar['species'], symprec)
+    pairs = sow_pairs(triplets, operations)
+
+    inv_lattice = np.linalg.inv(sposcar['lattice'])
+    step = H_DISPLACEMENT * np.eye(3) @ inv_lattice
+
+    displacements = []
+    for i, j, a, b in pairs:
+        for si, sj in itertools.product((1, -1), repeat=2):
+            frac = sposcar['frac'].copy()
+            frac[i] += si * step[a]
+            frac[j] += sj * step[b]
+            displacements.append(frac)
+
+    return sposcar, frange, displacements
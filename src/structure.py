@@ -0,0 +1,300 @@
+import os
+import re
+import mmap
+import hashlib
+import zipfile
+import numpy as np
+from src import disp_archive
+
+BOHR_TO_ANG = 0.529177210903
+DEFAULT_TOLERANCE = 1.0e-5
+# Coordinates are hashed on a grid this many tolerances wide, see hash_cells()
+HASH_GRID_FACTOR = 100
+MAX_PROBE_BITS = 8
+FINGERPRINT_VERSION = 2
+
+_UNIT_RE = re.compile(rb"[({]?\s*([A-Za-z_]+)\s*[)}]?")
+_NAT_RE = re.compile(rb"\bnat\s*=\s*(\d+)", re.IGNORECASE)
+_POS_RE = re.compile(rb"^[ \t]*ATOMIC_POSITIONS\b([^\n]*)", re.IGNORECASE | re.MULTILINE)
+_CELL_RE = re.compile(rb"^[ \t]*CELL_PARAMETERS\b([^\n]*)", re.IGNORECASE | re.MULTILINE)
+
+def _card_unit(rest, default):
+    match = _UNIT_RE.match(rest.strip())
+    return match.group(1).decode().lower() if match else default
+
+def _read_card(buf, header_match, nrows, ncols_skip):
+    rows = []
+    pos = header_match.end() + 1
+    size = len(buf)
+    while len(rows) < nrows and pos < size:
+        end = buf.find(b"\n", pos)
+        if end < 0:
+            end = size
+        fields = buf[pos:end].split()
+        pos = end + 1
+        if not fields or fields[0].startswith((b"!", b"#")):
+            continue
+        rows.append(fields)
+    if len(rows) < nrows:
+        return None
+    try:
+        values = [[float(x) for x in r[ncols_skip:ncols_skip + 3]] for r in rows]
+    except ValueError:
+        return None
+    if any(len(v) != 3 for v in values):
+        return None
+    return rows, np.array(values, dtype=float)
+
+def read_pw_structure(filepath):
+    if disp_archive.SEP in filepath:
+        try:
+            return _scan_structure(disp_archive.read_input(filepath))
+        except (IOError, OSError, KeyError, zipfile.BadZipFile):
+            return None
+
+    try:
+        with open(filepath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return _scan_structure(buf)
+    except (IOError, OSError, ValueError):
+        return None
+
+def _scan_structure(buf):
+    nat_match = _NAT_RE.search(buf)
+    pos_match = _POS_RE.search(buf)
+    if nat_match is None or pos_match is None:
+        return None
+    nat = int(nat_match.group(1))
+    if nat == 0:
+        return None
+
+    card = _read_card(buf, pos_match, nat, 1)
+    if card is None:
+        return None
+    rows, positions = card
+
+    cell = None
+    cell_unit = 'alat'
+    cell_match = _CELL_RE.search(buf)
+    if cell_match is not None:
+        cell_card = _read_card(buf, cell_match, 3, 0)
+        if cell_card is not None:
+            cell = cell_card[1]
+            cell_unit = _card_unit(cell_match.group(1), 'alat')
+
+    return {
+        'nat': nat,
+        'species': [r[0].decode() for r in rows],
+        'positions': positions,
+        'pos_unit': _card_unit(pos_match.group(1), 'alat'),
+        'cell': cell,
+        'cell_unit': cell_unit,
+    }
+
+def _to_angstrom(array, unit):
+    if unit == 'bohr':
+        return array * BOHR_TO_ANG
+    return array
+
+def fractional_positions(struct):
+    pos = struct['positions']
+    unit = struct['pos_unit']
+    cell = struct['cell']
+
+    if unit == 'crystal':
+        return pos.copy()
+    if cell is None:
+        return None
+
+    if unit == 'alat' and struct['cell_unit'] == 'alat':
+        return np.linalg.solve(cell.T, pos.T).T
+    if unit in ('bohr', 'angstrom') and struct['cell_unit'] in ('bohr', 'angstrom'):
+        cart = _to_angstrom(pos, unit)
+        lattice = _to_angstrom(cell, struct['cell_unit'])
+        return np.linalg.solve(lattice.T, cart.T).T
+    return None
+
+def wrap_fractional(frac):
+    return frac - np.floor(frac)
+
+def periodic_distance(frac_a, frac_b):
+    delta = frac_a - frac_b
+    delta -= np.rint(delta)
+    return np.abs(delta).max()
+
+def hash_cells(frac, periodic, tolerance=DEFAULT_TOLERANCE):
+    """Hash-grid cell of every coordinate, and the cell a match within `tolerance` may fall in.
+
+    The grid is HASH_GRID_FACTOR tolerances wide, so the second array only differs from
+    the first for the few coordinates lying within `tolerance` of a cell edge.
+    """
+    if periodic:
+        nbins = max(1, int(round(1.0 / (tolerance * HASH_GRID_FACTOR))))
+        scaled = frac * nbins
+        reach = tolerance * nbins
+    else:
+        scaled = frac / (tolerance * HASH_GRID_FACTOR)
+        reach = 1.0 / HASH_GRID_FACTOR
+    cells = np.rint(scaled)
+    offset = scaled - cells
+    neighbour = cells + np.where(np.abs(offset) > 0.5 - reach, np.sign(offset), 0.0)
+    cells = cells.astype(np.int64)
+    neighbour = neighbour.astype(np.int64)
+    if periodic:
+        cells %= nbins
+        neighbour %= nbins
+    return cells, neighbour
+
+def _cells_digest(cells):
+    return hashlib.blake2b(np.ascontiguousarray(cells, dtype=np.int64).tobytes(), digest_size=16).hexdigest()
+
+def structure_fingerprint(struct, tolerance=DEFAULT_TOLERANCE):
+    """(digest, coordinates, periodic) of a structure.
+
+    The digest is "<header>:<cells>": nat, species and cell (rounded to `tolerance`), then
+    the hash-grid cells of the wrapped fractional (or raw) coordinates. Equal digests only
+    propose a match; the distance check on the coordinates decides, see probe_digests().
+    """
+    frac = fractional_positions(struct)
+    periodic = frac is not None
+    if not periodic:
+        frac = struct['positions']
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(struct['nat']).encode())
+    h.update(" ".join(struct['species']).encode())
+
+    if struct['cell'] is not None:
+        lattice = _to_angstrom(struct['cell'], struct['cell_unit'])
+        unit_tag = 'alat' if struct['cell_unit'] == 'alat' else 'angstrom'
+        h.update(unit_tag.encode())
+        h.update(np.rint(lattice / tolerance).astype(np.int64).tobytes())
+
+    if periodic:
+        frac = wrap_fractional(frac)
+    else:
+        h.update(struct['pos_unit'].encode())
+    cells, _ = hash_cells(frac, periodic, tolerance)
+
+    return f"{h.hexdigest()}:{_cells_digest(cells)}", frac, periodic
+
+def probe_digests(fp, tolerance=DEFAULT_TOLERANCE):
+    """Every digest a structure within `tolerance` of `fp` can have, own digest first.
+
+    Coordinates near a cell edge may match a structure filed in the neighbouring cell, so
+    each combination of them is probed. Returns None past 2**MAX_PROBE_BITS combinations;
+    the caller then has to compare against every digest with the same header.
+    """
+    digest, frac, periodic = fp
+    header = digest.split(':', 1)[0]
+    cells, neighbour = hash_cells(frac, periodic, tolerance)
+    cells, neighbour = cells.ravel(), neighbour.ravel()
+    edge = np.flatnonzero(cells != neighbour)
+    if len(edge) > MAX_PROBE_BITS:
+        return None
+
+    digests = [digest]
+    for mask in range(1, 1 << len(edge)):
+        probe = cells.copy()
+        moved = edge[[(mask >> bit) & 1 == 1 for bit in range(len(edge))]]
+        probe[moved] = neighbour[moved]
+        digests.append(f"{header}:{_cells_digest(probe)}")
+    return digests
+
+_IBRAV_RE = re.compile(rb"\bibrav\s*=\s*(-?\d+)", re.IGNORECASE)
+_CELLDM_RE = re.compile(rb"\bcelldm\s*\(\s*(\d)\s*\)\s*=\s*([-+0-9.eEdD]+)", re.IGNORECASE)
+_ALAT_A_RE = re.compile(rb"(?<![\w(])A\s*=\s*([-+0-9.eEdD]+)")
+
+def _qe_float(raw):
+    return float(raw.decode().lower().replace('d', 'e'))
+
+def bravais_lattice(ibrav, celldm):
+    a = celldm.get(1, 0.0)
+    if ibrav == 1:
+        vecs = [[1, 0, 0], [0, 1, 0], [0, 0, 1]]
+    elif ibrav == 2:
+        vecs = [[-0.5, 0, 0.5], [0, 0.5, 0.5], [-0.5, 0.5, 0]]
+    elif ibrav == 3:
+        vecs = [[0.5, 0.5, 0.5], [-0.5, 0.5, 0.5], [-0.5, -0.5, 0.5]]
+    elif ibrav == 4:
+        vecs = [[1, 0, 0], [-0.5, np.sqrt(3) / 2, 0], [0, 0, celldm.get(3, 1.0)]]
+    elif ibrav == 6:
+        vecs = [[1, 0, 0], [0, 1, 0], [0, 0, celldm.get(3, 1.0)]]
+    elif ibrav == 8:
+        vecs = [[1, 0, 0], [0, celldm.get(2, 1.0), 0], [0, 0, celldm.get(3, 1.0)]]
+    else:
+        return None
+    return np.array(vecs, dtype=float) * a
+
+def read_unit_cell(filepath):
+    try:
+        with open(filepath, 'rb') as f:
+            buf = f.read()
+    except (IOError, OSError):
+        return None
+
+    struct = _scan_structure(buf)
+    if struct is None:
+        return None
+
+    ibrav_match = _IBRAV_RE.search(buf)
+    ibrav = int(ibrav_match.group(1)) if ibrav_match else 0
+    celldm = {int(m.group(1)): _qe_float(m.group(2)) for m in _CELLDM_RE.finditer(buf)}
+    a_match = _ALAT_A_RE.search(buf)
+    if 1 not in celldm and a_match:
+        celldm[1] = _qe_float(a_match.group(1)) / BOHR_TO_ANG
+
+    if ibrav == 0:
+        if struct['cell'] is None:
+            return None
+        cell = struct['cell']
+        if struct['cell_unit'] == 'alat':
+            cell = cell * celldm.get(1, 1.0)
+            struct['cell_unit'] = 'bohr'
+    else:
+        cell = bravais_lattice(ibrav, celldm)
+        if cell is None:
+            print(f"Error: ibrav = {ibrav} is not supported, please use ibrav = 0 in '{filepath}'.")
+            return None
+        struct['cell_unit'] = 'bohr'
+
+    lattice = _to_angstrom(cell, struct['cell_unit'])
+    if struct['pos_unit'] == 'alat':
+        cart = struct['positions'] * celldm.get(1, 1.0) * BOHR_TO_ANG
+        frac = np.linalg.solve(lattice.T, cart.T).T
+    else:
+        frac = fractional_positions(dict(struct, cell=lattice, cell_unit='angstrom'))
+    if frac is None:
+        return None
+
+    return {
+        'lattice': lattice,
+        'frac': wrap_fractional(frac),
+        'species': struct['species'],
+    }
+
+def replace_positions(text, species, frac):
+    buf = text.encode()
+    pos_match = _POS_RE.search(buf)
+    if pos_match is None:
+        return None
+    card = _read_card(buf, pos_match, len(species), 1)
+    if card is None:
+        return None
+
+    pos = pos_match.end() + 1
+    remaining = len(species)
+    while remaining and pos < len(buf):
+        end = buf.find(b"\n", pos)
+        end = len(buf) if end < 0 else end
+        fields = buf[pos:end].split()
+        pos = end + 1
+        if fields and not fields[0].startswith((b"!", b"#")):
+            remaining -= 1
+
+    lines = ["ATOMIC_POSITIONS crystal"]
+    for name, (x, y, z) in zip(species, frac):
+        lines.append(f"{name:4s} {x:16.10f} {y:16.10f} {z:16.10f}")
+    return (buf[:pos_match.start()] + "\n".join(lines).encode() + b"\n" + buf[pos:]).decode()
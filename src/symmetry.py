@@ -0,0 +1,106 @@
+import itertools
+import numpy as np
+
+DEFAULT_SYMPREC = 1.0e-3
+
+def _candidate_rotations():
+    entries = np.array(list(itertools.product((-1, 0, 1), repeat=9)), dtype=int)
+    mats = entries.reshape(-1, 3, 3)
+    dets = np.rint(np.linalg.det(mats)).astype(int)
+    return mats[np.abs(dets) == 1]
+
+def _wrapped_cartesian(delta, lattice):
+    delta = delta - np.rint(delta)
+    return delta @ lattice
+
+def equilibrium_positions(frac_list):
+    ref = frac_list[0]
+    stacked = np.stack(frac_list)
+    delta = stacked - ref
+    delta -= np.rint(delta)
+    eq = ref + np.median(delta, axis=0)
+    return eq - np.floor(eq)
+
+def find_symmetry_operations(lattice, frac, species, symprec=DEFAULT_SYMPREC):
+    metric = lattice @ lattice.T
+    scale = np.abs(metric).max()
+
+    rotations = _candidate_rotations()
+    transformed = np.einsum('nji,jk,nkl->nil', rotations, metric, rotations)
+    ok = np.abs(transformed - metric).reshape(len(rotations), -1).max(axis=1) < symprec * scale
+    rotations = rotations[ok]
+
+    species = np.asarray(species)
+    same_species = species[:, None] == species[None, :]
+    operations = []
+
+    inv_lattice = np.linalg.inv(lattice)
+    for W in rotations:
+        rotated = frac @ W.T
+        anchors = np.nonzero(species == species[0])[0]
+        for j in anchors:
+            t = frac[j] - rotated[0]
+            images = rotated + t
+            delta = images[:, None, :] - frac[None, :, :]
+            dist = np.linalg.norm(_wrapped_cartesian(delta, lattice), axis=2)
+            dist[~same_species] = np.inf
+
+            perm = dist.argmin(axis=1)
+            if dist[np.arange(len(frac)), perm].max() > symprec:
+                continue
+            if len(np.unique(perm)) != len(perm):
+                continue
+
+            cart_rot = lattice.T @ W @ inv_lattice.T
+            operations.append({'rotation': cart_rot, 'perm': perm, 'frac_rotation': W, 'translation': t})
+
+    return operations
+
+def displacement_pattern(eq, frac, lattice, symprec=DEFAULT_SYMPREC):
+    disp = _wrapped_cartesian(frac - eq, lattice)
+    norms = np.linalg.norm(disp, axis=1)
+    atoms = np.nonzero(norms > symprec)[0]
+    return atoms, disp[atoms]
+
+def _pattern_key(atoms, disp, step):
+    grid = np.rint(disp / step * 1000).astype(int)
+    order = np.lexsort((grid[:, 2], grid[:, 1], grid[:, 0], atoms))
+    return tuple((int(atoms[k]),) + tuple(int(x) for x in grid[k]) for k in order)
+
+def image_keys(atoms, disp, operations, step):
+    keys = []
+    for op in operations:
+        new_atoms = op['perm'][atoms]
+        new_disp = disp @ op['rotation'].T
+        keys.append(_pattern_key(new_atoms, new_disp, step))
+    return keys
+
+def classify_orbits(patterns, operations):
+    step = max(np.abs(d).max() for _, d in patterns if len(d)) if patterns else 1.0
+
+    orbit_of = {}
+    reps = []
+    assignment = []
+
+    for idx, (atoms, disp) in enumerate(patterns):
+        own_key = _pattern_key(atoms, disp, step)
+        canonical = min(image_keys(atoms, disp, operations, step))
+
+        if canonical not in orbit_of:
+            orbit_of[canonical] = idx
+            reps.append(idx)
+            assignment.append((idx, None))
+            continue
+
+        rep = orbit_of[canonical]
+        rep_atoms, rep_disp = patterns[rep]
+        rep_images = image_keys(rep_atoms, rep_disp, operations, step)
+        op_index = rep_images.index(own_key)
+        assignment.append((rep, op_index))
+
+    return reps, assignment
+
+def rotate_forces(forces, operation):
+    rotated = np.empty_like(forces)
+    rotated[operation['perm']] = forces @ operation['rotation'].T
+    return rotated
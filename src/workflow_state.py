@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import threading
+
+STATE_FILE = "workflow_state.json"
+
+PHASE_NEW = "new"
+PHASE_GENERATED = "generated"
+PHASE_DFT_SUBMITTED = "dft_submitted"
+PHASE_PIPELINE = "pipeline"
+PHASE_COMPLETE = "complete"
+PHASES = (PHASE_NEW, PHASE_GENERATED, PHASE_DFT_SUBMITTED, PHASE_PIPELINE, PHASE_COMPLETE)
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+class WorkflowState:
+    """Crash-safe record of where `auto` stopped.
+
+    Holds the workflow phase, the executor backend, and per config its pipeline stage,
+    the job currently working on it and the verified artifacts (size and mtime at the time
+    they were verified). Every update rewrites the JSON file atomically.
+    """
+
+    def __init__(self, configs, path=STATE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.key = sorted(list(c) for c in configs)
+        self.data = {'configs': self.key, 'phase': PHASE_NEW, 'backend': None,
+                     'folders': {}}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    saved = json.load(f)
+            except (IOError, OSError, ValueError):
+                print(f"  [Warning] Ignoring unreadable workflow state '{path}'.")
+                saved = None
+            if saved and saved.get('configs') == self.key:
+                self.data.update(saved)
+            elif saved:
+                print(f"  [Info] '{path}' records a different set of configs; starting a new workflow.")
+
+    def _save(self):
+        self.data['updated'] = time.time()
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(self.data, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    @property
+    def phase(self):
+        return self.data['phase']
+
+    @property
+    def backend(self):
+        return self.data['backend']
+
+    def reached(self, phase):
+        return PHASES.index(self.data['phase']) >= PHASES.index(phase)
+
+    def set_phase(self, phase, backend=None):
+        with self.lock:
+            self.data['phase'] = phase
+            if backend:
+                self.data['backend'] = backend
+            self._save()
+
+    def folder(self, folder):
+        return dict(self.data['folders'].get(folder, {}))
+
+    def update_folders(self, entries):
+        """Store {folder: {'stage', 'job', 'reason', 'artifacts'}}; writes only on change."""
+        with self.lock:
+            if entries == self.data['folders']:
+                return
+            self.data['folders'] = json.loads(json.dumps(entries))
+            self._save()
+
+    def artifact_valid(self, folder, path):
+        recorded = self.data['folders'].get(folder, {}).get('artifacts', {}).get(path)
+        return recorded is not None and recorded == file_signature(path)
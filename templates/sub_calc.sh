@@ -2,12 +2,13 @@
 #SBATCH -p <PARTITION_NAME>    # <--- [USER] Change to your cluster partition (e.g., v6_384)
 #SBATCH -N 1
 #SBATCH -n 96                  # <--- [USER] Change to cores per node
-#SBATCH --array=1-2            # <--- [USER] Adjust job array size based on your resource limit
-#SBATCH -J scf_array           # <--- [SYSTEM] DO NOT CHANGE. Used by automator for queue monitoring.
+#SBATCH --array=1-2            # <--- [USER] Default array size (submit_dft overrides it from MAX_ARRAY_TASKS)
+#SBATCH -J scf_array           # <--- [SYSTEM] Default name only (submit_dft names the jobs; the automator tracks job IDs).
 
 # ================= User Configuration =================
 # [1] Parallel Chunks
 # NOTE: This number MUST match the upper limit of '--array' above!
+# Only used for static chunking when no dft_queue.txt was published by submit_dft.
 NUM_CHUNKS=2
 
 # [2] Computational Resources
@@ -23,62 +24,267 @@ module load qe/6.7.0             # <--- [USER] Modify to your QE module
 # ... (Rest of the script logic remains unchanged) ...
 # (Only the header needs to be exposed for configuration)
 
+# Local backend (BACKEND = "local"): the cores reserved for this job are passed in AUTO3RD_NPROC
+if [ -n "$AUTO3RD_NPROC" ]; then
+    MY_NPROC=$AUTO3RD_NPROC
+    [ $MY_NPOOL -gt $MY_NPROC ] && MY_NPOOL=$MY_NPROC
+fi
+
 echo "=== Job Array ID: $SLURM_ARRAY_TASK_ID / $NUM_CHUNKS ==="
 echo "Work Dir: $(pwd)"
 
-files=($(ls DISP.* | grep -v "\.out$" | grep -v "\.save$" | grep -v "\.xml$" | grep -v "\.run$" | sort -V))
-total_files=${#files[@]}
+# Packed layout (DISP_LAYOUT = "packed"): inputs live in disp_inputs.zip and
+# outputs are appended to the disp_outputs.*.dat store. AUTO3RD_HOME is exported by submit_dft.
+ARCHIVE_TOOL="python3 ${AUTO3RD_HOME}/src/disp_archive.py"
+PACKED=0
+if [ -f "disp_inputs.zip" ]; then
+    PACKED=1
+fi
 
-echo "Total files found: $total_files"
+# Warm start (WARM_START = True): submit_dft first runs one undisplaced reference SCF per
+# supercell size in reference_<NaNbNc>/ (AUTO3RD_MODE=reference) and keeps its outdir.
+# Every displaced run then starts from a copy of that prefix.save (charge density and
+# wavefunctions); if a warm-started run does not converge it is rerun from scratch.
+WARM_START=${AUTO3RD_WARM_START:-0}
+REF_ROOT=${AUTO3RD_REF_ROOT:-..}
 
-if [ $total_files -eq 0 ]; then
-    echo "No files to process. Exiting."
-    exit 0
-fi
+# Retries of failed jobs (RETRY_LIMIT / FALLBACK_SCF in &dft): the automator writes
+# 'NAMELIST key value' lines to dft_fallback.txt and sets AUTO3RD_SCF_FALLBACK=1.
+SCF_FALLBACK=${AUTO3RD_SCF_FALLBACK:-0}
+FALLBACK_FILE="dft_fallback.txt"
 
-chunk_size=$(( (total_files + NUM_CHUNKS - 1) / NUM_CHUNKS ))
-start_idx=$(( (SLURM_ARRAY_TASK_ID - 1) * chunk_size ))
-my_batch=("${files[@]:$start_idx:$chunk_size}")
+set_input_param() {
+    local file="$1" namelist="$2" key="$3" value="$4"
+    sed -i "/^[[:space:]]*${key}[[:space:]]*=/Id" "$file"
+    [ -z "$value" ] && return 0
+    # Optional namelists (&ELECTRONS, ...) may be absent: add an empty one before the cards
+    if ! grep -qi "^[[:space:]]*&${namelist}\b" "$file"; then
+        awk -v nl="&${namelist}" '!added && tolower($0) ~ /^[[:space:]]*(&ions|&cell|atomic_species)/ \
+            {print nl; print "/"; added=1} {print}' "$file" > "${file}.tmp" && mv "${file}.tmp" "$file"
+    fi
+    sed -i "/^[[:space:]]*&${namelist}\b/Ia \ \ ${key} = ${value}" "$file"
+    grep -qi "^[[:space:]]*${key}[[:space:]]*=" "$file"
+}
 
-echo "Chunk Size: $chunk_size"
-echo "Processing Range: Index $start_idx to $((start_idx + ${#my_batch[@]} - 1))"
-echo "Files in this batch: ${#my_batch[@]}"
+run_pw() {
+    mpirun -np $MY_NPROC pw.x -npool $MY_NPOOL -input "$1" > "$2"
+}
 
-if [ ${#my_batch[@]} -eq 0 ]; then
-    echo "No files assigned to this chunk. Task Done."
+scf_converged() {
+    grep -q "JOB DONE" "$1" && ! grep -q "convergence NOT achieved" "$1"
+}
+
+if [ "$AUTO3RD_MODE" == "reference" ]; then
+    echo ">>> Reference SCF (undisplaced supercell) in $(pwd)"
+    rm -rf outdir
+    mkdir -p outdir
+    cp REF.in REF.in.run
+    set_input_param REF.in.run CONTROL outdir "'$(pwd)/outdir'"
+    run_pw REF.in.run REF.in.out
+    rm -f REF.in.run
+    if scf_converged REF.in.out; then
+        echo "=== Reference Ready ==="
+    else
+        echo "=== Reference SCF failed: displaced runs will start from scratch ==="
+        rm -rf outdir
+    fi
     exit 0
 fi
 
-for input in "${my_batch[@]}"; do
-    output="${input}.out"
+# Work-stealing queue: submit_dft publishes dft_queue.txt with only the jobs that
+# really need to run; every array task pulls the next entry until the queue is empty.
+# In global mode (SUBMIT_MODE = "global") the queue sits in the project root and its
+# entries are 'folder/DISP.*' paths; each job then runs inside its own folder.
+QUEUE_FILE="dft_queue.txt"
+CLAIMS_FILE="dft_queue.claims"
+DONE_FILE="dft_queue.done"
+LOCK_FILE="dft_queue.lock"
+if [ -n "$SLURM_ARRAY_JOB_ID" ]; then
+    WORKER_ID="${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}"
+else
+    WORKER_ID="pid_$$"
+fi
+
+# Fails only when the owner has positively ended: a failed squeue (controller timeout,
+# purged ID) counts as alive unless sacct reports a terminal state for the job.
+owner_alive() {
+    local owner="$1" listed state
+    case "$owner" in
+        pid_*) kill -0 "${owner#pid_}" 2>/dev/null; return ;;
+    esac
+    if listed=$(squeue -h -o "%i" -j "$owner" 2>/dev/null); then
+        [ -n "$listed" ]
+        return
+    fi
+    state=$(sacct -X -n -P -o State -j "$owner" 2>/dev/null | awk 'NF {print $1; exit}')
+    case "$state" in
+        COMPLETED|FAILED|CANCELLED|TIMEOUT|OUT_OF_MEMORY|NODE_FAIL|PREEMPTED|BOOT_FAIL|DEADLINE) return 1 ;;
+    esac
+    return 0
+}
+
+claim_next() {
+    (
+        flock -x 200
+        touch "$CLAIMS_FILE" "$DONE_FILE"
+        next=$(awk 'FILENAME == ARGV[1] {taken[$1]=1; next} !($1 in taken) {print $1; exit}' \
+               "$CLAIMS_FILE" "$QUEUE_FILE")
+
+        if [ -z "$next" ]; then
+            # Queue drained: reclaim entries whose owner died before finishing them
+            while read -r name owner stamp; do
+                [ "$owner" == "$WORKER_ID" ] && continue
+                grep -qxF "$name" "$DONE_FILE" && continue
+                owner_alive "$owner" && continue
+                next="$name"
+                echo "Reclaiming $name from $owner" >&2
+                break
+            done < "$CLAIMS_FILE"
+            if [ -n "$next" ]; then
+                awk -v n="$next" '$1 != n' "$CLAIMS_FILE" > "${CLAIMS_FILE}.tmp"
+                mv "${CLAIMS_FILE}.tmp" "$CLAIMS_FILE"
+            fi
+        fi
+
+        if [ -n "$next" ]; then
+            echo "$next $WORKER_ID $(date +%s)" >> "$CLAIMS_FILE"
+            echo "$next"
+        fi
+    ) 200>"$LOCK_FILE"
+}
+
+mark_done() {
+    ( flock -x 200; echo "$1" >> "$DONE_FILE" ) 200>"$LOCK_FILE"
+}
+
+run_one() {
+    local input="$1"
+    local output="${input}.out"
 
     if [ -L "$input" ] || [ -L "$output" ]; then
         echo "Skip Symlink (Deduplicated): $input"
-        continue
+        return
+    fi
+
+    if [ -f "sym_skip.list" ] && grep -qxF "$input" sym_skip.list; then
+        echo "Skip Symmetry-Equivalent (Synthesized later): $input"
+        return
     fi
 
     if [ -f "$output" ] && grep -q "JOB DONE" "$output"; then
         echo "Skip Completed: $output"
-        continue
+        return
     fi
 
     file_num=$(echo "$input" | awk -F'.' '{print $NF}')
     target_outdir="$(pwd)/outdir/job_${file_num}"
     
     run_input="${input}.run"
-    cp "$input" "$run_input"
+    if [ $PACKED -eq 1 ]; then
+        $ARCHIVE_TOOL extract . "$input" "$run_input"
+    else
+        cp "$input" "$run_input"
+    fi
 
     mkdir -p "$target_outdir"
 
     sed -i "/outdir/d" "$run_input" 
     sed -i "/&CONTROL/a \ \ outdir = '${target_outdir}'" "$run_input"
 
-    echo ">>> Running: $input (ID: $file_num)"
+    warm=0
+    if [ "$WARM_START" == "1" ]; then
+        grid=$(basename "$(pwd)" | cut -d_ -f2)
+        prefix=$(sed -n "s/.*prefix[[:space:]]*=[[:space:]]*['\"]\([^'\"]*\)['\"].*/\1/Ip" "$run_input" | head -n 1)
+        ref_save="${REF_ROOT}/reference_${grid}/outdir/${prefix:-pwscf}.save"
+        if [ -d "$ref_save" ]; then
+            cp -r "$ref_save" "$target_outdir/"
+            if set_input_param "$run_input" ELECTRONS startingpot "'file'" \
+                    && set_input_param "$run_input" ELECTRONS startingwfc "'file'"; then
+                warm=1
+            else
+                echo ">>> Could not set startingpot/startingwfc in $run_input; starting from scratch"
+                set_input_param "$run_input" ELECTRONS startingpot ""
+                rm -rf "$target_outdir/${prefix:-pwscf}.save"
+            fi
+        fi
+    fi
+
+    if [ "$SCF_FALLBACK" == "1" ] && [ -f "$FALLBACK_FILE" ]; then
+        while read -r namelist key value; do
+            [ -n "$key" ] && set_input_param "$run_input" "$namelist" "$key" "$value"
+        done < "$FALLBACK_FILE"
+        echo ">>> Fallback SCF settings applied: $(awk '{printf "%s=%s ", $2, $3}' "$FALLBACK_FILE")"
+    fi
+
+    echo ">>> Running: $input (ID: $file_num, warm start: $warm)"
 
-    mpirun -np $MY_NPROC pw.x -npool $MY_NPOOL -input "$run_input" > "$output"
+    run_pw "$run_input" "$output"
+
+    if [ $warm -eq 1 ] && ! scf_converged "$output"; then
+        echo ">>> Warm start failed for $input, retrying from scratch"
+        rm -rf "$target_outdir"
+        mkdir -p "$target_outdir"
+        set_input_param "$run_input" ELECTRONS startingpot ""
+        set_input_param "$run_input" ELECTRONS startingwfc ""
+        run_pw "$run_input" "$output"
+    fi
+
+    if [ $PACKED -eq 1 ]; then
+        $ARCHIVE_TOOL store . "$input" "$output" && rm -f "$output"
+    fi
 
     rm -rf "$target_outdir"
     rm -f "$run_input"
+}
+
+if [ -f "$QUEUE_FILE" ]; then
+    echo "Queue mode: $(wc -l < "$QUEUE_FILE") jobs in $QUEUE_FILE (worker $WORKER_ID)"
+    n_done=0
+    while true; do
+        entry=$(claim_next)
+        [ -z "$entry" ] && break
+        (
+            cd "$(dirname "$entry")" || exit 1
+            PACKED=0
+            [ -f "disp_inputs.zip" ] && PACKED=1
+            run_one "$(basename "$entry")"
+        )
+        mark_done "$entry"
+        n_done=$((n_done + 1))
+    done
+    echo "=== Queue Empty: $n_done jobs processed by $WORKER_ID ==="
+    exit 0
+fi
+
+if [ $PACKED -eq 1 ]; then
+    files=($($ARCHIVE_TOOL pending . | sort -V))
+else
+    files=($(ls DISP.* | grep -v "\.out$" | grep -v "\.save$" | grep -v "\.xml$" | grep -v "\.run$" | sort -V))
+fi
+total_files=${#files[@]}
+
+echo "Total files found: $total_files"
+
+if [ $total_files -eq 0 ]; then
+    echo "No files to process. Exiting."
+    exit 0
+fi
+
+chunk_size=$(( (total_files + NUM_CHUNKS - 1) / NUM_CHUNKS ))
+start_idx=$(( (SLURM_ARRAY_TASK_ID - 1) * chunk_size ))
+my_batch=("${files[@]:$start_idx:$chunk_size}")
+
+echo "Chunk Size: $chunk_size"
+echo "Processing Range: Index $start_idx to $((start_idx + ${#my_batch[@]} - 1))"
+echo "Files in this batch: ${#my_batch[@]}"
+
+if [ ${#my_batch[@]} -eq 0 ]; then
+    echo "No files assigned to this chunk. Task Done."
+    exit 0
+fi
+
+for input in "${my_batch[@]}"; do
+    run_one "$input"
 done
 
 echo "=== Batch Complete ==="
@@ -2,7 +2,7 @@
 #SBATCH -p <PARTITION_NAME>    # <--- [USER] Change to your cluster partition
 #SBATCH -N 1
 #SBATCH -n 1
-#SBATCH -J Gen_FC3             # <--- [SYSTEM] DO NOT CHANGE. Used by automator for queue monitoring.
+#SBATCH -J Gen_FC3             # <--- [SYSTEM] Job name (the automator tracks job IDs from job_registry.json).
 #SBATCH -o reap.out            # <--- [SYSTEM] DO NOT CHANGE. Used by automator to verify 'Success'.
 
 # ================= User Configuration =================
@@ -2,7 +2,7 @@
 #SBATCH -p <PARTITION_NAME>    # <--- [USER] Change to your cluster partition
 #SBATCH -N 1
 #SBATCH -n 96                  # <--- [USER] Change to cores per node
-#SBATCH -J shengBTE            # <--- [SYSTEM] DO NOT CHANGE. Used by automator for queue monitoring.
+#SBATCH -J shengBTE            # <--- [SYSTEM] Default name only (run_bte names the jobs K_<size>_<cutoff>).
 #SBATCH -o shengbte.out        # <--- [SYSTEM] DO NOT CHANGE. Used by automator to verify 'Job Done'.
 
 # ================= User Configuration =================
@@ -24,6 +24,11 @@ module load qe/6.7.0           # <--- [USER] Load MPI environment required by Sh
 # ======================================================
 # ... (Rest of the script logic remains unchanged) ...
 
+# Local backend (BACKEND = "local"): the cores reserved for this job are passed in AUTO3RD_NPROC
+if [ -n "$AUTO3RD_NPROC" ]; then
+    MY_NPROC=$AUTO3RD_NPROC
+fi
+
 echo "=== Job Started at $(date) ==="
 echo "Work Dir: $(pwd)"
 
@@ -44,9 +49,15 @@ done
 
 echo "Starting ShengBTE calculation..."
 
-mpirun -np $MY_NPROC "$SHENGBTE_EXE"
+# Packed allocations (PACK_TASKS) launch each task with 'srun --exclusive -n' instead
+LAUNCHER=${AUTO3RD_LAUNCHER:-"mpirun -np"}
+
+START_TIME=$(date +%s)
+$LAUNCHER $MY_NPROC "$SHENGBTE_EXE"
+STATUS=$?
+echo "ShengBTE wall time: $(( $(date +%s) - START_TIME )) s"
 
-if [ $? -eq 0 ]; then
+if [ $STATUS -eq 0 ]; then
     echo "Job Done Successfully at $(date)."
 else
     echo "Job Failed at $(date)."